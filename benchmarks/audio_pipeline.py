@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Measures how many guilds the Spotify player serves at once, without Spotify.
+
+A fake librespot session writes a synthetic tone into every player. Each stream gets a thread reading
+`SpotSpawn.read()` every 20ms, like discord's audio player does. Reports the frames per second read,
+per frame latency, deadlines missed and the memory used.
+
+Run with `python -m benchmarks.audio_pipeline` from the repository root.
+"""
+
+import resource
+import threading
+import time
+
+import click
+import numpy as np
+
+from benchmarks import fake_librespot
+
+FRAME_DURATION = 0.02  # seconds
+
+
+class _Stream:
+    def __init__(self, spawn):
+        self.spawn = spawn
+        self.latencies = []
+        self.misses = 0
+        self.frames = 0
+
+
+def _drive(stream: _Stream, stop_at: float):
+    """Reads a frame every 20ms until `stop_at`. A late frame doesn't shift the next deadlines, like
+    discord's audio player."""
+    start = time.perf_counter()
+    latencies = stream.latencies
+    read = stream.spawn.read
+    index = 0
+    while True:
+        deadline = start + (index + 1) * FRAME_DURATION
+        if deadline > stop_at:
+            break
+        before = time.perf_counter()
+        read()
+        after = time.perf_counter()
+        latencies.append(after - before)
+        if after > deadline:
+            stream.misses += 1
+        index += 1
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    stream.frames = index
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / 1024 ** 2
+    except OSError:
+        return float('nan')
+
+
+@click.command()
+@click.option('--streams', default=8, help='Number of guilds playing at the same time.')
+@click.option('--seconds', default=10.0, help='Seconds every stream plays.')
+@click.option('--speed', default=1.0, help='Rate librespot writes audio at, times real-time. 0 is unthrottled.')
+@click.option('--track_seconds', default=30, help='Length of every track.')
+@click.option('--buffer_frames', default=50, help='Audio buffered ahead of playback, in 20ms frames.')
+@click.option('--crossfade_ms', default=0, help='Cross-fade between tracks.')
+def main(streams, seconds, speed, track_seconds, buffer_frames, crossfade_ms):
+    fake_librespot.install(speed, track_seconds)
+    # Imports librespot, so only after the fake is installed
+    from cogs.players.spotify.spawn import SpotSpawn
+
+    rss_before = _rss_mb()
+    started = time.perf_counter()
+    players = []
+    for i in range(streams):
+        spawn = SpotSpawn(('benchmark', 'benchmark'), buffer_frames, crossfade_ms)
+        spawn.queue(' '.join(f'track:{i:08d}{track:014d}' for track in range(int(seconds // track_seconds) + 2)))
+        spawn.resume()
+        players.append(_Stream(spawn))
+    click.echo(f'Started {streams} streams in {(time.perf_counter() - started) * 1000:.1f} ms')
+
+    # Give librespot a head start, like the first frames of a track in discord
+    time.sleep(min(0.5, buffer_frames * FRAME_DURATION))
+    stop_at = time.perf_counter() + seconds
+    threads = [threading.Thread(target=_drive, args=(stream, stop_at), daemon=True) for stream in players]
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    rss_after = _rss_mb()
+
+    latencies = np.concatenate([np.array(stream.latencies) for stream in players]) * 1000
+    frames = sum(stream.frames for stream in players)
+    misses = sum(stream.misses for stream in players)
+    underruns = sum(stream.spawn.underruns for stream in players)
+    for stream in players:
+        stream.spawn.cleanup()
+
+    click.echo(f'         frames/sec: {frames / wall:9.1f} (real-time is {streams / FRAME_DURATION:.0f})')
+    click.echo(f'  latency p50 / p99: {np.percentile(latencies, 50):9.3f} / {np.percentile(latencies, 99):.3f} ms')
+    click.echo(f'        latency max: {latencies.max():9.3f} ms')
+    click.echo(f'    deadline misses: {misses:9d} of {frames} frames')
+    click.echo(f'          underruns: {underruns:9d} frames of silence')
+    click.echo(f'         CPU of wall: {cpu / wall * 100:9.1f} %')
+    click.echo(f'                RSS: {rss_after:9.1f} MB ({(rss_after - rss_before) / streams:.1f} MB per stream)')
+    click.echo(f'           peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:9.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Measures looking up voice channels by name, like `join` does, on a guild with thousands of channels.
+
+Compares scanning every channel name with the channel index: exact names, abbreviations, misspellings,
+and keeping the index current while channels are renamed. Fails when the p99 of a lookup through the index
+exceeds the target, the max is reported against it as well.
+
+Run with `python -m benchmarks.channel_lookup` from the repository root.
+"""
+
+import random
+import string
+import sys
+import time
+import types
+
+import click
+import numpy as np
+from unidecode import unidecode
+
+from util.channel_index import ChannelIndex
+
+WORDS = ('general', 'music', 'gaming', 'lounge', 'chill', 'raid', 'stream', 'study', 'afk', 'café', 'übungsraum',
+         'team', 'squad', 'party', 'karaoke', 'movie', 'night', 'voice', 'talk', 'events')
+TARGET_MS = 1.0  # per lookup through the index
+
+
+def _channels(count: int):
+    return [types.SimpleNamespace(id=channel_id, name=f'{" ".join(random.sample(WORDS, 2)).title()} {channel_id}')
+            for channel_id in range(1, count + 1)]
+
+
+def _misspell(name: str):
+    i = random.randrange(len(name))
+    return name[:i] + random.choice(string.ascii_lowercase) + name[i + 1:]
+
+
+def _scan(channels, query):
+    # What `join` did before the index
+    return next(filter(lambda x: unidecode(x.name).strip().startswith(query), channels), None)
+
+
+def _measure(lookup, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        lookup(query)
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000
+
+
+def _report(name, latencies, target=None):
+    """Echoes the percentiles, against the target when there is one. Returns whether the p99 is within it."""
+    p99, worst = np.percentile(latencies, 99), latencies.max()
+    line = f'{name:>24}: p50 {np.percentile(latencies, 50):7.3f}  p99 {p99:7.3f}  max {worst:7.3f} ms'
+    if target is not None:
+        line += f'  (p99 {p99 / target:.0%}, max {worst / target:.0%} of {target} ms)'
+    click.echo(line)
+    return target is None or p99 <= target
+
+
+@click.command()
+@click.option('--channels', default=5000, help='Voice channels of the guild.')
+@click.option('--lookups', default=1000, help='Lookups per kind of query.')
+@click.option('--seed', default=0, help='Seed of the channel names and queries.')
+@click.option('--target', default=TARGET_MS, help='Allowed p99 of a lookup through the index, in ms.')
+def main(channels, lookups, seed, target):
+    random.seed(seed)
+    all_channels = _channels(channels)
+    start = time.perf_counter()
+    index = ChannelIndex(all_channels)
+    click.echo(f'Indexed {len(index)} channels in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    names = [random.choice(all_channels).name for _ in range(lookups)]
+    _report('scan, exact', _measure(lambda query: _scan(all_channels, query), names))
+    within = [
+        _report('index, exact', _measure(index.best, names), target),
+        _report('index, abbreviated', _measure(index.best, [name[:random.randint(3, 8)] for name in names]), target),
+        _report('index, misspelled', _measure(index.best, [_misspell(name) for name in names]), target),
+        _report('index, 5 ranked', _measure(index.find, [_misspell(name) for name in names]), target),
+    ]
+
+    renamed = random.sample(all_channels, min(lookups, channels))
+    for channel in renamed:
+        channel.name = f'{channel.name} renamed'
+    _report('index, rename', _measure(index.add, renamed))
+
+    hits = sum(index.best(_misspell(name)) is not None for name in names)
+    click.echo(f'Misspelled names found: {hits} of {len(names)}')
+    if not all(within):
+        click.echo(f'FAIL: lookups exceed {target} ms at p99')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Load-tests command dispatch of the bot with a simulated gateway, without network.
+
+Synthetic guild messages are dispatched like gateway events and go through `process_commands`: prefix
+resolution, cooldown buckets of `Administration` and the `Voice` commands with stubbed voice clients.
+Reports the messages handled per second, latency from dispatch until the command finished, and how
+late the event loop runs its callbacks.
+
+Run with `python -m benchmarks.dispatch` from the repository root.
+"""
+
+import asyncio
+import tempfile
+import time
+import types
+
+import click
+import numpy as np
+from discord.ext import commands
+
+import util
+from benchmarks.fake_discord import BOT_ID, Guild, Message, install_config
+
+OWNER_ID = 1
+LAG_INTERVAL = 0.01  # seconds between event loop lag probes
+TICK = 0.01  # seconds between batches of gateway events at a fixed rate
+
+# What every guild keeps sending, in order. Join first, so no command hits a missing voice state.
+SCRIPT = (
+    '!join General',
+    'just chatting',
+    '!playing',
+    '!volume 50',
+    '!seek +10',
+    '!add prefix p!',
+    'p!playing',
+    '!nope',
+    '!summon',
+    '!leave',
+)
+
+
+class _Context(commands.Context):
+    async def send(self, content=None, **kwargs):
+        self.bot.responses += 1
+        return types.SimpleNamespace(id=0, content=content)
+
+
+def _bench_bot(cache_manager):
+    # Imports config, so only after it's installed
+    from bot import PinguBot
+
+    class BenchBot(PinguBot):
+        def __init__(self):
+            super().__init__(cache_manager)
+            self._connection.user = types.SimpleNamespace(id=BOT_ID, bot=True, name='Pingu', mention=f'<@{BOT_ID}>')
+            self.owner_id = OWNER_ID
+            self.responses = 0
+            self.latencies = []
+            self.all_done = asyncio.Event()
+            self.expected = 0
+
+        async def get_context(self, message, *, cls=_Context):
+            return await super().get_context(message, cls=cls)
+
+        async def invoke(self, ctx):
+            try:
+                await super().invoke(ctx)
+            finally:
+                self.latencies.append(time.perf_counter() - ctx.message.dispatched)
+                if len(self.latencies) == self.expected:
+                    self.all_done.set()
+
+    return BenchBot()
+
+
+async def _probe_lag(lags: list, stopped: asyncio.Event):
+    while not stopped.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+async def _gateway(bot, messages, rate: float, burst: int):
+    """Dispatches the messages like gateway events, `rate` per second or in bursts as fast as possible."""
+    per_tick = max(1, int(rate * TICK)) if rate else burst
+    start = time.perf_counter()
+    for tick, offset in enumerate(range(0, len(messages), per_tick)):
+        for message in messages[offset:offset + per_tick]:
+            message.dispatched = time.perf_counter()
+            bot.dispatch('message', message)
+        if rate:
+            await asyncio.sleep(max(0.0, start + (tick + 1) * TICK - time.perf_counter()))
+        else:
+            await asyncio.sleep(0)
+
+
+def _report_ms(name, values):
+    values = np.array(values) * 1000
+    click.echo(f'{name:>20}: p50 {np.percentile(values, 50):8.3f}  p99 {np.percentile(values, 99):8.3f}  '
+               f'max {values.max():8.3f} ms')
+
+
+@click.command()
+@click.option('--messages', default=20000, help='Number of messages to dispatch.')
+@click.option('--guilds', default=100, help='Number of distinct guilds.')
+@click.option('--rate', default=0.0, help='Messages per second, 0 dispatches as fast as possible.')
+@click.option('--burst', default=100, help='Messages dispatched at once without a rate.')
+@click.option('--metrics/--no-metrics', default=False, help='Collect the bot metrics during the run.')
+def main(messages, guilds, rate, burst, metrics):
+    install_config(EXTENSIONS_WHITELIST=('cogs.administration', 'cogs.voice'), PLAYERS_WHITELIST={}, AUDIO_WORKERS=0,
+                   METRICS=metrics, METRICS_PORT=None)
+    with tempfile.TemporaryDirectory() as directory:
+        cache_manager = util.CacheManager(directory)
+        try:
+            bot = _bench_bot(cache_manager)
+            all_guilds = [Guild(guild_id) for guild_id in range(1, guilds + 1)]
+            for guild in all_guilds:
+                bot.add_prefix_for_guild(guild.id, '!')
+            # Guilds take turns, every guild works through the script
+            samples = [Message(all_guilds[i % guilds], SCRIPT[(i // guilds) % len(SCRIPT)]) for i in range(messages)]
+            bot.expected = len(samples)
+            bot.loop.run_until_complete(_run(bot, samples, rate, burst))
+            bot.loop.run_until_complete(bot.global_cache.close())
+            if metrics:
+                click.echo(util.metrics.registry.summary())
+        finally:
+            cache_manager.cleanup()
+
+
+async def _run(bot, samples, rate, burst):
+    lags = []
+    stopped = asyncio.Event()
+    probe = asyncio.ensure_future(_probe_lag(lags, stopped))
+    start = time.perf_counter()
+    await _gateway(bot, samples, rate, burst)
+    await bot.all_done.wait()
+    elapsed = time.perf_counter() - start
+    stopped.set()
+    await probe
+
+    click.echo(f'{"throughput":>20}: {len(samples) / elapsed:10.0f} messages/s ({bot.responses} responses)')
+    _report_ms('dispatch latency', bot.latencies)
+    if lags:
+        _report_ms('event loop lag', lags)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Measures the per-frame cost of the DSP stage and fails when it's not well below the frame budget.
+
+Run with `python -m benchmarks.dsp` from the repository root.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import click
+import numpy as np
+
+from cogs.players.dsp import DspSource, SAMPLES_PER_FRAME, CHANNELS, DT
+from cogs.players.stub import StubSource
+
+FRAME_BUDGET = 0.020  # seconds
+
+
+class _SineSource(StubSource):
+    """Endless PCM sine tone, frames are generated up front."""
+
+    def __init__(self, frequency, amplitude, frames=50):
+        t = np.arange(frames * SAMPLES_PER_FRAME) / 48000
+        tone = (np.sin(2 * np.pi * frequency * t) * amplitude).astype(DT)
+        pcm = np.repeat(tone, CHANNELS)
+        size = SAMPLES_PER_FRAME * CHANNELS
+        self._frames = [pcm[i * size:(i + 1) * size].tobytes() for i in range(frames)]
+        self._index = 0
+
+    def read(self):
+        self._index += 1
+        return self._frames[self._index % len(self._frames)]
+
+
+@click.command()
+@click.option('--frames', default=5000, help='Number of 20ms frames to process.')
+@click.option('--max-fraction', default=0.05, help='Allowed fraction of the frame budget.')
+def main(frames, max_fraction):
+    dsp = DspSource(_SineSource(440, 8000), volume=0.8)
+    dsp.add_overlay(_SineSource(880, 2000))
+    for _ in range(100):
+        dsp.read()
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        dsp.read()
+    per_frame = (time.perf_counter() - start) / frames
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for _ in range(100):
+        dsp.read()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    click.echo(f'{per_frame * 1e6:.1f} us/frame ({per_frame / FRAME_BUDGET:.2%} of the frame budget), '
+               f'peak traced allocation {peak - before} bytes, '
+               f'integrated loudness {dsp.meter.integrated:.1f} LUFS')
+    if per_frame > FRAME_BUDGET * max_fraction:
+        click.echo(f'FAIL: more than {max_fraction:.0%} of the frame budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Stand-ins for the discord objects the cogs touch, so commands run without a gateway or voice connection.
+
+Voice channels take `connect_seconds` to connect and count connects which overlap within a guild.
+"""
+
+import asyncio
+import datetime
+import importlib
+import itertools
+import sys
+import types
+
+import discord
+
+BOT_ID = 123456789012345678
+
+
+def install_config(**overrides):
+    """The bot reads `config`, build it from the example with the overrides of what runs offline."""
+    config = types.ModuleType('config')
+    config.__dict__.update({k: v for k, v in vars(importlib.import_module('config_example')).items()
+                            if not k.startswith('__')})
+    config.__dict__.update(overrides)
+    sys.modules['config'] = config
+    return config
+
+
+class VoiceClient:
+    """Voice client without a connection or audio thread."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self._playing = False
+        self._paused = False
+
+    def play(self, source):
+        self.source = source
+        self._playing = True
+        self._paused = False
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def is_playing(self):
+        return self._playing and not self._paused
+
+    def is_paused(self):
+        return self._playing and self._paused
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self):
+        self.channel.guild.voice_client = None
+        if self.source is not None:
+            self.source.cleanup()
+
+
+class VoiceChannel:
+    def __init__(self, guild, channel_id: int, name: str):
+        self.id = channel_id
+        self.guild = guild
+        self.name = name
+
+    async def connect(self):
+        guild = self.guild
+        if guild.connecting:
+            guild.racing_connects += 1
+        if guild.voice_client is not None:
+            raise discord.ClientException('Already connected to a voice channel.')
+        guild.connecting = True
+        try:
+            if guild.connect_seconds:
+                await asyncio.sleep(guild.connect_seconds)
+        finally:
+            guild.connecting = False
+        guild.voice_client = VoiceClient(self)
+        return guild.voice_client
+
+
+class Guild:
+    def __init__(self, guild_id: int, connect_seconds: float = 0.0):
+        self.id = guild_id
+        self.name = f'Guild {guild_id}'
+        self.voice_client = None
+        self.connect_seconds = connect_seconds
+        self.connecting = False
+        # Connects started while another one of the guild was still connecting
+        self.racing_connects = 0
+        self.voice_channels = [VoiceChannel(self, guild_id * 10 + 2, 'General'),
+                               VoiceChannel(self, guild_id * 10 + 3, 'Music')]
+        self.text_channel = types.SimpleNamespace(id=guild_id * 10, guild=self, name='general')
+        self.member = Member(guild_id * 10 + 1, self)
+        self.me = Member(BOT_ID, self)
+
+
+class Member:
+    def __init__(self, member_id: int, guild):
+        self.id = member_id
+        self.guild = guild
+        self.bot = False
+        self.name = self.display_name = f'Member {member_id}'
+        self.mention = f'<@{member_id}>'
+
+    @property
+    def voice(self):
+        # Summoning goes to the channel the bot joined first
+        return types.SimpleNamespace(channel=self.guild.voice_channels[0])
+
+    async def send(self, content=None, **kwargs):
+        pass
+
+
+class Message:
+    _ids = itertools.count(1)
+
+    def __init__(self, guild: Guild, content: str):
+        self.id = next(self._ids)
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = guild.member
+        self.content = content
+        self.created_at = datetime.datetime.utcnow()
+        self.mentions = []
+        self._state = None
+        self.dispatched = None
@@ -0,0 +1,133 @@
+"""Stand-in for the librespot binding, so SpotSpawn runs without a Spotify account or network.
+
+`install()` replaces `librespot.Session` and `librespot.SpotifyId` before the spotify player is imported.
+Loaded tracks are a 440Hz tone of 44.1kHz stereo PCM, written into the sink at `speed` times real-time.
+Logging in takes `login_seconds`.
+"""
+
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+INPUT_RATE = 44100
+CHANNELS = 2
+SAMPLE_SIZE = 2
+BYTES_PER_SECOND = INPUT_RATE * CHANNELS * SAMPLE_SIZE
+CHUNK_MS = 100  # Audio written into the sink at once
+TRACK_SECONDS = 30  # Default length of every track
+
+# One second holds exactly 440 periods, so repeating it gives a continuous tone
+_t = np.arange(INPUT_RATE) / INPUT_RATE
+_TONE = np.repeat((np.sin(2 * np.pi * 440 * _t) * 8000).astype('<i2').reshape((-1, 1)), CHANNELS, axis=1).tobytes()
+# Chunks may wrap around the end of the second
+_TONE_TWICE = _TONE * 2
+
+
+class SpotifyId:
+    def __init__(self, track_id: str):
+        self.track_id = track_id
+
+
+class _Loaded:
+    """Future of a load, callbacks fire once the whole track is written."""
+
+    def __init__(self):
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def _done(self):
+        for callback in self._callbacks:
+            callback()
+
+
+class Player:
+    def __init__(self, session):
+        self._session = session
+        self._sink_lock = threading.Lock()
+        # Loads replace the running one, eg when seeking
+        self._generation = 0
+
+    def load(self, track_id: SpotifyId, autostart: bool = True, position_ms: int = 0):
+        self._generation += 1
+        loaded = _Loaded()
+        threading.Thread(target=self._write_track, args=(loaded, self._generation, position_ms),
+                         name='Fake librespot', daemon=True).start()
+        return loaded
+
+    def _write_track(self, loaded: _Loaded, generation: int, position_ms: int):
+        speed = self._session.speed
+        chunk_size = BYTES_PER_SECOND * CHUNK_MS // 1000
+        offset = INPUT_RATE * position_ms // 1000 * CHANNELS * SAMPLE_SIZE
+        end = BYTES_PER_SECOND * self._session.track_seconds
+        start = time.perf_counter()
+        written = 0
+        try:
+            while offset < end:
+                if generation != self._generation:
+                    return
+                size = min(chunk_size, end - offset)
+                at = offset % BYTES_PER_SECOND
+                chunk = _TONE_TWICE[at:at + size]
+                with self._sink_lock:
+                    self._session.sink.write(chunk)
+                    self._session.sink.flush()
+                offset += size
+                written += size
+                if speed:
+                    delay = start + written / (BYTES_PER_SECOND * speed) - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+        except (OSError, ValueError):
+            # The player was cleaned up
+            return
+        loaded._done()
+
+    def play(self):
+        pass
+
+    def pause(self):
+        pass
+
+
+class _Connecting:
+    def __init__(self, session):
+        self._session = session
+
+    def wait(self):
+        # The login round-trip
+        time.sleep(self._session.login_seconds)
+        return self._session
+
+
+class Session:
+    """Writes tracks at `speed` times real-time, 0 writes as fast as the sink takes them."""
+    speed = 1.0
+    track_seconds = TRACK_SECONDS
+    login_seconds = 0.0
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    @classmethod
+    def connect(cls, username: str, password: str, sink):
+        return _Connecting(cls(sink))
+
+    def player(self):
+        return Player(self)
+
+
+def install(speed: float = 1.0, track_seconds: int = TRACK_SECONDS, login_seconds: float = 0.0):
+    """Makes `import librespot` hand out the fake session, whether or not the binding is installed."""
+    try:
+        import librespot
+    except ImportError:
+        librespot = sys.modules['librespot'] = types.ModuleType('librespot')
+    librespot.Session = type('Session', (Session,), {'speed': speed, 'track_seconds': track_seconds,
+                                                     'login_seconds': login_seconds})
+    librespot.SpotifyId = SpotifyId
+    return librespot
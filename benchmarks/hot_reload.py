@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Reloads the Spotify player and the voice cog while guilds are playing, without Spotify or discord.
+
+Every guild joins a stub voice channel and attaches the Spotify player, which plays a synthetic tone from a
+fake librespot session. A thread per guild reads the source of its voice client every 20ms, like discord's
+audio player. Meanwhile the player (with its spawn module) and the voice cog are reloaded in turns.
+
+Reports how long reloads take, the objects they leave behind, late and silent frames, and checks that the
+lazily loaded player got its cache arena's, that every guild kept its voice client and source, and that the
+sources run the reloaded classes.
+
+Run with `python -m benchmarks.hot_reload` from the repository root.
+"""
+
+import asyncio
+import gc
+import sys
+import tempfile
+import threading
+import time
+
+import click
+import numpy as np
+
+import util
+from benchmarks import fake_librespot
+from benchmarks.fake_discord import Guild, install_config
+
+FRAME_DURATION = 0.02  # seconds
+PLAYER_MODULE = 'cogs.players.spotify.control'
+SPAWN_MODULE = 'cogs.players.spotify.spawn'
+RELOADS = ((PLAYER_MODULE, (SPAWN_MODULE,)), ('cogs.voice', ()))
+
+
+class _Listener:
+    """Reads the source of a voice client on a 20ms cadence, whichever source that is at the time."""
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.frames = 0
+        self.misses = 0
+        self.silent = 0
+        self.gaps = []
+
+    def run(self, stop: threading.Event):
+        start = time.perf_counter()
+        previous = start
+        while not stop.is_set():
+            frame = self.guild.voice_client.source.read()
+            now = time.perf_counter()
+            self.frames += 1
+            self.gaps.append(now - previous)
+            previous = now
+            if frame == bytes(len(frame)):
+                self.silent += 1
+            deadline = start + self.frames * FRAME_DURATION
+            if now > deadline:
+                self.misses += 1
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+async def _attach(bot, guilds, tracks: int):
+    voice = bot.get_cog('Voice')
+    for guild in guilds:
+        await voice._build_voice_state_or_move(guild.voice_channels[0])
+        await voice._attach_source(guild, 'spotify')
+        spawn = bot.get_cog('SpotControl').get_spawn(guild)
+        spawn.queue(' '.join(f'track:{guild.id:08d}{track:014d}' for track in range(tracks)))
+        spawn.resume()
+
+
+async def _leave(bot, guilds):
+    voice = bot.get_cog('Voice')
+    for guild in guilds:
+        await voice._remove_voice_state(guild)
+
+
+async def _reload(bot, reloads: int, interval: float, reload: bool):
+    durations, cpu = [], []
+    for i in range(reloads):
+        await asyncio.sleep(interval)
+        if not reload:
+            continue
+        name, modules = RELOADS[i % len(RELOADS)]
+        # Wall time includes waiting for the GIL while the audio threads run
+        start = time.thread_time()
+        durations.append(bot.reload_extension(name, modules))
+        cpu.append(time.thread_time() - start)
+        # Listeners of the reload run
+        await asyncio.sleep(0)
+    return durations, cpu
+
+
+def _check(bot, guilds, clients: list, sources: list):
+    problems = []
+    control = bot.get_cog('SpotControl')
+    spawn_class = sys.modules[SPAWN_MODULE].SpotSpawn
+    for guild, client, source in zip(guilds, clients, sources):
+        if guild.voice_client is not client or bot.get_cog('Voice')._voice_states.get(guild.id) is not client:
+            problems.append(f'guild {guild.id} got another voice client')
+        elif client.source is not source:
+            problems.append(f'guild {guild.id} plays another source')
+        if type(control.get_spawn(guild)) is not spawn_class:
+            problems.append(f'guild {guild.id} runs the previous SpotSpawn')
+    if bot.get_cog('Voice')._players['spotify'].__self__ is not control:
+        problems.append('attaching spotify goes through the previous control object')
+    return problems
+
+
+def _check_arenas(bot):
+    """The player loaded on the first attach, it should have its cache arena's nevertheless."""
+    control = bot.get_cog('SpotControl')
+    problems = []
+    if control.track_cache is None:
+        problems.append('the lazily loaded player has no track cache')
+    if control._queue_arena is None:
+        problems.append('the lazily loaded player has no queue arena')
+    return problems
+
+
+def _report_ms(name, values):
+    values = np.array(values) * 1000
+    click.echo(f'{name:>18}: p50 {np.percentile(values, 50):8.2f}  p99 {np.percentile(values, 99):8.2f}  '
+               f'max {values.max():8.2f} ms')
+
+
+@click.command()
+@click.option('--guilds', default=8, help='Guilds playing while reloading.')
+@click.option('--reloads', default=20, help='Reloads, alternating between the Spotify player and the voice cog.')
+@click.option('--interval_ms', default=250, help='Time between reloads.')
+@click.option('--reload/--no-reload', default=True, help='Reload, or only play for a baseline.')
+def main(guilds, reloads, interval_ms, reload):
+    fake_librespot.install()
+    spot_player = dict(install_config().SPOT_PLAYER, metadata={}, track_cache_mb=64)
+    install_config(EXTENSIONS_WHITELIST=('cogs.voice',), PLAYERS_WHITELIST={'spotify': PLAYER_MODULE},
+                   AUDIO_WORKERS=0, PRE_ENCODE_OPUS=False, METRICS=False, METRICS_PORT=None, SPOT_PLAYER=spot_player)
+    # Imports config, so only after it's installed
+    from bot import PinguBot
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache_manager = util.CacheManager(directory)
+        try:
+            bot = PinguBot(cache_manager)
+            all_guilds = [Guild(guild_id) for guild_id in range(1, guilds + 1)]
+            seconds = reloads * interval_ms / 1000
+            tracks = int(seconds // fake_librespot.TRACK_SECONDS) + 2
+            bot.loop.run_until_complete(_attach(bot, all_guilds, tracks))
+            # Like once the bot is ready
+            bot.freeze_startup()
+            clients = [guild.voice_client for guild in all_guilds]
+            sources = [client.source for client in clients]
+            # Give librespot a head start, like the first frames of a track in discord
+            time.sleep(0.5)
+
+            gc.collect()
+            objects = len(gc.get_objects())
+            stop = threading.Event()
+            listeners = [_Listener(guild) for guild in all_guilds]
+            threads = [threading.Thread(target=listener.run, args=(stop,), daemon=True) for listener in listeners]
+            for thread in threads:
+                thread.start()
+            durations, cpu = bot.loop.run_until_complete(_reload(bot, reloads, interval_ms / 1000, reload))
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            frames = sum(listener.frames for listener in listeners)
+            gc.collect()
+            growth = len(gc.get_objects()) - objects
+            if reload:
+                _report_ms('reload', durations)
+                _report_ms('reload CPU', cpu)
+                click.echo(f'{"objects left":>18}: {growth / reloads:.0f} per reload')
+            _report_ms('frame interval', [gap for listener in listeners for gap in listener.gaps])
+            click.echo(f'{"late frames":>18}: {sum(listener.misses for listener in listeners)} of {frames}')
+            click.echo(f'{"silent frames":>18}: {sum(listener.silent for listener in listeners)} of {frames}')
+            problems = _check_arenas(bot)
+            problems += _check(bot, all_guilds, clients, sources) if reload else []
+            click.echo(f'{"kept state":>18}: {"; ".join(problems) or "every guild, no reconnects"}')
+
+            bot.loop.run_until_complete(_leave(bot, all_guilds))
+            bot.remove_cog('Voice')
+            bot.remove_cog('SpotControl')
+            bot.loop.run_until_complete(bot.global_cache.close())
+        finally:
+            cache_manager.cleanup()
+
+
+if __name__ == '__main__':
+    main()
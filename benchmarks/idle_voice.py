@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Measures the CPU an idle voice state costs per guild, per second of audio.
+
+Run with `python -m benchmarks.idle_voice` from the repository root.
+"""
+
+import time
+
+import click
+import discord
+
+from cogs.players.stub import StubSource, SilenceSource
+
+FRAMES_PER_SECOND = 50  # 20ms frames
+
+
+def _encoding_reader(source, encoder):
+    """Mimics discord's audio thread for PCM sources, every frame gets encoded."""
+    def read():
+        encoder.encode(source.read(), encoder.SAMPLES_PER_FRAME)
+    return read
+
+
+def _cpu_per_guild_second(read, frames):
+    start = time.process_time()
+    for _ in range(frames):
+        read()
+    per_frame = (time.process_time() - start) / frames
+    return per_frame * FRAMES_PER_SECOND
+
+
+def _report(name, cost):
+    click.echo(f'{name:>22}: {cost * 1e6:9.1f} us CPU per idle guild per second')
+
+
+@click.command()
+@click.option('--frames', default=20000, help='Number of 20ms frames read per source.')
+def main(frames):
+    try:
+        encoder = discord.opus.Encoder()
+        _report('stub PCM + encode', _cpu_per_guild_second(_encoding_reader(StubSource(), encoder), frames))
+    except discord.opus.OpusNotLoaded:
+        click.echo('Opus library not found, skipping the PCM encode path')
+
+    # Never times out within the benchmark
+    silence = SilenceSource(idle_timeout=frames)
+    _report('opus silence', _cpu_per_guild_second(silence.read, frames))
+    click.echo('After the idle timeout the audio player stops, idle guilds then cost no CPU at all')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Resolves a playlist against the stub metadata provider and reports when the first tracks and the
+whole playlist are queued, with and without concurrent lookups and memoization.
+
+Run with `python -m benchmarks.metadata` from the repository root.
+"""
+
+import asyncio
+import tempfile
+import time
+
+import click
+import diskcache
+
+from benchmarks import fake_librespot
+
+PLAYLIST = 'stubplaylist0000000000'
+
+
+async def _queue_playlist(resolver, loop):
+    start = time.perf_counter()
+    first = None
+    queued = []
+    async for track_ids in resolver.resolve(f'playlist:{PLAYLIST}', loop):
+        queued.extend(track_ids)
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start, len(queued)
+
+
+def _report(name, loop, resolver):
+    first, total, count = loop.run_until_complete(_queue_playlist(resolver, loop))
+    click.echo(f'{name:>18}: first tracks after {first * 1000:7.1f} ms, {count} tracks after {total * 1000:7.1f} ms')
+
+
+@click.command()
+@click.option('--tracks', default=1000, help='Number of tracks in the playlist.')
+@click.option('--latency', default=0.05, help='Seconds every lookup takes.')
+@click.option('--concurrency', default=8, help='Lookups running at the same time.')
+def main(tracks, latency, concurrency):
+    fake_librespot.install()
+    # The spotify package imports librespot, so only after the fake is installed
+    from cogs.players.spotify.metadata import Resolver, StubMetadataProvider
+
+    loop = asyncio.get_event_loop()
+    provider = StubMetadataProvider(playlist_tracks=tracks, latency=latency)
+    _report('sequential', loop, Resolver(provider, concurrency=1))
+    _report(f'{concurrency} concurrent', loop, Resolver(provider, concurrency=concurrency))
+
+    with tempfile.TemporaryDirectory() as directory:
+        memoized = Resolver(provider, diskcache.FanoutCache(directory), concurrency=concurrency)
+        _report('memoized, cold', loop, memoized)
+        lookups = provider.lookups
+        _report('memoized, warm', loop, memoized)
+        if provider.lookups != lookups:
+            raise click.ClickException('The warm run looked up pages again')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Measures queueing a playlist into a persistent play queue, and restoring it after a restart.
+
+Run with `python -m benchmarks.play_queue` from the repository root.
+"""
+
+import tempfile
+import time
+
+import click
+import diskcache
+
+from cogs.players.play_queue import PlayQueue
+
+
+def _tracks(count):
+    return [f'{i:022x}' for i in range(count)]
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return (time.perf_counter() - start) * 1000, result
+
+
+@click.command()
+@click.option('--tracks', default=1000, help='Number of tracks in the playlist.')
+def main(tracks):
+    items = _tracks(tracks)
+    with tempfile.TemporaryDirectory() as directory:
+        naive = diskcache.Deque(directory=f'{directory}/naive')
+        elapsed, _ = _timed(lambda: [naive.append(item) for item in items])
+        click.echo(f' deque append per track: {elapsed:9.2f} ms')
+
+        queue = PlayQueue(diskcache.Deque(directory=f'{directory}/queue'))
+        elapsed, _ = _timed(lambda: queue.extend(items))
+        click.echo(f'      play queue extend: {elapsed:9.2f} ms (caller)')
+        elapsed, _ = _timed(queue.flush)
+        click.echo(f'       background flush: {elapsed:9.2f} ms (one transaction)')
+
+        # After a restart
+        restored = PlayQueue(diskcache.Deque(directory=f'{directory}/queue'))
+        elapsed, _ = _timed(restored.__len__)
+        click.echo(f'   restore on first use: {elapsed:9.2f} ms')
+        if list(restored) != items:
+            raise click.ClickException('Restored queue differs from the queued tracks')
+
+        elapsed, _ = _timed(lambda: [restored.popleft() for _ in range(tracks)])
+        click.echo(f'        pop every track: {elapsed:9.2f} ms (caller)')
+        restored.close()
+        if len(diskcache.Deque(directory=f'{directory}/queue')):
+            raise click.ClickException('Popped tracks are still stored')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Replays synthetic guild messages through `_prefix_callable` and reports message throughput.
+
+Run with `python -m benchmarks.prefix` from the repository root.
+"""
+
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+
+import click
+import diskcache
+
+from bot import PrefixCache, _prefix_callable, _guild_prefix_key
+
+BOT_ID = 123456789012345678
+
+
+def _legacy_prefix_callable(bot, msg):
+    """The previous implementation, reading the prefixes from disk for every message."""
+    bot_id = bot.user.id
+    allowed_prefix = [f'<@!{bot_id}> ', f'<@{bot_id}> ']
+    try:
+        prefixes = bot.global_cache[_guild_prefix_key(msg.guild.id)]
+    except KeyError:
+        prefixes = set()
+    allowed_prefix.extend(prefixes)
+    return allowed_prefix
+
+
+def _messages(count, guilds):
+    contents = ['!play', 'hello there', f'<@{BOT_ID}> join General', '$$queue track:abc', 'pingu noot']
+    return [SimpleNamespace(guild=SimpleNamespace(id=random.randrange(guilds)), content=random.choice(contents))
+            for _ in range(count)]
+
+
+def _throughput(prefix_callable, bot, messages):
+    start = time.perf_counter()
+    for msg in messages:
+        prefixes = prefix_callable(bot, msg)
+        # What discord.py does with the result
+        msg.content.startswith(tuple(prefixes))
+    return len(messages) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--messages', default=20000, help='Number of messages to replay.')
+@click.option('--guilds', default=100, help='Number of distinct guilds.')
+@click.option('--prefixes', default=5, help='Number of prefixes per guild.')
+def main(messages, guilds, prefixes):
+    with tempfile.TemporaryDirectory() as directory:
+        store = diskcache.Index(directory)
+        for guild_id in range(guilds):
+            store[_guild_prefix_key(guild_id)] = {'!', '$$', 'pingu '} | {f'p{i}.' for i in range(prefixes - 3)}
+        bot = SimpleNamespace(user=SimpleNamespace(id=BOT_ID), global_cache=store, prefix_cache=PrefixCache(store))
+        samples = _messages(messages, guilds)
+
+        click.echo(f'    disk: {_throughput(_legacy_prefix_callable, bot, samples):10.0f} messages/s')
+        click.echo(f'  cached: {_throughput(_prefix_callable, bot, samples):10.0f} messages/s')
+
+
+if __name__ == '__main__':
+    main()
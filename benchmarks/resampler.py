@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Measures how many concurrent guild streams one core can resample in real time.
+
+Run with `python -m benchmarks.resampler` from the repository root.
+"""
+
+import os
+# Pin numeric libraries to a single thread, we're measuring capacity of ONE core.
+for _var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(_var, '1')
+
+import time
+
+import click
+import numpy as np
+import nnresample
+
+from cogs.players.resampler import StreamingResampler, DT
+
+FRAME_LENGTH = 20  # milliseconds
+CHANNELS = 2
+INPUT_RATE = 44100
+OUTPUT_RATE = 48000
+SAMPLES_20MS_44100 = INPUT_RATE * FRAME_LENGTH // 1000
+
+
+def _synthetic_frames(count):
+    """Builds `count` consecutive 20ms frames of a stereo sweep with some noise."""
+    t = np.arange(count * SAMPLES_20MS_44100) / INPUT_RATE
+    left = np.sin(2 * np.pi * (220 + 2000 * t) * t)
+    right = np.sin(2 * np.pi * 440 * t) + 0.1 * np.random.randn(len(t))
+    pcm = (np.stack((left, right), axis=1) * 10000).astype(DT)
+    return [pcm[i * SAMPLES_20MS_44100:(i + 1) * SAMPLES_20MS_44100].tobytes() for i in range(count)]
+
+
+def _legacy_resample(src):
+    """The per-frame path SpotSpawn used before the streaming resampler."""
+    a = np.frombuffer(src, dtype=DT)
+    i = a.reshape((2, -1), order='F')
+    resampled = nnresample.resample(i, OUTPUT_RATE, INPUT_RATE, axis=1, fc='nn', As=80, N=32001)
+    o = resampled.reshape((-1,), order='F')
+    return o.astype(DT).tobytes()
+
+
+def _time_per_frame(resample, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        resample(frame)
+    return (time.perf_counter() - start) / len(frames)
+
+
+def _report(name, per_frame):
+    budget = FRAME_LENGTH / 1000
+    click.echo(f'{name:>10}: {per_frame * 1000:7.3f} ms/frame, '
+               f'{budget / per_frame:7.1f} real-time streams per core')
+
+
+@click.command()
+@click.option('--frames', default=500, help='Number of 20ms frames to resample per path.')
+def main(frames):
+    samples = _synthetic_frames(frames)
+
+    # Warm up both paths, filter design isn't part of the per-frame cost.
+    resampler = StreamingResampler(INPUT_RATE, OUTPUT_RATE, CHANNELS)
+    resampler.process(samples[0])
+    _legacy_resample(samples[0])
+
+    _report('legacy', _time_per_frame(_legacy_resample, samples))
+    _report('streaming', _time_per_frame(resampler.process, samples))
+
+
+if __name__ == '__main__':
+    main()
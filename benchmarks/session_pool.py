@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Measures how long attaching a Spotify player takes, logging in for every attach or using the session pool.
+
+A fake librespot session stands in for Spotify, its login takes `--login_ms`.
+
+Run with `python -m benchmarks.session_pool` from the repository root.
+"""
+
+import asyncio
+import time
+
+import click
+
+from benchmarks import fake_librespot
+
+
+async def _attach(spawn_source):
+    start = time.perf_counter()
+    spawn = await spawn_source()
+    elapsed = (time.perf_counter() - start) * 1000
+    spawn.cleanup()
+    return elapsed
+
+
+def _report(name, latencies):
+    latencies = sorted(latencies)
+    click.echo(f'{name:>24}: median {latencies[len(latencies) // 2]:8.2f} ms  max {latencies[-1]:8.2f} ms')
+
+
+@click.command()
+@click.option('--attaches', default=10, help='Number of attach/detach cycles.')
+@click.option('--login_ms', default=500, help='Duration of a login round-trip.')
+@click.option('--warm', default=1, help='Sessions the pool keeps logged in.')
+def main(attaches, login_ms, warm):
+    fake_librespot.install(login_seconds=login_ms / 1000)
+    # Imports librespot, so only after the fake is installed
+    from cogs.players.spotify.spawn import SpotSpawn, PUMP_POLL
+    from cogs.players.spotify.session_pool import SessionPool
+
+    loop = asyncio.new_event_loop()
+    credentials = ('benchmark', 'benchmark')
+
+    async def login_on_attach():
+        # What attaching did before; blocks the event loop for the login
+        return SpotSpawn(credentials)
+
+    _report('login on every attach', [loop.run_until_complete(_attach(login_on_attach)) for _ in range(attaches)])
+
+    pool = SessionPool(credentials, warm=warm)
+    pool.start()
+    # The pool logs in while the bot starts
+    time.sleep(login_ms / 1000 + 0.1)
+
+    async def pooled():
+        return SpotSpawn(None, session=await pool.acquire(loop))
+
+    latencies = []
+    for _ in range(attaches):
+        latencies.append(loop.run_until_complete(_attach(pooled)))
+        # Detached players hand their session back once their pump stopped
+        time.sleep(PUMP_POLL * 2)
+    _report('pooled sessions', latencies)
+    click.echo(f'Pool: {pool.stats()}')
+    pool.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
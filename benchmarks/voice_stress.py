@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Fires hundreds of concurrent join, attach and leave commands at the Voice cog across simulated guilds.
+
+Voice connections are stubs which take `--connect_ms` to connect. Sources are built by a blocking builder,
+like a player logging in, and by a coroutine builder. Reports the operations per second, their latency,
+event loop lag, and checks that no guild connected twice at once and that every built source got cleaned up.
+
+Run with `python -m benchmarks.voice_stress` from the repository root.
+"""
+
+import asyncio
+import random
+import time
+import types
+
+import click
+import numpy as np
+
+from benchmarks.fake_discord import Guild
+from cogs.players.stub import StubSource
+from cogs.voice import Voice, SOURCE_RELEASE_DELAY
+
+LAG_INTERVAL = 0.01  # seconds between event loop lag probes
+
+
+class _CountingSource(StubSource):
+    built = 0
+    cleaned = 0
+
+    def __init__(self):
+        _CountingSource.built += 1
+        self._cleaned = False
+
+    def cleanup(self):
+        # AudioSource.__del__ cleans up again, count every source once
+        if not self._cleaned:
+            self._cleaned = True
+            _CountingSource.cleaned += 1
+
+
+class _Context:
+    def __init__(self, guild):
+        self.guild = guild
+        self.message = types.SimpleNamespace(author=guild.member, guild=guild)
+        self.responses = []
+
+    async def send(self, content=None, **kwargs):
+        self.responses.append(content)
+
+
+class _Unserialized:
+    """Runs voice operations right away, like the cog did before it serialized them."""
+
+    async def run(self, guild_id, operation, *args):
+        return await operation(*args)
+
+
+def _players(build_seconds: float):
+    def blocking(guild):
+        time.sleep(build_seconds)
+        return _CountingSource()
+
+    async def coroutine(guild):
+        await asyncio.sleep(build_seconds)
+        return _CountingSource()
+
+    return {'blocking': blocking, 'coroutine': coroutine}
+
+
+def _operations(voice, guilds, count):
+    commands = (
+        lambda ctx: Voice.join.callback(voice, ctx, channel=random.choice(('General', 'Music'))),
+        lambda ctx: Voice.summon.callback(voice, ctx),
+        lambda ctx: Voice.attach.callback(voice, ctx, 'blocking'),
+        lambda ctx: Voice.attach.callback(voice, ctx, 'coroutine'),
+        lambda ctx: Voice.leave.callback(voice, ctx),
+    )
+    return [(random.choice(commands), _Context(random.choice(guilds))) for _ in range(count)]
+
+
+async def _timed(command, ctx, latencies, failures):
+    start = time.perf_counter()
+    try:
+        await command(ctx)
+    except Exception as e:
+        # Leaving without a voice state, which the bot reports through on_command_error
+        failures[type(e).__name__] = failures.get(type(e).__name__, 0) + 1
+    latencies.append(time.perf_counter() - start)
+
+
+async def _probe_lag(lags: list, stopped: asyncio.Event):
+    while not stopped.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+def _report_ms(name, values):
+    values = np.array(values) * 1000
+    click.echo(f'{name:>18}: p50 {np.percentile(values, 50):8.2f}  p99 {np.percentile(values, 99):8.2f}  '
+               f'max {values.max():8.2f} ms')
+
+
+async def _run(voice, guilds, operations):
+    latencies, failures, lags = [], {}, []
+    stopped = asyncio.Event()
+    probe = asyncio.ensure_future(_probe_lag(lags, stopped))
+    start = time.perf_counter()
+    await asyncio.gather(*(_timed(command, ctx, latencies, failures) for command, ctx in operations))
+    elapsed = time.perf_counter() - start
+
+    # Builds of timed out attaches keep running, their sources are cleaned up once they finish
+    builds = asyncio.all_tasks() - {asyncio.current_task(), probe}
+    await asyncio.gather(*builds, return_exceptions=True)
+    # Leave everywhere, sources swapped out are cleaned up after a delay
+    for guild in guilds:
+        if guild.voice_client is not None:
+            await Voice.leave.callback(voice, _Context(guild))
+    await asyncio.sleep(SOURCE_RELEASE_DELAY * 2)
+    stopped.set()
+    await probe
+
+    responses = [response for _, ctx in operations for response in ctx.responses]
+    click.echo(f'{"operations":>18}: {len(operations) / elapsed:8.0f} per second, {len(operations)} in {elapsed:.2f} s')
+    _report_ms('latency', latencies)
+    _report_ms('event loop lag', lags)
+    click.echo(f'{"timeouts":>18}: {sum("too long" in r for r in responses if r)}')
+    click.echo(f'{"errors":>18}: {failures or "none"}')
+    click.echo(f'{"racing connects":>18}: {sum(guild.racing_connects for guild in guilds)}')
+    click.echo(f'{"leaked sources":>18}: {_CountingSource.built - _CountingSource.cleaned} '
+               f'of {_CountingSource.built} built')
+
+
+@click.command()
+@click.option('--operations', default=500, help='Number of concurrent voice commands.')
+@click.option('--guilds', default=50, help='Number of distinct guilds.')
+@click.option('--connect_ms', default=20, help='Duration of connecting to a voice channel.')
+@click.option('--build_ms', default=30, help='Duration of building a source.')
+@click.option('--timeout', default=15.0, help='Seconds a voice operation may take.')
+@click.option('--serialize/--no-serialize', default=True, help='Serialize the operations of a guild.')
+@click.option('--seed', default=0, help='Seed of the random operations.')
+def main(operations, guilds, connect_ms, build_ms, timeout, serialize, seed):
+    random.seed(seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    config = types.SimpleNamespace(VOICE_IDLE_TIMEOUT=5.0, VOICE_OPERATION_TIMEOUT=timeout,
+                                   AUDIO_DSP=False, PRE_ENCODE_OPUS=False)
+    voice = Voice(types.SimpleNamespace(config=config, loop=loop), _players(build_ms / 1000))
+    if not serialize:
+        voice._scheduler = _Unserialized()
+    all_guilds = [Guild(guild_id, connect_seconds=connect_ms / 1000) for guild_id in range(1, guilds + 1)]
+    loop.run_until_complete(_run(voice, all_guilds, _operations(voice, all_guilds, operations)))
+    voice._Voice__unload()
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
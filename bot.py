@@ -3,18 +3,86 @@ import sys
 import traceback
 import datetime
 import asyncio
+import re
+import time
+import collections
+import gc
 from types import ModuleType
 
 import discord
 from discord.ext import commands
 
+from util import AsyncGlobalCache, metrics
+
 log = logging.getLogger(__name__)
 
+EDIT_TRACK_TTL = 30  # seconds a response follows edits of the message it answered
+EDIT_TRACK_SIZE = 1000  # maximum amount of tracked messages
+
 
 class MissingSubCommandError(commands.UserInputError):
     pass
 
 
+class ReloadableCog:
+    """Cogs whose state survives reloading their extension, see `PinguBot.reload_extension`.
+
+    The attributes named in `kept_on_reload` are handed to the cog of the reloaded extension, which takes them
+    over instead of building its own. `__unload` must leave them alone once they're handed over.
+    """
+    kept_on_reload = ()
+    _handed_over = False
+
+    def hand_over(self):
+        self._handed_over = True
+        return {name: getattr(self, name) for name in self.kept_on_reload}
+
+    def take_over(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+def _rebind(value, new_class):
+    """Moves the instance onto the new version of its class, letting it add attributes with `migrate`."""
+    migrate = getattr(new_class, 'migrate', None)
+    # Migrated first, audio threads call the methods of the new class as soon as it's set
+    if migrate is not None:
+        try:
+            migrate(value)
+        except Exception:
+            log.exception(f'Migrating a {new_class.__qualname__} failed, it keeps the previous version')
+            return
+    try:
+        value.__class__ = new_class
+    except TypeError:
+        log.warning(f'{new_class.__qualname__} changed its layout, instances keep the previous version')
+
+
+def _rebind_instances(value, classes: dict, package: str, seen: set):
+    """Moves the instances reachable from `value` onto the new versions of their classes. Walks containers and
+    the attributes of objects defined in `package`, the audio sources of voice clients as well."""
+    if id(value) in seen:
+        return
+    seen.add(id(value))
+    # Copied first, audio threads may change them meanwhile
+    if isinstance(value, dict):
+        for item in list(value.values()):
+            _rebind_instances(item, classes, package, seen)
+        return
+    if isinstance(value, (list, tuple, set, frozenset, collections.deque)):
+        for item in list(value):
+            _rebind_instances(item, classes, package, seen)
+        return
+
+    new_class = classes.get(type(value), None)
+    if new_class is not None:
+        _rebind(value, new_class)
+    if isinstance(value, discord.VoiceClient):
+        _rebind_instances(value.source, classes, package, seen)
+    elif type(value).__module__.split('.')[0] == package and hasattr(value, '__dict__'):
+        _rebind_instances(vars(value), classes, package, seen)
+
+
 def _prefix_callable(bot, msg):
     bot_id = bot.user.id
     allowed_prefix = [f'<@!{bot_id}> ', f'<@{bot_id}> ']
@@ -22,28 +90,156 @@ def _prefix_callable(bot, msg):
         allowed_prefix.append('!')
         allowed_prefix.append('?')
         allowed_prefix.append('')
-    else:
-        allowed_prefix.extend(bot.get_prefixes_for_guild(msg.guild.id))
+        return allowed_prefix
+
+    # Hand back only the prefix the message starts with, discord then doesn't test every prefix again
+    prefix = bot.prefix_cache.match(msg.guild.id, msg.content, allowed_prefix)
+    if prefix is not None:
+        return [prefix]
     # DBG
     # log.debug(allowed_prefix)
     return allowed_prefix
 
 
+def _timed_prefix_callable(bot, msg):
+    start = time.perf_counter()
+    try:
+        return _prefix_callable(bot, msg)
+    finally:
+        bot.prefix_latency.observe(time.perf_counter() - start)
+
+
 def _guild_prefix_key(guild_id: int):
     """Constructs the key for locating all allowed prefixes for the specified guild."""
     return 'prefix_' + str(guild_id)
 
 
+class PrefixCache:
+    """In-memory, write-through copy of the guild prefixes kept in the global cache.
+
+    All stored prefixes are loaded once, afterwards lookups never touch disk. Each guild gets one
+    compiled pattern, so a message is matched against all its prefixes in a single pass.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._prefixes = {}
+        self._patterns = {}
+        self._load()
+
+    def _load(self):
+        if self._store is None:
+            return
+        for key in self._store.keys():
+            if isinstance(key, str) and key.startswith('prefix_'):
+                self._prefixes[int(key[len('prefix_'):])] = frozenset(self._store[key])
+
+    def get(self, guild_id: int):
+        return set(self._prefixes.get(guild_id, ()))
+
+    def add(self, guild_id: int, prefix: str):
+        prefixes = self._prefixes.get(guild_id, frozenset()) | {prefix}
+        self._store[_guild_prefix_key(guild_id)] = set(prefixes)
+        self._prefixes[guild_id] = prefixes
+        self._patterns.pop(guild_id, None)
+
+    def match(self, guild_id: int, content: str, default_prefixes=()):
+        """Returns the longest prefix of the guild, or of `default_prefixes`, that `content` starts with.
+        The default prefixes must be the same for every call.
+        """
+        pattern = self._patterns.get(guild_id, None)
+        if pattern is None:
+            candidates = sorted(self._prefixes.get(guild_id, frozenset()).union(default_prefixes),
+                                key=len, reverse=True)
+            pattern = re.compile('|'.join(re.escape(p) for p in candidates))
+            self._patterns[guild_id] = pattern
+        found = pattern.match(content)
+        return found.group(0) if found else None
+
+
+class EditableContext(commands.Context):
+    """Context of a command. When the command runs again for its edited message, `previous_response` is the
+    response of the run before, see `PinguBot.respond_editable`."""
+    previous_response = None
+
+
+class EditTracker:
+    """Bounded index of recently answered messages, keyed by message id.
+
+    Entries share one TTL, so insertion order is also expiry order and expired entries are evicted
+    from the front while tracking new ones. No timers run per message.
+    """
+
+    def __init__(self, ttl: float = EDIT_TRACK_TTL, max_size: int = EDIT_TRACK_SIZE):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def track(self, message_id: int, response):
+        now = time.monotonic()
+        self._entries.pop(message_id, None)
+        self._entries[message_id] = (now + self._ttl, response)
+        while self._entries:
+            expiry, _ = next(iter(self._entries.values()))
+            if expiry > now and len(self._entries) <= self._max_size:
+                break
+            self._entries.popitem(last=False)
+
+    def get(self, message_id: int):
+        """Returns the response to the message, or None when the message isn't tracked (anymore)."""
+        entry = self._entries.get(message_id, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+
 class PinguBot(commands.Bot):
     """Wrapper class to support the Pingu Bot"""
 
     def __init__(self, cache_manager):
-        super().__init__(command_prefix=_prefix_callable,
+        # Instrumented code checks this once while it's set up, metrics cost nothing while disabled
+        metrics.registry.enabled = bool(getattr(self.config, 'METRICS', False))
+        super().__init__(command_prefix=_timed_prefix_callable if metrics.registry.enabled else _prefix_callable,
                          description=self.config.BOT_DESCRIPTION,
                          pm_help=True)
-        self.global_cache = None
+        # Available during extension setup, so extensions can persist data across reboots.
+        # Writes are batched off the event loop, so SQLite never stalls it.
+        self.global_cache = AsyncGlobalCache(cache_manager.global_cache, self.loop)
+        self.prefix_cache = PrefixCache(self.global_cache)
+        self._edit_tracker = EditTracker()
         self._cache_manager = cache_manager
+        self._metrics_server = None
+        # State handed over by cogs while their extension reloads, by cog name
+        self._handovers = {}
+        self.reloading = None
+        if metrics.registry.enabled:
+            self._setup_metrics(cache_manager)
         self._setup_extensions()
+        # Garbage of importing and setting up the extensions, nothing plays yet. See `freeze_startup`.
+        gc.collect()
+
+    def _setup_metrics(self, cache_manager):
+        registry = metrics.registry
+        self.prefix_latency = registry.histogram('pingu_prefix_lookup_seconds',
+                                                 'Time taken to find the prefix of a message').labels()
+        self._command_latency = registry.histogram('pingu_command_seconds', 'Time taken to dispatch and run commands',
+                                                   ('command',))
+        self._command_errors = registry.counter('pingu_command_errors_total', 'Errors raised by commands',
+                                                ('error',))
+        registry.add_collector(self.global_cache.collect_metrics)
+        registry.add_collector(cache_manager.collect_metrics)
+        port = getattr(self.config, 'METRICS_PORT', None)
+        if port:
+            self.loop.create_task(self._serve_metrics(port))
+
+    async def _serve_metrics(self, port: int):
+        try:
+            self._metrics_server = await metrics.serve(metrics.registry, port)
+        except OSError:
+            log.exception(f'Failed to serve metrics on port {port}')
 
     def _setup_extensions(self):
         log.info('Loading extensions..')
@@ -57,6 +253,92 @@ class PinguBot(commands.Bot):
                 log.exception(f'Failed to load extension `{extension}`')
                 traceback.print_exc()
 
+    def reload_extension(self, name: str, modules=()):
+        """Loads the extension, and the `modules` it imports, again from source without interrupting its cogs.
+
+        Cogs derived from `ReloadableCog` hand their state over, the setup of the reloaded extension takes it
+        over with `take_over`. Instances of the classes of reloaded modules which are reachable from that state,
+        like the sources of voice clients, are moved onto the new classes: they keep their buffers, queues and
+        threads, and run the new code from their next method call. Voice clients stay connected throughout.
+
+        Rebound instances keep the attributes the previous `__init__` set, audio threads may call the new methods
+        right away. A class whose new version relies on attributes the previous one didn't set defines
+        `migrate(self)`, which is called on every rebound instance to add them. Instances whose `migrate` fails,
+        or whose class changed its layout (`__slots__`), keep the previous version.
+
+        When the new version fails to load, the previous one is set up again from the same state and the error
+        is raised. Returns the seconds the reload took.
+        """
+        if name not in self.extensions:
+            raise discord.ClientException(f'Extension `{name}` isn\'t loaded')
+        start = time.perf_counter()
+        # Importing allocates plenty, a collection in the middle of the swap would hold up the audio threads.
+        # Collections resume afterwards, so the previous version is freed once nothing runs its code anymore.
+        # They're short, as what was set up at startup is frozen, see `freeze_startup`.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._swap_extension(name, modules)
+        finally:
+            if collecting:
+                gc.enable()
+            self.dispatch('extension_reloaded', name)
+
+        elapsed = time.perf_counter() - start
+        log.info(f'Reloaded `{name}` in {elapsed * 1000:.1f} ms')
+        return elapsed
+
+    def _swap_extension(self, name: str, modules):
+        previous = {module: sys.modules[module] for module in (name, *modules) if module in sys.modules}
+        handovers = self._hand_over(name)
+        self.reloading = name
+        try:
+            self.unload_extension(name)
+            for module in modules:
+                sys.modules.pop(module, None)
+            try:
+                self._handovers = dict(handovers)
+                self.load_extension(name)
+            except Exception:
+                log.exception(f'Reloading `{name}` failed, setting up the previous version again')
+                # Setup may have failed after adding cogs
+                self._hand_over(name)
+                self.extensions.pop(name, None)
+                sys.modules.update(previous)
+                self._handovers = dict(handovers)
+                previous[name].setup(self)
+                self.extensions[name] = previous[name]
+                raise
+        finally:
+            self._handovers = {}
+            self.reloading = None
+
+        classes = {}
+        for module_name, module in previous.items():
+            reloaded = sys.modules.get(module_name, None)
+            for class_name, cls in vars(module).items():
+                new_class = getattr(reloaded, class_name, None)
+                if isinstance(cls, type) and cls.__module__ == module_name and isinstance(new_class, type) \
+                        and new_class is not cls:
+                    classes[cls] = new_class
+        if classes:
+            _rebind_instances(handovers, classes, name.split('.')[0], set())
+
+    def _hand_over(self, name: str):
+        """Collects the state of the reloadable cogs of the extension."""
+        handovers = {}
+        for cog_name, cog in self.cogs.copy().items():
+            if commands.bot._is_submodule(name, cog.__module__):
+                if isinstance(cog, ReloadableCog):
+                    handovers[cog_name] = cog.hand_over()
+                # Gone by the time the extension loads again, also when setup failed half-way
+                self.remove_cog(cog_name)
+        return handovers
+
+    def take_over(self, cog_name: str):
+        """The state handed over by the cog while its extension reloads, None when the cog is set up anew."""
+        return self._handovers.pop(cog_name, None)
+
     def get_loaded_cogs_for_module(self, module):
         if not isinstance(module, ModuleType): raise ValueError('module')
         result_cogs = []
@@ -74,7 +356,19 @@ class PinguBot(commands.Bot):
     def cache_manager(self):
         return self._cache_manager
 
+    async def invoke(self, ctx):
+        if not metrics.registry.enabled:
+            return await super().invoke(ctx)
+        start = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            command = ctx.command.qualified_name if ctx.command is not None else 'unknown'
+            self._command_latency.labels(command).observe(time.perf_counter() - start)
+
     async def on_command_error(self, ctx, error):
+        if metrics.registry.enabled:
+            self._command_errors.labels(type(error).__name__).inc()
         if isinstance(error, commands.NoPrivateMessage):
             await ctx.author.send('This command cannot be used in private messages.')
         elif isinstance(error, commands.DisabledCommand):
@@ -97,6 +391,7 @@ class PinguBot(commands.Bot):
     async def on_ready(self):
         if not hasattr(self, 'uptime'):
             self.uptime = datetime.datetime.utcnow()
+            self.freeze_startup()
         # Update bot username and avatar
         if self.user.name != self.config.BOT_NICKNAME:
             await self.user.edit(username=self.config.BOT_NICKNAME)
@@ -104,56 +399,80 @@ class PinguBot(commands.Bot):
 
         log.info(f'Ready: {self.user} (ID: {self.user.id})')
 
+    def freeze_startup(self):
+        """Moves everything alive after startup out of reach of the garbage collector. It lives as long as the bot
+        anyway, and full collections, like after reloading an extension, then don't hold up the audio threads
+        walking it. Objects created later, the versions of reloaded extensions included, are collected as usual.
+
+        It doesn't collect, voice may already be playing once the bot is ready. Startup garbage was collected after
+        setting up the extensions."""
+        gc.freeze()
+
     async def on_resumed(self):
         log.info('resumed...')
 
     def run(self):
-        # Remove a reference to the cache manager, because COGS should operate on cache arena's.
-        self.global_cache = self._cache_manager.global_cache
-        del self._cache_manager
+        # The cache manager stays reachable: players load on their first attach, long after startup, and
+        # create their cache arena's then.
         # Connect and run the event-loop of our bot
         super().run(self.config.TOKEN, reconnect=True)
 
     async def close(self):
         log.info('Bot close requested')
-        super().close()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        # Make sure queued writes hit the disk before shutting down
+        await self.global_cache.close()
+        await super().close()
 
     def get_prefixes_for_guild(self, guild_id: int):
         """Retrieves all saved prefixes for the specified guild."""
-        prefix_key = _guild_prefix_key(guild_id)
-        try:
-            prefixes = self.global_cache[prefix_key]
-        except KeyError:
-            prefixes = set()
-            self.global_cache[prefix_key] = prefixes
-        return prefixes
+        return self.prefix_cache.get(guild_id)
 
     def add_prefix_for_guild(self, guild_id: int, prefix: str):
         """Adds the specified prefix to the saved list of prefixes for the specified guild."""
-        prefix_key = _guild_prefix_key(guild_id)
-        prefixes = set()
-        try:
-            prefixes = self.global_cache[prefix_key]
-        except KeyError:
-            pass
-        # Update set and store it for the desired key
-        prefixes.add(prefix)
-        self.global_cache[prefix_key] = prefixes
-
-    async def respond_editable(self, message: discord.Message, response: str, previous_message=None):
-        if previous_message is None:
-            previous_message = await message.channel.send(response)
-        else:
-            await previous_message.edit(response)
-
-        await self._check_edit(message, previous_message.content)
-
-    async def _check_edit(self, message: discord.Message, sent_response: discord.Message):
-        """NON ROBUST scheme for checking edited messages"""
-        original_content = message.content
-        for _ in range(30):
-            if message.content != original_content:
-                # TODO Introduce seperate method which also incorporates the previous message contents
-                await self.on_message(message.content)
-                return
-            await asyncio.sleep(1)
+        self.prefix_cache.add(guild_id, prefix)
+
+    async def get_context(self, message, *, cls=EditableContext):
+        return await super().get_context(message, cls=cls)
+
+    async def respond_editable(self, ctx: commands.Context, response: str, previous_response=None):
+        """Responds to the command, or replaces `previous_response`, the response of the run before its message
+        got edited. When the message gets edited within EDIT_TRACK_TTL seconds, the command runs again and gets
+        this response as `ctx.previous_response`."""
+        if previous_response is not None:
+            try:
+                await previous_response.edit(content=response)
+            except discord.NotFound:
+                previous_response = None
+        if previous_response is None:
+            previous_response = await ctx.send(response)
+
+        self._edit_tracker.track(ctx.message.id, previous_response)
+        return previous_response
+
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        if before.content != after.content:
+            await self._process_edited(after)
+
+    async def on_raw_message_edit(self, payload):
+        # Cached messages are handled by on_message_edit
+        if self._connection._get_message(payload.message_id) is not None:
+            return
+        data = payload.data
+        channel = self.get_channel(int(data.get('channel_id', 0)))
+        # Edits of embeds only don't carry the message
+        if channel is None or 'content' not in data or 'author' not in data:
+            return
+        if self._edit_tracker.get(payload.message_id) is None:
+            return
+        await self._process_edited(discord.Message(state=self._connection, channel=channel, data=data))
+
+    async def _process_edited(self, message: discord.Message):
+        """Runs the command of an edited message again, when it responded through `respond_editable`."""
+        previous_response = self._edit_tracker.get(message.id)
+        if previous_response is None or message.author.bot:
+            return
+        ctx = await self.get_context(message)
+        ctx.previous_response = previous_response
+        await self.invoke(ctx)
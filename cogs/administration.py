@@ -1,7 +1,10 @@
 import logging
 
+import discord
 from discord.ext import commands
 
+from util import metrics
+
 log = logging.getLogger(__name__)
 
 
@@ -25,6 +28,32 @@ class Administration:
         if not ctx.subcommand_passed:
             await ctx.send(f'You have to pass a subcommand. Type \'{ctx.prefix} help\' for more info.')
 
+    @commands.command(name='metrics')
+    @commands.is_owner()
+    async def _metrics(self, ctx):
+        """Shows the metrics of the audio and command pipelines."""
+        if not metrics.registry.enabled:
+            await ctx.send('Metrics are disabled, set `METRICS = True` in the config to collect them.')
+            return
+        paginator = commands.Paginator()
+        for line in (metrics.registry.summary() or 'Nothing measured yet').splitlines():
+            paginator.add_line(line)
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    @commands.command(name='reload')
+    @commands.is_owner()
+    async def _reload(self, ctx, extension: str, *modules: str):
+        """Reloads an extension, and modules it imports, from source. Voice clients keep playing."""
+        try:
+            elapsed = self.bot.reload_extension(extension, modules)
+        except discord.ClientException as e:
+            await ctx.send(str(e))
+        except Exception as e:
+            await ctx.send(f'Reloading `{extension}` failed, the previous version is running: `{e}`')
+        else:
+            await ctx.send(f'Reloaded `{extension}` in {elapsed * 1000:.1f} ms')
+
     @_add.command(name='prefix')
     @commands.cooldown(2, 5.0, commands.BucketType.guild)
     @commands.guild_only()
@@ -23,7 +23,8 @@ class TestCommands:
         async with ctx.channel.typing():
             await asyncio.sleep(2.5)
             result_string = ' '.join(args)
-            await ctx.send(result_string)
+            # Editing the message echoes it again, in place of this response
+            await self.bot.respond_editable(ctx, result_string, ctx.previous_response)
             log.debug(f'Echoed {result_string}')
 
     @commands.command()
@@ -1 +1,2 @@
-from .player_base import PlayerBase, ControlBase, UnknownPlayerError
+from .player_base import PlayerBase, WrappedSource, ControlBase, UnknownPlayerError
+from .opus_source import OpusEncodedSource
@@ -0,0 +1,139 @@
+import collections
+import logging
+import threading
+
+from .player_base import PlayerBase
+
+log = logging.getLogger(__name__)
+
+MAX_LAG = 50  # frames a subscriber may fall behind the leading one, 1 second
+
+
+class Broadcast:
+    """Fans out the frames of one source to many voice states.
+
+    The source is read once per frame, by whichever subscriber is first to need the frame. Frames
+    stay in a shared history until every subscriber read past them, each subscriber keeps its own
+    cursor in that history. Subscribers falling more than `max_lag` frames behind skip ahead.
+    """
+
+    def __init__(self, source: PlayerBase, name: str = None, max_lag: int = MAX_LAG, on_close=None):
+        self.source = source
+        self.name = name
+        self._max_lag = max_lag
+        self._on_close = on_close
+        self._frames = collections.deque()
+        self._base = 0  # sequence number of the oldest frame in history
+        self._cursors = {}
+        self._ids = 0
+        self._ended = False
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return str(self.source)
+
+    @property
+    def subscribers(self):
+        return len(self._cursors)
+
+    def subscribe(self):
+        """Returns a new source following this broadcast live."""
+        with self._lock:
+            self._ids += 1
+            self._cursors[self._ids] = self._base + len(self._frames)
+            return BroadcastSubscriber(self, self._ids)
+
+    def _unsubscribe(self, subscriber_id: int):
+        with self._lock:
+            if self._cursors.pop(subscriber_id, None) is None:
+                return
+            last = not self._cursors
+            if not last:
+                self._release()
+        if last:
+            self.source.cleanup()
+            if self._on_close is not None:
+                self._on_close(self)
+
+    def _release(self):
+        """Drops the frames every subscriber read past, and those a stalled subscriber would skip anyway.
+        Lock must be held."""
+        head = self._base + len(self._frames)
+        oldest = max(min(self._cursors.values()), head - self._max_lag)
+        for subscriber_id, cursor in self._cursors.items():
+            if cursor < oldest:
+                self._cursors[subscriber_id] = oldest
+        while self._frames and self._base < oldest:
+            self._frames.popleft()
+            self._base += 1
+
+    def _read(self, subscriber_id: int):
+        with self._lock:
+            head = self._base + len(self._frames)
+            cursor = max(self._cursors[subscriber_id], head - self._max_lag)
+            if cursor == head:
+                if self._ended:
+                    return b''
+                frame = self.source.read()
+                if not frame:
+                    self._ended = True
+                    return b''
+                self._frames.append(frame)
+
+            frame = self._frames[cursor - self._base]
+            self._cursors[subscriber_id] = cursor + 1
+            self._release()
+            return frame
+
+
+class BroadcastSubscriber(PlayerBase):
+    """Source reading the frames of a broadcast, control calls go to the broadcast source."""
+
+    def __init__(self, broadcast: Broadcast, subscriber_id: int):
+        self.broadcast = broadcast
+        self._id = subscriber_id
+
+    def __str__(self):
+        return str(self.broadcast)
+
+    def read(self):
+        return self.broadcast._read(self._id)
+
+    def is_opus(self):
+        return self.broadcast.source.is_opus()
+
+    def is_idle(self):
+        return self.broadcast.source.is_idle()
+
+    def current_track(self):
+        return self.broadcast.source.current_track()
+
+    def cleanup(self):
+        self.broadcast._unsubscribe(self._id)
+
+    def skip(self, amount: int):
+        self.broadcast.source.skip(amount)
+
+    def previous(self, amount: int):
+        self.broadcast.source.previous(amount)
+
+    def seek(self, position: int):
+        self.broadcast.source.seek(position)
+
+    def position(self):
+        return self.broadcast.source.position()
+
+    def stats(self):
+        return self.broadcast.source.stats()
+
+    def resume(self):
+        self.broadcast.source.resume()
+
+    def pause(self):
+        self.broadcast.source.pause()
+
+    def stop(self):
+        self.broadcast.source.stop()
+
+    def queue(self, arg: str):
+        self.broadcast.source.queue(arg)
@@ -0,0 +1,191 @@
+import logging
+import math
+
+import numpy as np
+
+from .player_base import PlayerBase, WrappedSource
+
+log = logging.getLogger(__name__)
+
+CHANNELS = 2
+SAMPLES_PER_FRAME = 960  # 20ms at 48KHz
+FRAME_SIZE = SAMPLES_PER_FRAME * CHANNELS * 2  # bytes
+DT = np.dtype(np.int16).newbyteorder('<')
+
+TARGET_LOUDNESS = -16.0  # LUFS
+MAX_NORMALIZATION_GAIN = 12.0  # dB, in both directions
+GAIN_SMOOTHING = 0.05  # fraction of the remaining gain change applied each frame
+
+# Loudness measurement after ITU-R BS.1770 / EBU R128: 400ms blocks overlapping by 75%,
+# built from 100ms sub-blocks. Block loudness goes into a histogram, so the gated integrated
+# loudness is updated incrementally without keeping every block around.
+FRAMES_PER_SUB_BLOCK = 5
+SUB_BLOCKS_PER_BLOCK = 4
+MIN_BLOCKS = 10  # blocks measured before normalization kicks in
+ABSOLUTE_GATE = -70.0  # LUFS
+RELATIVE_GATE = -10.0  # LU
+HISTOGRAM_MAX = 5.0  # LUFS
+HISTOGRAM_STEP = 0.1  # LU
+_FULL_SCALE_POWER = 32768.0 ** 2
+
+
+def _loudness(power: float):
+    return -0.691 + 10 * math.log10(power)
+
+
+class LoudnessMeter:
+    """Incrementally measures the gated, integrated loudness of a stream of frames.
+
+    Deviation from EBU R128: channels are not K-weighted, a per-sample IIR filter doesn't
+    vectorize over 20ms frames.
+    """
+
+    def __init__(self):
+        bins = int(round((HISTOGRAM_MAX - ABSOLUTE_GATE) / HISTOGRAM_STEP)) + 1
+        self._counts = np.zeros(bins, dtype=np.int64)
+        self._powers = np.zeros(bins, dtype=np.float64)
+        self._sub_blocks = np.zeros(SUB_BLOCKS_PER_BLOCK, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        self._counts.fill(0)
+        self._powers.fill(0)
+        self._sub_blocks.fill(0)
+        self._sub_block_power = 0.0
+        self._frames = 0
+        self._sub_block_index = 0
+        self.blocks = 0
+        self.integrated = None
+
+    def add_frame(self, power: float):
+        """Adds the summed mean square power of all channels of one frame, relative to full scale."""
+        self._sub_block_power += power
+        self._frames += 1
+        if self._frames % FRAMES_PER_SUB_BLOCK:
+            return
+
+        self._sub_blocks[self._sub_block_index % SUB_BLOCKS_PER_BLOCK] = self._sub_block_power / FRAMES_PER_SUB_BLOCK
+        self._sub_block_index += 1
+        self._sub_block_power = 0.0
+        if self._sub_block_index < SUB_BLOCKS_PER_BLOCK:
+            return
+
+        block_power = self._sub_blocks.mean()
+        if block_power <= 0 or _loudness(block_power) < ABSOLUTE_GATE:
+            return
+        index = min(int((_loudness(block_power) - ABSOLUTE_GATE) / HISTOGRAM_STEP), len(self._counts) - 1)
+        self._counts[index] += 1
+        self._powers[index] += block_power
+        self.blocks += 1
+        self._update_integrated()
+
+    def _update_integrated(self):
+        ungated = _loudness(self._powers.sum() / self._counts.sum())
+        gate = max(0, int((ungated + RELATIVE_GATE - ABSOLUTE_GATE) / HISTOGRAM_STEP))
+        count = self._counts[gate:].sum()
+        if count:
+            self.integrated = _loudness(self._powers[gate:].sum() / count)
+
+
+class DspSource(WrappedSource):
+    """Processing stage on top of a PCM source: overlays, per track loudness normalization and volume.
+
+    Every frame is processed in place on buffers allocated at construction; the only allocation per
+    frame is the bytes object handed to discord.
+    """
+
+    def __init__(self, source: PlayerBase, volume: float = 1.0, normalize: bool = True,
+                 target_loudness: float = TARGET_LOUDNESS):
+        if source.is_opus():
+            raise ValueError('DSP needs a PCM source')
+        super().__init__(source)
+        self.volume = volume
+        self.normalize = normalize
+        self.target_loudness = target_loudness
+        self.meter = LoudnessMeter()
+        self._overlays = []
+        self._track = None
+        self._gain = 1.0
+
+        self._mix = np.zeros((SAMPLES_PER_FRAME, CHANNELS), dtype=np.float32)
+        self._square = np.zeros((SAMPLES_PER_FRAME, CHANNELS), dtype=np.float32)
+        self._ramp = np.linspace(0, 1, SAMPLES_PER_FRAME, endpoint=False, dtype=np.float32).reshape((-1, 1))
+        self._gains = np.zeros((SAMPLES_PER_FRAME, 1), dtype=np.float32)
+        self._out = np.zeros((SAMPLES_PER_FRAME, CHANNELS), dtype=DT)
+
+    def add_overlay(self, source: PlayerBase, volume: float = 1.0):
+        """Mixes the PCM frames of `source` on top of the main source until it ends."""
+        if source.is_opus():
+            raise ValueError('Overlays must be PCM sources')
+        self._overlays.append((source, volume))
+
+    def _add_frame(self, frame, volume: float, replace: bool = False):
+        """Adds (or copies) a PCM frame into the mix buffer, short frames are padded with silence."""
+        samples = np.frombuffer(frame, dtype=DT, count=min(len(frame), FRAME_SIZE) // 2).reshape((-1, CHANNELS))
+        target = self._mix[:len(samples)]
+        if replace:
+            np.copyto(target, samples)
+            self._mix[len(samples):] = 0
+            if volume != 1.0:
+                np.multiply(target, volume, out=target)
+        elif volume == 1.0:
+            np.add(target, samples, out=target)
+        else:
+            # Reuse the square buffer as scratch space
+            scratch = self._square[:len(samples)]
+            np.multiply(samples, volume, out=scratch)
+            np.add(target, scratch, out=target)
+
+    def _normalization_gain(self):
+        track = self.source.current_track()
+        if track is not None and track is not self._track:
+            self._track = track
+            self.meter.reset()
+
+        np.multiply(self._mix, self._mix, out=self._square)
+        self.meter.add_frame(float(self._square.sum()) / SAMPLES_PER_FRAME / _FULL_SCALE_POWER)
+        if not self.normalize or self.meter.blocks < MIN_BLOCKS or self.meter.integrated is None:
+            return 1.0
+        gain_db = max(-MAX_NORMALIZATION_GAIN,
+                      min(MAX_NORMALIZATION_GAIN, self.target_loudness - self.meter.integrated))
+        return 10 ** (gain_db / 20)
+
+    def read(self):
+        frame = self.source.read()
+        if not frame:
+            return frame
+        self._add_frame(frame, 1.0, replace=True)
+
+        # Normalize the main source only, overlays have their own volume
+        target = self._gain + (self._normalization_gain() * self.volume - self._gain) * GAIN_SMOOTHING
+        # Ramp from the previous gain to the new one over the frame, avoids zipper noise
+        np.multiply(self._ramp, target - self._gain, out=self._gains)
+        np.add(self._gains, self._gain, out=self._gains)
+        np.multiply(self._mix, self._gains, out=self._mix)
+        self._gain = target
+
+        for overlay in self._overlays[:]:
+            source, volume = overlay
+            overlay_frame = source.read()
+            if not overlay_frame:
+                self._overlays.remove(overlay)
+                source.cleanup()
+                continue
+            self._add_frame(overlay_frame, volume)
+
+        np.rint(self._mix, out=self._mix)
+        np.clip(self._mix, -32768, 32767, out=self._mix)
+        np.copyto(self._out, self._mix, casting='unsafe')
+        return self._out.tobytes()
+
+    def is_opus(self):
+        return False
+
+    def is_idle(self):
+        return not self._overlays and super().is_idle()
+
+    def cleanup(self):
+        for source, _ in self._overlays:
+            source.cleanup()
+        self._overlays.clear()
+        super().cleanup()
@@ -0,0 +1,53 @@
+import time
+
+from util import metrics
+from .player_base import PlayerBase, WrappedSource
+
+FRAME_DURATION = 0.02  # seconds of audio per read
+# Stats of sources which are levels, the rest counts events
+GAUGE_STATS = frozenset(('buffered_bytes', 'pipe_backlog_bytes'))
+
+
+class MeteredSource(WrappedSource):
+    """Measures reads of the wrapped source for the metrics of a guild, and exports the stats of the
+    sources in the chain. The voice cog only adds it while metrics are enabled."""
+
+    def __init__(self, source: PlayerBase, guild_id: int, registry: metrics.MetricsRegistry = None):
+        super().__init__(source)
+        self.guild_id = guild_id
+        self._registry = registry if registry is not None else metrics.registry
+        self._latency = self._registry.histogram(
+            'pingu_audio_read_seconds', 'Time taken by reads of the attached source', ('guild',)).labels(guild_id)
+        self._overruns = self._registry.counter(
+            'pingu_audio_overruns_total', 'Reads of the attached source taking longer than a frame lasts',
+            ('guild',)).labels(guild_id)
+        self._registry.add_collector(self._collect)
+
+    def read(self):
+        start = time.perf_counter()
+        frame = self.source.read()
+        elapsed = time.perf_counter() - start
+        self._latency.observe(elapsed)
+        if elapsed > FRAME_DURATION:
+            self._overruns.inc()
+        return frame
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def _collect(self):
+        labels = {'guild': self.guild_id}
+        for name, value in self.source.stats().items():
+            if name in GAUGE_STATS:
+                yield f'pingu_audio_{name}', 'gauge', f'Current {name} of the attached source', labels, value
+            else:
+                yield f'pingu_audio_{name}_total', 'counter', f'Total {name} of the attached source', labels, value
+
+    def release(self):
+        """Stops exporting stats and hands back the wrapped source, without cleaning it up."""
+        self._registry.remove_collector(self._collect)
+        return self.source
+
+    def cleanup(self):
+        self._registry.remove_collector(self._collect)
+        super().cleanup()
@@ -0,0 +1,105 @@
+import logging
+import queue
+import threading
+
+import discord
+
+from .player_base import PlayerBase, WrappedSource
+
+log = logging.getLogger(__name__)
+
+# Opus packet for one frame of silence
+OPUS_SILENCE = b'\xf8\xff\xfe'
+ENCODE_AHEAD = 5  # Default amount of frames encoded ahead of playback, 100ms
+_END_OF_STREAM = b''
+
+
+class OpusEncodedSource(WrappedSource):
+    """Wraps a PCM source and encodes its frames into Opus packets on a worker thread.
+
+    discord.py sends the packets as-is, because this source reports `is_opus()`. The wrapped source
+    is read by the worker, at most `encode_ahead` frames ahead of playback. The encoder lives as long
+    as the worker, so its state carries across frames. Opus releases the GIL while encoding, so
+    sources of different guilds encode in parallel.
+    """
+
+    def __init__(self, source: PlayerBase, encode_ahead: int = ENCODE_AHEAD):
+        if source.is_opus():
+            raise ValueError('source already produces opus packets')
+        super().__init__(source)
+        self._packets = queue.Queue(maxsize=encode_ahead)
+        self._stopped = threading.Event()
+        self._ended = False
+        self.underruns = 0
+        self._worker = threading.Thread(target=self._encode_loop, name='Opus encoder', daemon=True)
+        self._worker.start()
+
+    def _encode_loop(self):
+        try:
+            encoder = discord.opus.Encoder()
+            frame_size = encoder.SAMPLES_PER_FRAME
+            while not self._stopped.is_set():
+                if self.source.is_idle():
+                    # Nothing to encode, send the precomputed silence packet
+                    packet = OPUS_SILENCE
+                else:
+                    pcm = self.source.read()
+                    packet = encoder.encode(pcm, frame_size) if pcm else _END_OF_STREAM
+                # Wait for room, but keep an eye out for cleanup
+                while not self._stopped.is_set():
+                    try:
+                        self._packets.put(packet, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if not packet:
+                    break
+        except Exception:
+            log.exception('Opus encoder worker crashed')
+        finally:
+            self._ended = True
+
+    def _flush(self):
+        """Drops packets encoded from audio that's no longer wanted."""
+        try:
+            while True:
+                self._packets.get_nowait()
+        except queue.Empty:
+            pass
+
+    def read(self):
+        try:
+            return self._packets.get_nowait()
+        except queue.Empty:
+            if self._ended:
+                return _END_OF_STREAM
+            # The worker fell behind, keep the stream going
+            self.underruns += 1
+            return OPUS_SILENCE
+
+    def is_opus(self):
+        return True
+
+    def stats(self):
+        return dict(super().stats(), encoder_underruns=self.underruns)
+
+    def cleanup(self):
+        self._stopped.set()
+        self._flush()
+        super().cleanup()
+
+    def skip(self, amount: int):
+        super().skip(amount)
+        self._flush()
+
+    def previous(self, amount: int):
+        super().previous(amount)
+        self._flush()
+
+    def seek(self, position: int):
+        super().seek(position)
+        self._flush()
+
+    def stop(self):
+        super().stop()
+        self._flush()
@@ -0,0 +1,130 @@
+import collections
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+FLUSH_DELAY = 0.1  # seconds changes are collected before they're written as one transaction
+
+
+class PlayQueue:
+    """Queue of track ids which survives restarts and crashes, backed by a diskcache Deque.
+
+    Changes apply to an in-memory copy right away and are written to disk in batched transactions by
+    a background thread, so queueing a whole playlist costs about as much as extending a list. The
+    stored queue is read on first use, restoring queues costs nothing until they're played.
+    At most the changes of the last `flush_delay` seconds are lost on a crash.
+
+    The queue pickles by its store, so it can be handed to a source running in an audio worker.
+    Only one process at a time may change a queue.
+    """
+
+    def __init__(self, store, flush_delay: float = FLUSH_DELAY):
+        self._store = store
+        self._flush_delay = flush_delay
+        self._init_local()
+
+    def _init_local(self):
+        self._items = None
+        self._journal = []
+        self._timer = None
+        self._lock = threading.Lock()
+        # Keeps batches in order
+        self._flush_lock = threading.Lock()
+
+    def __getstate__(self):
+        return self._store, self._flush_delay
+
+    def __setstate__(self, state):
+        self._store, self._flush_delay = state
+        self._init_local()
+
+    def _loaded(self):
+        # Lock must be held
+        if self._items is None:
+            self._items = collections.deque(self._store)
+        return self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._loaded())
+
+    def __iter__(self):
+        """Iterates over a snapshot of the queue."""
+        with self._lock:
+            return iter(list(self._loaded()))
+
+    def append(self, item):
+        self.extend((item,))
+
+    def extend(self, items):
+        items = list(items)
+        if not items:
+            return
+        with self._lock:
+            self._loaded().extend(items)
+            self._log('extend', items)
+
+    def appendleft(self, item):
+        with self._lock:
+            self._loaded().appendleft(item)
+            self._log('appendleft', item)
+
+    def popleft(self):
+        """Removes and returns the first item, raises IndexError when the queue is empty."""
+        with self._lock:
+            item = self._loaded().popleft()
+            self._log('popleft', 1)
+        return item
+
+    def clear(self):
+        with self._lock:
+            self._loaded().clear()
+            # Earlier changes don't matter anymore
+            self._journal.clear()
+            self._log('clear', None)
+
+    def _log(self, action: str, arg):
+        # Lock must be held
+        last = self._journal[-1] if self._journal else None
+        if last is not None and last[0] == action == 'extend':
+            last[1].extend(arg)
+        elif last is not None and last[0] == action == 'popleft':
+            last[1] += arg
+        else:
+            self._journal.append([action, arg])
+
+        if self._timer is None:
+            self._timer = threading.Timer(self._flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes all pending changes to disk in one transaction."""
+        with self._flush_lock:
+            with self._lock:
+                journal, self._journal = self._journal, []
+                self._timer = None
+            if not journal:
+                return
+
+            store = self._store
+            with store.transact():
+                for action, arg in journal:
+                    if action == 'extend':
+                        store.extend(arg)
+                    elif action == 'appendleft':
+                        store.appendleft(arg)
+                    elif action == 'popleft':
+                        for _ in range(arg):
+                            store.popleft()
+                    elif action == 'clear':
+                        store.clear()
+
+    def close(self):
+        """Writes the pending changes, the queue can still be used afterwards."""
+        with self._lock:
+            timer = self._timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
@@ -8,10 +8,20 @@ class UnknownPlayerError(discord.ClientException):
 
 
 class ControlBase(ABC):
+    # Set by the voice cog when sources must run inside the audio worker pool
+    worker_pool = None
+
     def spawn_source(self, *args, **kwargs):
-        """Spawn a new audiosource object, which can be played."""
+        """Spawn a new audiosource object, which can be played. May be a coroutine, when spawning waits
+        for something, eg a login."""
         raise NotImplementedError
 
+    def build_source(self, source_type, *args, **kwargs):
+        """Constructs the source in this process, or inside the audio worker pool when one is set."""
+        if self.worker_pool is not None:
+            return self.worker_pool.spawn(source_type, *args, **kwargs)
+        return source_type(*args, **kwargs)
+
 
 class PlayerBase(ABC, discord.AudioSource):
     def read(self):
@@ -20,6 +30,14 @@ class PlayerBase(ABC, discord.AudioSource):
         """
         raise NotImplementedError
 
+    def is_idle(self):
+        """True while this source only produces silence, eg nothing is queued."""
+        return False
+
+    def current_track(self):
+        """Object identifying the item being played, changes when another item starts. None when unknown."""
+        return None
+
     def skip(self, amount: int):
         """Skip `amount` of songs."""
         raise NotImplementedError
@@ -28,6 +46,18 @@ class PlayerBase(ABC, discord.AudioSource):
         """Go back `amount` of songs."""
         raise NotImplementedError
 
+    def seek(self, position: int):
+        """Continue the current song at `position` milliseconds from its start."""
+        raise NotImplementedError
+
+    def position(self):
+        """Milliseconds played of the current song, None when unknown."""
+        return None
+
+    def stats(self):
+        """Counters of this source by name, eg underruns. Read from other threads, for metrics."""
+        return {}
+
     def resume(self):
         """Send music to channel."""
         raise NotImplementedError
@@ -43,3 +73,67 @@ class PlayerBase(ABC, discord.AudioSource):
     def queue(self, arg: str):
         """Add a certain player item to the queue"""
         raise NotImplementedError
+
+    def release_queue(self):
+        """Stops using a queue shared with the source replacing this one, once this returns it can be read.
+        What's loaded already keeps playing."""
+        pass
+
+
+class WrappedSource(PlayerBase):
+    """Base for sources adding a processing stage on top of another source.
+    Control calls are passed on to the wrapped source."""
+
+    def __init__(self, source: PlayerBase):
+        self.source = source
+
+    def __str__(self):
+        return str(self.source)
+
+    def find(self, source_type):
+        """Returns the first source of type `source_type` in this chain of wrapped sources, or None."""
+        source = self
+        while source is not None:
+            if isinstance(source, source_type):
+                return source
+            source = getattr(source, 'source', None)
+        return None
+
+    def is_idle(self):
+        return self.source.is_idle()
+
+    def current_track(self):
+        return self.source.current_track()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+    def skip(self, amount: int):
+        self.source.skip(amount)
+
+    def previous(self, amount: int):
+        self.source.previous(amount)
+
+    def seek(self, position: int):
+        self.source.seek(position)
+
+    def position(self):
+        return self.source.position()
+
+    def stats(self):
+        return self.source.stats()
+
+    def resume(self):
+        self.source.resume()
+
+    def pause(self):
+        self.source.pause()
+
+    def stop(self):
+        self.source.stop()
+
+    def queue(self, arg: str):
+        self.source.queue(arg)
+
+    def release_queue(self):
+        self.source.release_queue()
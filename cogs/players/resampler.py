@@ -0,0 +1,217 @@
+import logging
+import threading
+import time
+from math import gcd
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Defaults equal to the parameters the per-frame nnresample path used.
+STOPBAND_ATTENUATION = 80  # dB
+FILTER_TAPS = 32001
+
+DT = np.dtype(np.int16).newbyteorder('<')
+_I16_MIN = np.iinfo(np.int16).min
+_I16_MAX = np.iinfo(np.int16).max
+
+
+def design_filter(up: int, down: int, taps: int = FILTER_TAPS, attenuation: float = STOPBAND_ATTENUATION):
+    """Designs the low-pass FIR filter for resampling by `up`/`down`.
+    The coefficients are scaled by `up` to compensate for the zero-stuffing of the upsampler.
+    """
+    # Imported on first use, scipy is slow to import and only needed when designing filters
+    import nnresample
+    from nnresample.utility import disambiguate_params
+
+    n, beta, _ = disambiguate_params(N=taps, As=attenuation)
+    filt = nnresample.compute_filt(up, down, fc='nn', beta=beta, N=n)
+    return np.asarray(filt, dtype=np.float64) * up
+
+
+def _cycle_matrix(filt, up: int, down: int):
+    """Lays out the polyphase filter as one matrix per up/down cycle.
+
+    One cycle turns `down` input samples into `up` output samples. Row `n` produces output
+    sample `n` of a cycle from a window that starts `taps - 1` samples before the cycle's first
+    input; a matrix product with that window therefore resamples a whole cycle at once.
+    """
+    taps = -(-len(filt) // up)
+    padded = np.zeros(taps * up, dtype=np.float64)
+    padded[:len(filt)] = filt
+    # Row `p` holds h[p], h[p + up], h[p + 2*up], ... reversed to line up with ascending input samples
+    phases = padded.reshape((taps, up)).T[:, ::-1]
+
+    matrix = np.zeros((up, down + taps - 1), dtype=np.float32)
+    for n in range(up):
+        # Output `n` is built from the inputs up to `floor(n * down / up)` with sub-filter `(n * down) % up`
+        last_input = (n * down) // up
+        matrix[n, last_input:last_input + taps] = phases[(n * down) % up]
+    return matrix, taps
+
+
+def _store_key(key):
+    return 'resampler_filter_' + '_'.join(str(x) for x in key)
+
+
+class FilterCache:
+    """Process-wide cache of designed resampling filters, keyed by (input rate, output rate, taps, attenuation).
+
+    Filters are designed lazily on first request. When a persistent store (any mapping, eg the
+    GlobalCache) is attached, designed coefficients are saved into it so restarts skip filter design.
+    """
+
+    def __init__(self):
+        self._filters = {}
+        self._store = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+
+    def persist_to(self, store):
+        """Saves designed filters into, and loads missing filters from, `store`."""
+        self._store = store
+
+    def get(self, input_rate: int, output_rate: int, taps: int = FILTER_TAPS,
+            attenuation: float = STOPBAND_ATTENUATION):
+        """Returns the cycle matrix and taps per phase for the requested conversion."""
+        key = (input_rate, output_rate, taps, attenuation)
+        with self._lock:
+            cached = self._filters.get(key, None)
+            if cached is not None:
+                self.hits += 1
+                return cached
+
+            g = gcd(output_rate, input_rate)
+            up, down = output_rate // g, input_rate // g
+            filt = self._load(key)
+            if filt is None:
+                self.misses += 1
+                log.debug(f'Designing resampling filter {key}')
+                filt = design_filter(up, down, taps, attenuation)
+                self._save(key, filt)
+            else:
+                self.store_hits += 1
+
+            cached = _cycle_matrix(filt, up, down)
+            # Shared between resamplers, so make sure nobody modifies it
+            cached[0].setflags(write=False)
+            self._filters[key] = cached
+            return cached
+
+    def _load(self, key):
+        if self._store is None:
+            return None
+        try:
+            return self._store[_store_key(key)]
+        except KeyError:
+            return None
+        except Exception:
+            log.exception('Failed to load resampling filter from store')
+            return None
+
+    def _save(self, key, filt):
+        if self._store is None:
+            return
+        try:
+            self._store[_store_key(key)] = filt
+        except Exception:
+            log.exception('Failed to persist resampling filter')
+
+    def stats(self):
+        return {
+            'filters': len(self._filters),
+            'hits': self.hits,
+            'misses': self.misses,
+            'store_hits': self.store_hits,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._filters.clear()
+
+
+filter_cache = FilterCache()
+
+
+class StreamingResampler:
+    """Polyphase resampler for interleaved i16 PCM which carries its filter history
+    and phase between calls, so consecutive chunks resample as one continuous signal.
+
+    Filter coefficients come from `cache`, the process-wide filter cache by default, so
+    resamplers for the same conversion share them. A `timed` resampler adds up the time spent
+    in `process`, for metrics.
+    """
+
+    def __init__(self, input_rate: int, output_rate: int, channels: int = 2, taps: int = FILTER_TAPS,
+                 attenuation: float = STOPBAND_ATTENUATION, cache: FilterCache = None, timed: bool = False):
+        g = gcd(output_rate, input_rate)
+        self.up = output_rate // g
+        self.down = input_rate // g
+        self.channels = channels
+        cache = cache if cache is not None else filter_cache
+        self._matrix, self.taps = cache.get(input_rate, output_rate, taps, attenuation)
+        # Outputs produced, and inputs received, within the current up/down cycle
+        self._produced = 0
+        self._received = 0
+        # Input samples of the current cycle, preceded by the `taps - 1` samples before it
+        self._history = np.zeros((self.taps - 1, channels), dtype=np.float32)
+        self.timed = timed
+        self.busy_time = 0.0
+        self.processed = 0
+
+    def output_length(self, input_length: int):
+        """Number of output samples (per channel) the next `input_length` input samples produce."""
+        total = self._received + input_length
+        return -(-total * self.up // self.down) - self._produced
+
+    def reset(self):
+        """Drops the carried filter history, eg when playback jumps to another position."""
+        self._history = np.zeros((self.taps - 1, self.channels), dtype=np.float32)
+        self._produced = 0
+        self._received = 0
+
+    def process(self, src):
+        """Resamples a chunk of interleaved i16 PCM and returns the resampled chunk as bytes."""
+        if self.timed:
+            start = time.perf_counter()
+            result = self._process(src)
+            self.busy_time += time.perf_counter() - start
+            self.processed += 1
+            return result
+        return self._process(src)
+
+    def _process(self, src):
+        if isinstance(src, np.ndarray):
+            a = src
+        elif isinstance(src, (bytes, bytearray, memoryview)):
+            a = np.frombuffer(src, dtype=DT)
+        else:
+            raise NotImplementedError("Unknown source")
+
+        block = a.reshape((-1, self.channels))
+        total = self._received + len(block)
+        end = -(-total * self.up // self.down)
+        cycles = -(-end // self.up)
+        width = self.down + self.taps - 1
+
+        # Cycle `k` reads `ext[k * down:k * down + width]`; zero padding only feeds
+        # outputs of an unfinished cycle, which are not returned yet.
+        ext = np.zeros((max(len(self._history) + len(block), (cycles - 1) * self.down + width), self.channels),
+                       dtype=np.float32)
+        ext[:len(self._history)] = self._history
+        ext[len(self._history):len(self._history) + len(block)] = block
+        row, col = ext.strides
+        windows = np.lib.stride_tricks.as_strided(ext, shape=(cycles, width, self.channels),
+                                                  strides=(self.down * row, row, col), writeable=False)
+        out = np.matmul(self._matrix, windows).reshape((-1, self.channels))[self._produced:end]
+
+        finished = total // self.down
+        self._history = ext[finished * self.down:total + self.taps - 1].copy()
+        self._produced = end - finished * self.up
+        self._received = total - finished * self.down
+
+        np.rint(out, out=out)
+        np.clip(out, _I16_MIN, _I16_MAX, out=out)
+        return out.astype(DT).tobytes()
@@ -0,0 +1,111 @@
+import threading
+
+
+class RingBuffer:
+    """Fixed size, preallocated byte FIFO for handing audio from one producer thread to one consumer.
+
+    Writes block while the buffer is full, which pushes back on the producer. Reads never block,
+    they copy out what is available so the audio player thread is never held up.
+    `alignment` makes reads return whole multiples of that many bytes, eg one PCM sample for all channels.
+    """
+
+    def __init__(self, capacity: int, alignment: int = 1):
+        if capacity <= 0 or capacity % alignment:
+            raise ValueError('capacity must be a positive multiple of alignment')
+        self.capacity = capacity
+        self.alignment = alignment
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._size = 0
+        self._closed = False
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    @property
+    def available(self):
+        """Amount of bytes which can be read right now."""
+        return self._size
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def epoch(self):
+        """Amount of times the buffer got cleared."""
+        return self._epoch
+
+    def write(self, data, timeout: float = None, epoch: int = None):
+        """Copies all of `data` into the buffer, waiting for free space when necessary.
+        Returns the amount of bytes written, which is less than `len(data)` when the buffer
+        got closed or the timeout expired. With `epoch`, the rest of the data is dropped when
+        the buffer gets cleared after that epoch.
+        """
+        data = memoryview(data).cast('B')
+        written = 0
+        with self._cond:
+            while written < len(data):
+                # Clearing frees up space, so it wakes up this wait as well
+                if not self._cond.wait_for(lambda: self._closed or self._size < self.capacity, timeout):
+                    break
+                if self._closed or (epoch is not None and self._epoch != epoch):
+                    break
+                end = (self._start + self._size) % self.capacity
+                count = min(len(data) - written, self.capacity - self._size, self.capacity - end)
+                self._view[end:end + count] = data[written:written + count]
+                self._size += count
+                written += count
+        return written
+
+    def read_into(self, dst):
+        """Copies up to `len(dst)` bytes into `dst` without blocking, returns the amount copied."""
+        dst = memoryview(dst).cast('B')
+        with self._cond:
+            count = min(len(dst), self._size)
+            count -= count % self.alignment
+            first = min(count, self.capacity - self._start)
+            dst[:first] = self._view[self._start:self._start + first]
+            dst[first:count] = self._view[:count - first]
+            self._start = (self._start + count) % self.capacity
+            self._size -= count
+            if count:
+                self._cond.notify()
+        return count
+
+    def peek_into(self, dst, offset: int = 0):
+        """Copies up to `len(dst)` bytes, starting `offset` bytes past the read position, without consuming them.
+        Returns the amount copied."""
+        dst = memoryview(dst).cast('B')
+        with self._cond:
+            count = max(0, min(len(dst), self._size - offset))
+            count -= count % self.alignment
+            start = (self._start + offset) % self.capacity
+            first = min(count, self.capacity - start)
+            dst[:first] = self._view[start:start + first]
+            dst[first:count] = self._view[:count - first]
+        return count
+
+    def skip(self, count: int):
+        """Drops up to `count` bytes from the front of the buffer, returns the amount dropped."""
+        with self._cond:
+            count = min(count, self._size)
+            self._start = (self._start + count) % self.capacity
+            self._size -= count
+            if count:
+                self._cond.notify()
+        return count
+
+    def clear(self):
+        """Drops all buffered data."""
+        with self._cond:
+            self._start = 0
+            self._size = 0
+            self._epoch += 1
+            self._cond.notify()
+
+    def close(self):
+        """Wakes up and refuses all pending and future writes. Buffered data stays readable."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
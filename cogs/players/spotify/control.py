@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import logging
 import tempfile
 import os
@@ -6,25 +8,95 @@ import time
 import discord
 from discord.ext import commands
 
-from bot import MissingSubCommandError
+from bot import MissingSubCommandError, ReloadableCog
 from cogs.players.player_base import ControlBase
+from cogs.players.play_queue import PlayQueue
+from cogs.players.resampler import filter_cache
+from cogs.players.track_cache import TrackCache
 
-from .spawn import SpotSpawn
+from .spawn import SpotSpawn, BUFFER_FRAMES, CROSSFADE_MS
+from .session_pool import SessionPool, POOL_SIZE, WARM_SESSIONS, IDLE_TTL
+from .metadata import (Resolver, WebApiProvider, StubMetadataProvider, MetadataError, parse_query,
+                       RESOLVE_CONCURRENCY, METADATA_TTL)
 
 log = logging.getLogger(__name__)
 
+TRACK_ARENA = 'spotify_tracks'
+QUEUE_ARENA = 'spotify_queues'
+METADATA_ARENA = 'spotify_metadata'
+METADATA_CACHE_MB = 64  # Default budget of memoized lookups
 
-class SpotControl(ControlBase):
-    def __init__(self, cfg=None):
+
+class SpotControl(ControlBase, ReloadableCog):
+    # Reloading keeps attached guilds playing, with their queues, caches and logged in sessions
+    kept_on_reload = ('_spawns', '_queues', '_queue_arena', 'track_cache', 'resolver', 'sessions', 'worker_pool')
+
+    def __init__(self, cfg=None, track_cache: TrackCache = None, queue_arena=None, resolver: Resolver = None,
+                 sessions: SessionPool = None):
         self._spawns = {}
+        self._queues = {}
+        self._queue_arena = queue_arena
+        self.track_cache = track_cache
+        self.resolver = resolver
+        self.sessions = sessions
         if cfg:
             self.config = cfg
 
-    def spawn_source(self, *args, **kwargs):
+    def __unload(self):
+        if self._handed_over:
+            return
+        if self.track_cache is not None:
+            # Finish recordings which are still being written
+            self.track_cache.close()
+        for queue in self._queues.values():
+            queue.close()
+        if self.resolver is not None:
+            self.resolver.close()
+        if self.sessions is not None:
+            self.sessions.close()
+
+    def get_queue(self, guild_id: int):
+        """Returns the play queue of the guild, it holds the tracks queued before the last reboot as well.
+        None when queues aren't persisted."""
+        queue = self._queues.get(guild_id, None)
+        if queue is None and self._queue_arena is not None:
+            queue = PlayQueue(self._queue_arena.build_deque(guild_id))
+            self._queues[guild_id] = queue
+        return queue
+
+    async def spawn_source(self, *args, **kwargs):
         guild = kwargs.pop('guild', None)
         if not guild: raise ValueError('guild arg is missing')
-        cred = self.config['tmp_credentials']
-        spawn = SpotSpawn((cred['username'], cred['password']))
+        options = {
+            'buffer_frames': self.config.get('buffer_frames', BUFFER_FRAMES),
+            'crossfade_ms': self.config.get('crossfade_ms', CROSSFADE_MS),
+            'track_cache': self.track_cache,
+            'playlist': self.get_queue(guild.id),
+        }
+        if self.sessions is not None and self.worker_pool is not None:
+            # Sessions can't move into worker processes, sources log in inside their worker
+            log.info('Audio workers are used, closing the Spotify session pool')
+            self.sessions.close()
+            self.sessions = None
+
+        loop = asyncio.get_event_loop()
+        previous = self._spawns.get(guild.id, None)
+        if previous is not None:
+            # The new source reads the queue, which may be a copy inside a worker. The previous source
+            # returns its unfinished tracks to the queue and lets go of it first.
+            await loop.run_in_executor(None, previous.release_queue)
+        if self.sessions is not None:
+            session = await self.sessions.acquire(loop)
+            if options['crossfade_ms']:
+                # Fetches the start of the next track while the current one plays
+                options['lookahead_session'] = await self.sessions.acquire(loop)
+            # Setting up the resampler designs or reads its filter, keep it off the event loop as well
+            spawn = await loop.run_in_executor(None, functools.partial(SpotSpawn, None, session=session, **options))
+        else:
+            # Logs in, keep it off the event loop
+            cred = self.config['tmp_credentials']
+            spawn = await loop.run_in_executor(None, functools.partial(
+                self.build_source, SpotSpawn, (cred['username'], cred['password']), **options))
         self._spawns[guild.id] = spawn
         return spawn
 
@@ -43,12 +115,53 @@ class SpotControl(ControlBase):
     @_spotify.command(name='queue')
     @commands.guild_only()
     async def _queue(self, ctx, *, full: str):
+        """Queues tracks, albums, playlists or the best match of a search"""
         try:
             spawn = self.get_spawn(ctx.guild)
-            spawn.queue(full)
-            await ctx.send('Queued successfully')
         except KeyError:
             await ctx.send('Not attached to this voice client. Attach first!')
+            return
+
+        parts = full.split()
+        if all(parse_query(part)[0] != 'search' for part in parts):
+            queries = parts
+        else:
+            queries = [full]
+        if self.resolver is None and any(parse_query(query)[0] != 'track' for query in queries):
+            await ctx.send('Only tracks can be queued, no metadata provider is configured')
+            return
+
+        queued = []
+        try:
+            for query in queries:
+                if self.resolver is None:
+                    track_ids = [parse_query(query)[1]]
+                    spawn.queue(f'track:{track_ids[0]}')
+                    queued.extend(track_ids)
+                    continue
+                # Pages go into the queue as they resolve, so the first tracks play while the rest is looked up
+                async for track_ids in self.resolver.resolve(query, ctx.bot.loop):
+                    if track_ids:
+                        spawn.queue(' '.join(f'track:{track_id}' for track_id in track_ids))
+                        queued.extend(track_ids)
+        except MetadataError as e:
+            log.warning(f'Resolving `{full}` failed: {e}')
+            await ctx.send(f'Couldn\'t look up everything, {len(queued)} tracks queued')
+            return
+
+        if not queued:
+            await ctx.send('Nothing found to queue')
+        elif len(queued) > 1 or self.resolver is None:
+            await ctx.send(f'Queued {len(queued)} tracks')
+        else:
+            await ctx.send(f'Queued {await self._describe(ctx, queued[0])}')
+
+    async def _describe(self, ctx, track_id: str):
+        try:
+            track = await self.resolver.track(track_id, ctx.bot.loop)
+            return f'`{track["name"]}` by {", ".join(track["artists"])}'
+        except MetadataError:
+            return f'`{track_id}`'
 
     @_spotify.command(name='setup')
     @commands.guild_only()
@@ -59,10 +172,89 @@ class SpotControl(ControlBase):
 
 def setup(bot):
     cfg = bot.config.SPOT_PLAYER
-    spot_instance = SpotControl(cfg)
+    state = bot.take_over('SpotControl')
+    if state is not None:
+        spot_instance = SpotControl(cfg)
+        spot_instance.take_over(state)
+        bot.add_cog(spot_instance)
+        return
+
+    # Resampling filters are designed when the first stream needs them, persisting them skips that after reboots.
+    if cfg.get('persist_filters', True) and bot.global_cache is not None:
+        filter_cache.persist_to(bot.global_cache)
+    spot_instance = SpotControl(cfg, _build_track_cache(bot, cfg), _build_queue_arena(bot),
+                                _build_resolver(bot, cfg), _build_session_pool(cfg))
     bot.add_cog(spot_instance)
 
 
-def teardown():
+def _build_session_pool(cfg):
+    """Sessions log in ahead of time, so attaching doesn't wait for the login round-trip."""
+    sessions = cfg.get('sessions', {})
+    size = sessions.get('pool_size', POOL_SIZE)
+    if not size:
+        return None
+    cred = cfg['tmp_credentials']
+    pool = SessionPool((cred['username'], cred['password']), size=size,
+                       warm=sessions.get('warm', WARM_SESSIONS), idle_ttl=sessions.get('idle_ttl', IDLE_TTL))
+    pool.start()
+    return pool
+
+
+def _build_resolver(bot, cfg):
+    metadata = cfg.get('metadata', {})
+    kind = metadata.get('provider', None)
+    if kind == 'web':
+        provider = WebApiProvider(metadata['client_id'], metadata['client_secret'])
+    elif kind == 'stub':
+        provider = StubMetadataProvider()
+    else:
+        return None
+
+    # Lookups are memoized across reboots
+    cache = None
+    cache_manager = getattr(bot, 'cache_manager', None)
+    arena = None
+    if cache_manager is not None:
+        arena = cache_manager.create_arena(METADATA_ARENA, persistent=True,
+                                           max_bytes=metadata.get('cache_mb', METADATA_CACHE_MB) * 1024 ** 2)
+    if arena is not None:
+        cache = arena.build_fanout()
+    return Resolver(provider, cache, concurrency=metadata.get('concurrency', RESOLVE_CONCURRENCY),
+                    ttl=metadata.get('ttl', METADATA_TTL))
+
+
+def _build_queue_arena(bot):
+    """Queues are kept in a persistent arena, so they're restored when voice states reconnect after a reboot."""
+    cache_manager = getattr(bot, 'cache_manager', None)
+    if cache_manager is None:
+        log.warning('No cache manager, queues won\'t survive reboots and tracks aren\'t cached')
+        return None
+    arena = cache_manager.create_arena(QUEUE_ARENA, persistent=True)
+    if arena is None:
+        log.warning(f'Cache arena `{QUEUE_ARENA}` is in use, queues won\'t survive reboots')
+    return arena
+
+
+def _build_track_cache(bot, cfg):
+    """Tracks are recorded into a persistent arena, so replays survive reboots."""
+    max_mb = cfg.get('track_cache_mb', 0)
+    cache_manager = getattr(bot, 'cache_manager', None) if max_mb else None
+    if cache_manager is None:
+        return None
+    arena = cache_manager.create_arena(TRACK_ARENA, persistent=True, max_bytes=max_mb * 1024 ** 2)
+    if arena is None:
+        log.warning(f'Cache arena `{TRACK_ARENA}` is in use, playing without track cache')
+        return None
+    return TrackCache(arena)
+
+
+def teardown(bot):
     """Optional: Can be used to clean up after usage."""
-    pass
+    if getattr(bot, 'reloading', None):
+        # The reloaded extension takes the arenas over
+        return
+    cache_manager = getattr(bot, 'cache_manager', None)
+    if cache_manager is not None:
+        cache_manager.remove_arena(TRACK_ARENA)
+        cache_manager.remove_arena(QUEUE_ARENA)
+        cache_manager.remove_arena(METADATA_ARENA)
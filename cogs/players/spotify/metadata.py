@@ -0,0 +1,208 @@
+import base64
+import json
+import logging
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from util import memoized_result
+
+log = logging.getLogger(__name__)
+
+RESOLVE_CONCURRENCY = 8  # Default amount of lookups running at the same time
+METADATA_TTL = 24 * 60 * 60  # Default seconds lookups are memoized
+
+_QUERY = re.compile(r'(?:^|[:/])(track|album|playlist)[:/]([A-Za-z0-9]{22})')
+
+
+def parse_query(query: str):
+    """Splits a queue argument into its kind and value: a track, album or playlist id, or a search.
+    Accepts `track:<id>` style arguments, Spotify URIs and open.spotify.com links."""
+    query = query.strip()
+    match = _QUERY.search(query)
+    if match:
+        return match.group(1), match.group(2)
+    # Plain ids without a valid length
+    for kind in ('track', 'album', 'playlist'):
+        if query.startswith(kind + ':'):
+            return kind, query[len(kind) + 1:]
+    return 'search', query
+
+
+class MetadataError(Exception):
+    pass
+
+
+class MetadataProvider:
+    """Looks up items of the Spotify catalog. Every method blocks, the Resolver runs them on worker threads.
+    Pages return the track ids on that page and the total amount of tracks."""
+    album_page_size = 50
+    playlist_page_size = 100
+
+    def track(self, track_id: str):
+        """Returns a dict with the `name`, `artists` and `duration_ms` of the track."""
+        raise NotImplementedError
+
+    def album_page(self, album_id: str, offset: int):
+        raise NotImplementedError
+
+    def playlist_page(self, playlist_id: str, offset: int):
+        raise NotImplementedError
+
+    def search(self, query: str):
+        """Returns the ids of the tracks best matching `query`, best first."""
+        raise NotImplementedError
+
+
+class WebApiProvider(MetadataProvider):
+    """Spotify Web API, authenticated with the client credentials of an app registered on Spotify."""
+    API = 'https://api.spotify.com/v1'
+    TOKEN_URL = 'https://accounts.spotify.com/api/token'
+    TIMEOUT = 10  # seconds
+
+    def __init__(self, client_id: str, client_secret: str):
+        self._credentials = base64.b64encode(f'{client_id}:{client_secret}'.encode()).decode()
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = threading.Lock()
+
+    def _access_token(self):
+        with self._token_lock:
+            if self._token is None or self._token_expires <= time.monotonic():
+                request = urllib.request.Request(self.TOKEN_URL, data=b'grant_type=client_credentials',
+                                                 headers={'Authorization': f'Basic {self._credentials}'})
+                with urllib.request.urlopen(request, timeout=self.TIMEOUT) as response:
+                    token = json.load(response)
+                self._token = token['access_token']
+                # Refresh a minute early
+                self._token_expires = time.monotonic() + token['expires_in'] - 60
+            return self._token
+
+    def _get(self, path: str, **params):
+        url = f'{self.API}/{path}'
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        try:
+            # Fetching a token fails the same way as the request itself
+            request = urllib.request.Request(url, headers={'Authorization': f'Bearer {self._access_token()}'})
+            with urllib.request.urlopen(request, timeout=self.TIMEOUT) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            raise MetadataError(f'Spotify answered {e.code} for {path}') from e
+        except urllib.error.URLError as e:
+            raise MetadataError(f'Spotify is unreachable: {e.reason}') from e
+
+    def track(self, track_id: str):
+        track = self._get(f'tracks/{track_id}')
+        return {
+            'name': track['name'],
+            'artists': [artist['name'] for artist in track['artists']],
+            'duration_ms': track['duration_ms'],
+        }
+
+    def album_page(self, album_id: str, offset: int):
+        page = self._get(f'albums/{album_id}/tracks', limit=self.album_page_size, offset=offset)
+        return [item['id'] for item in page['items']], page['total']
+
+    def playlist_page(self, playlist_id: str, offset: int):
+        page = self._get(f'playlists/{playlist_id}/tracks', limit=self.playlist_page_size, offset=offset,
+                         fields='total,items(track(id))')
+        # Local files and removed tracks have no id
+        return [item['track']['id'] for item in page['items'] if item['track'] and item['track']['id']], page['total']
+
+    def search(self, query: str):
+        result = self._get('search', q=query, type='track', limit=5)
+        return [item['id'] for item in result['tracks']['items']]
+
+
+class StubMetadataProvider(MetadataProvider):
+    """Local, deterministic catalog for testing. Every album and playlist holds the configured amount of
+    tracks, every lookup takes `latency` seconds."""
+
+    def __init__(self, album_tracks: int = 12, playlist_tracks: int = 1000, latency: float = 0.05):
+        self.album_tracks = album_tracks
+        self.playlist_tracks = playlist_tracks
+        self.latency = latency
+        self.lookups = 0
+
+    @staticmethod
+    def _track_id(parent: str, index: int):
+        return f'{parent[:14]}{index:08d}'
+
+    def _lookup(self):
+        self.lookups += 1
+        time.sleep(self.latency)
+
+    def track(self, track_id: str):
+        self._lookup()
+        return {'name': f'Track {track_id}', 'artists': ['Stub artist'], 'duration_ms': 180000}
+
+    def _page(self, parent: str, offset: int, page_size: int, total: int):
+        self._lookup()
+        return [self._track_id(parent, i) for i in range(offset, min(offset + page_size, total))], total
+
+    def album_page(self, album_id: str, offset: int):
+        return self._page(album_id, offset, self.album_page_size, self.album_tracks)
+
+    def playlist_page(self, playlist_id: str, offset: int):
+        return self._page(playlist_id, offset, self.playlist_page_size, self.playlist_tracks)
+
+    def search(self, query: str):
+        self._lookup()
+        return [self._track_id(query.replace(' ', '').ljust(14, '0'), i) for i in range(5)]
+
+
+class Resolver:
+    """Turns queue arguments into track ids, running at most `concurrency` lookups at the same time.
+    With a fanout `cache` the lookups are memoized for `ttl` seconds.
+    """
+
+    def __init__(self, provider: MetadataProvider, cache=None, concurrency: int = RESOLVE_CONCURRENCY,
+                 ttl: float = METADATA_TTL):
+        self.provider = provider
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='Spotify metadata')
+        self._lookups = {}
+        for method in ('track', 'album_page', 'playlist_page', 'search'):
+            lookup = getattr(provider, method)
+            if cache is not None:
+                lookup = memoized_result(cache, name=f'spotify.{method}', expire=ttl)(lookup)
+            self._lookups[method] = lookup
+
+    def _run(self, loop, method: str, *args):
+        return loop.run_in_executor(self._executor, self._lookups[method], *args)
+
+    async def resolve(self, query: str, loop):
+        """Yields the track ids `query` refers to in order, a page at a time as soon as the page and all
+        pages before it are known. The first page is looked up on its own, the rest all at once."""
+        kind, value = parse_query(query)
+        if kind == 'track':
+            yield [value]
+            return
+        if kind == 'search':
+            found = await self._run(loop, 'search', value)
+            yield found[:1]
+            return
+
+        method = f'{kind}_page'
+        page_size = getattr(self.provider, f'{kind}_page_size')
+        track_ids, total = await self._run(loop, method, value, 0)
+        yield track_ids
+        pages = [self._run(loop, method, value, offset) for offset in range(page_size, total, page_size)]
+        try:
+            for page in pages:
+                track_ids, _ = await page
+                yield track_ids
+        finally:
+            # Consumer stopped early, or a lookup failed
+            for page in pages:
+                page.cancel()
+
+    async def track(self, track_id: str, loop):
+        return await self._run(loop, 'track', track_id)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
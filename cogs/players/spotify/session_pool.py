@@ -0,0 +1,186 @@
+import collections
+import logging
+import os
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import librespot
+
+log = logging.getLogger(__name__)
+
+POOL_SIZE = 4  # Default maximum of idle sessions kept for reuse
+WARM_SESSIONS = 1  # Default amount of idle sessions kept logged in at all times
+IDLE_TTL = 10 * 60  # Default seconds idle sessions beyond the warm ones are kept
+REAP_INTERVAL = 10.0  # seconds between checks for expired sessions
+LOGIN_CONCURRENCY = 2  # Logins running at the same time
+DRAIN_CHUNK = 64 * 1024
+
+
+class SpotSession:
+    """A logged in librespot session and its player, with the pipe the player writes audio into.
+    Connecting blocks for the login round-trip."""
+
+    def __init__(self, credentials, pool=None):
+        fd_read, fd_write = os.pipe()
+        self.pipe = open(fd_read, 'rb')
+        self.sink = open(fd_write, 'wb')
+        self.session = librespot.Session.connect(credentials[0], credentials[1], self.sink).wait()
+        self.player = self.session.player()
+        # Cleared when librespot stopped writing audio, the session isn't reused then
+        self.healthy = True
+        self.idle_since = None
+        self._pool = pool
+
+    def drain(self):
+        """Drops audio a previous user left in the pipe. Returns False when librespot closed it."""
+        fd = self.pipe.fileno()
+        try:
+            while select.select((fd,), (), (), 0)[0]:
+                if not os.read(fd, DRAIN_CHUNK):
+                    self.healthy = False
+                    break
+        except (OSError, ValueError):
+            self.healthy = False
+        return self.healthy
+
+    def release(self):
+        """Hands the session back to its pool, sessions without one are closed. The player must be paused."""
+        if self._pool is not None:
+            self._pool.release(self)
+        else:
+            self.close()
+
+    def close(self):
+        # TODO Shutdown reactor within session
+        self.healthy = False
+        self.session = self.player = None
+        for pipe in (self.sink, self.pipe):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+
+class SessionPool:
+    """Logs in librespot sessions off the event loop and reuses them after guilds detach.
+
+    `warm` idle sessions are kept logged in ahead of time, so attaching doesn't wait for a login.
+    At most `size` idle sessions are kept, the ones beyond `warm` close after `idle_ttl` seconds.
+    """
+
+    def __init__(self, credentials, size: int = POOL_SIZE, warm: int = WARM_SESSIONS, idle_ttl: float = IDLE_TTL):
+        self._credentials = credentials
+        self.size = size
+        self.warm = min(warm, size)
+        self.idle_ttl = idle_ttl
+        # Most recently released last, the oldest ones expire first
+        self._idle = collections.deque()
+        self._connecting = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=LOGIN_CONCURRENCY, thread_name_prefix='Spotify login')
+        self._stopped = threading.Event()
+        self._reaper = None
+        # Stats
+        self.logins = 0
+        self.reuses = 0
+
+    def start(self):
+        """Logs in the warm sessions in the background and starts expiring idle ones."""
+        self._top_up()
+        self._reaper = threading.Thread(target=self._reap_loop, name='Spotify session reaper', daemon=True)
+        self._reaper.start()
+
+    def _connect(self):
+        session = SpotSession(self._credentials, self)
+        with self._lock:
+            self.logins += 1
+        return session
+
+    def _connect_idle(self):
+        try:
+            session = self._connect()
+        except Exception:
+            log.exception('Logging in a Spotify session failed')
+            return
+        finally:
+            with self._lock:
+                self._connecting -= 1
+        self.release(session)
+
+    def _top_up(self):
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            missing = self.warm - len(self._idle) - self._connecting
+            self._connecting += max(0, missing)
+        for _ in range(missing):
+            self._executor.submit(self._connect_idle)
+
+    def _take_idle(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                session = self._idle.pop()
+            if session.drain():
+                return session
+            session.close()
+
+    async def acquire(self, loop):
+        """Returns a logged in session, only waits for a login when no idle session is left."""
+        session = self._take_idle()
+        if session is not None:
+            with self._lock:
+                self.reuses += 1
+        else:
+            session = await loop.run_in_executor(self._executor, self._connect)
+        self._top_up()
+        return session
+
+    def release(self, session: SpotSession):
+        with self._lock:
+            keep = session.healthy and not self._stopped.is_set() and len(self._idle) < self.size
+            if keep:
+                session.idle_since = time.monotonic()
+                self._idle.append(session)
+        if not keep:
+            session.close()
+
+    def _reap_loop(self):
+        while not self._stopped.wait(REAP_INTERVAL):
+            self.reap()
+
+    def reap(self):
+        """Closes the sessions beyond the warm ones which idled longer than the TTL."""
+        expired = []
+        deadline = time.monotonic() - self.idle_ttl
+        with self._lock:
+            while len(self._idle) > self.warm and self._idle[0].idle_since <= deadline:
+                expired.append(self._idle.popleft())
+        for session in expired:
+            session.close()
+        if expired:
+            log.debug(f'Closed {len(expired)} idle Spotify sessions')
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'idle': len(self._idle),
+                'connecting': self._connecting,
+                'logins': self.logins,
+                'reuses': self.reuses,
+            }
+
+    def close(self):
+        self._stopped.set()
+        if self._reaper is not None:
+            self._reaper.join()
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for session in idle:
+            session.close()
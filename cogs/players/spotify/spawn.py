@@ -2,14 +2,24 @@ import logging
 import os
 import tempfile
 import collections
+import threading
+import array
+import fcntl
+import select
+import termios
+import time
 
 import numpy as np
 from discord.ext import commands
-import nnresample
 
 import librespot
 
 from cogs.players import PlayerBase
+from cogs.players.play_queue import PlayQueue
+from cogs.players.resampler import StreamingResampler
+from cogs.players.ring_buffer import RingBuffer
+from .session_pool import SpotSession
+from util import metrics
 
 log = logging.getLogger(__name__)
 
@@ -23,68 +33,446 @@ QUALITY = 5
 FRAME_20MS_44100 = int(((INPUT_RATE * FRAME_LENGTH) / 1000) * CHANNELS * SAMPLE_SIZE)
 FRAME_20MS_48000 = int(((OUTPUT_RATE * FRAME_LENGTH) / 1000) * CHANNELS * SAMPLE_SIZE)
 DT = np.dtype(np.int16).newbyteorder('<')
-ZEROS = np.zeros(FRAME_20MS_48000, dtype=DT).tobytes()
+ZEROS = np.zeros(FRAME_20MS_48000 // SAMPLE_SIZE, dtype=DT).tobytes()
+SILENCE_44100 = memoryview(bytes(FRAME_20MS_44100))
 
+BUFFER_FRAMES = 50  # Default buffer depth, 1 second of audio
+PUMP_CHUNK = 16 * 1024  # Maximum amount of bytes moved from the pipe at once
+PUMP_POLL = 0.1  # seconds the pump waits for audio before checking whether it should stop
+CROSSFADE_MS = 0  # Default cross-fade between tracks, 0 gives plain gapless transitions
+SAMPLES_20MS_44100 = FRAME_20MS_44100 // (CHANNELS * SAMPLE_SIZE)
+BYTES_PER_MS_44100 = INPUT_RATE * CHANNELS * SAMPLE_SIZE / 1000
 
-def _resample(src):
-    if isinstance(src, np.ndarray):
-        a = src
-    elif isinstance(src, bytes):
-        a = np.frombuffer(src, dtype=DT)
-    else:
-        raise NotImplementedError("Unknown source")
 
-    i = a.reshape((2, -1), order='F')
-    resampled = nnresample.resample(i, OUTPUT_RATE, INPUT_RATE, axis=1, fc='nn', As=80, N=32001)
-    o = resampled.reshape((-1,), order='F')
-    return o.astype(DT).tobytes()
+def _pipe_backlog(fd):
+    """Amount of bytes written into the pipe which haven't been read yet."""
+    try:
+        count = array.array('i', [0])
+        fcntl.ioctl(fd, termios.FIONREAD, count)
+        return count[0]
+    except OSError:
+        return 0
 
 
-#  Do a warmup run as to not delay the first resample iterations
-for i in range(5):
-    _resample(ZEROS)
-log.info("Warmup run completed")
+class _Segment:
+    """One track in play order. Streamed tracks come out of the buffer, cached ones straight from disk."""
+    __slots__ = ('track_id', 'cached', 'writer', 'start', 'offset', 'end')
+
+    def __init__(self, track_id: str, cached=None, writer=None, start: int = 0, offset: int = 0):
+        self.track_id = track_id
+        self.cached = cached
+        # Records the streamed track into the track cache
+        self.writer = writer
+        # Stream position where librespot started writing the track, `offset` milliseconds into it
+        self.start = start
+        self.offset = offset
+        # Stream position where the track ends, known once librespot finished it
+        self.end = None
+
+    def close(self):
+        if self.cached is not None:
+            self.cached.close()
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+
+
+class _Lookahead:
+    """Second librespot session which fetches the start of the next track while the current one plays.
+
+    One player writes one track at a time, so without it the next track only starts loading once librespot
+    finished the current one, and a cross-fade needs its start sooner than librespot can write it.
+    """
+
+    def __init__(self, session: SpotSession, size: int):
+        self.session = session
+        self.player = session.player
+        self._size = size
+        self._track_id = None
+        self._head = bytearray()
+        self._paused = False
+        # Audio before this position in the pipe belongs to a previous fetch
+        self._pumped = 0
+        self._discard_until = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._pump = threading.Thread(target=self._pump_pipe, name='SpotSpawn lookahead', daemon=True)
+        self._pump.start()
+
+    def fetch(self, track_id: str):
+        """Starts fetching the start of the track, unless it's fetched already."""
+        with self._lock:
+            if track_id == self._track_id or self._stopped.is_set():
+                # Once stopped, the session may be used by another source
+                return
+            self._track_id = track_id
+            self._head = bytearray()
+            self._discard_until = self._pumped + _pipe_backlog(self.session.pipe.fileno())
+            self._paused = False
+            self.player.load(librespot.SpotifyId(track_id), True, 0)
+
+    def take(self, track_id: str):
+        """Returns the start of the track when it's fetched completely, otherwise None."""
+        with self._lock:
+            if track_id != self._track_id or len(self._head) < self._size:
+                return None
+            self._track_id = None
+            return bytes(self._head)
+
+    def _pump_pipe(self):
+        try:
+            fd = self.session.pipe.fileno()
+            while not self._stopped.is_set():
+                if not select.select((fd,), (), (), PUMP_POLL)[0]:
+                    continue
+                with self._lock:
+                    chunk = os.read(fd, PUMP_CHUNK)
+                    discard = self._discard_until - self._pumped
+                    self._pumped += len(chunk)
+                    if not chunk:
+                        self.session.healthy = False
+                        break
+                    if discard > 0:
+                        chunk = chunk[discard:]
+                    self._head += chunk[:self._size - len(self._head)]
+                    if len(self._head) >= self._size and not self._paused:
+                        # Nothing more is needed of this track
+                        self._paused = True
+                        self.player.pause()
+        except (OSError, ValueError):
+            self.session.healthy = False
+        finally:
+            with self._lock:
+                self._stopped.set()
+            self.session.release()
+
+    def close(self):
+        self._stopped.set()
+        self.player.pause()
 
 
 class SpotSpawn(PlayerBase):
-    def __init__(self, credentials):
-        pipe_read, pipe_write = self._setup_pipe()
-        self.pipe = pipe_read
-        self.session = librespot.Session.connect(credentials[0], credentials[1], pipe_write).wait()
+    """Plays Spotify tracks through a librespot session.
+
+    Librespot decodes ahead of playback by up to `buffer_frames`, so the next track loads while the
+    buffered end of the current one still plays and transitions are gapless. With `crossfade_ms`
+    the end of each track is mixed with the start of the next one.
+    Cross-fading takes a second session, which fetches the start of the next track while the current one
+    plays. The player then continues the next track right after that start.
+    With a `track_cache`, streamed tracks are recorded after resampling and replays come from disk.
+    Cross-fading mixes before resampling, so it disables the track cache.
+    The `playlist` holds track ids, pass a PlayQueue to keep it across restarts.
+    Pass a logged in `session`, and `lookahead_session` when cross-fading, to skip the logins. They're released
+    once the source is cleaned up.
+    """
+
+    def __init__(self, credentials, buffer_frames: int = BUFFER_FRAMES, crossfade_ms: int = CROSSFADE_MS,
+                 track_cache=None, playlist: PlayQueue = None, session: SpotSession = None,
+                 lookahead_session: SpotSession = None):
+        self.spot_session = session if session is not None else SpotSession(credentials)
+        self.pipe = self.spot_session.pipe
+        self.session = self.spot_session.session
 
-        self.player = self.session.player()
+        self.player = self.spot_session.player
+        self.resampler = StreamingResampler(INPUT_RATE, OUTPUT_RATE, CHANNELS, timed=metrics.registry.enabled)
         self.playing = None
-        self.playlist = collections.deque()
+        self.playlist = playlist if playlist is not None else collections.deque()
 
-    @staticmethod
-    def _setup_pipe():
-        fd_read, fd_write = os.pipe()
-        pipe_read = open(fd_read, 'rb')
-        pipe_write = open(fd_write, 'wb')
-        return pipe_read, pipe_write
+        # The pump thread drains the pipe into the buffer, read() never waits on librespot
+        self.buffer = RingBuffer(buffer_frames * FRAME_20MS_44100, alignment=CHANNELS * SAMPLE_SIZE)
+        self.underruns = 0
+        self._frame = bytearray(FRAME_20MS_44100)
+        self._frame_view = memoryview(self._frame)
+        self._pump_eof = False
+        # Byte positions in the stream of audio going through the buffer
+        self._pumped = 0
+        self._consumed = 0
+        # Held while bytes move out of the pipe, so pipe backlog and `_pumped` add up
+        self._pump_lock = threading.Lock()
+        # Audio before this stream position is dropped by the pump, it belongs to an abandoned load
+        self._discard_until = 0
+
+        # [position where a track ends, start of the next track fetched ahead or None], only tracked for cross-fading
+        self._boundaries = collections.deque()
+        self._fade_bytes = int(INPUT_RATE * crossfade_ms / 1000) * CHANNELS * SAMPLE_SIZE
+        self._fade_ms = crossfade_ms
+        self._lookahead = None
+        if self._fade_bytes:
+            session = lookahead_session if lookahead_session is not None else SpotSession(credentials)
+            self._lookahead = _Lookahead(session, self._fade_bytes)
+        self._fade_frame = bytearray(FRAME_20MS_44100)
+        self._fade_view = memoryview(self._fade_frame)
+        self._fade_gain = np.empty((SAMPLES_20MS_44100, 1), dtype=np.float32)
+        self._fade_mix = np.empty((SAMPLES_20MS_44100, CHANNELS), dtype=np.float32)
+        self._sample_index = np.arange(SAMPLES_20MS_44100, dtype=np.float32).reshape((-1, 1))
+
+        # Tracks in play order, from the audible one up to the one librespot loaded last
+        self.track_cache = track_cache if not self._fade_bytes else None
+        self._segments = collections.deque()
+        # Held while the play order changes, librespot callbacks and the audio thread both advance it
+        self._load_lock = threading.RLock()
+
+        # Seeks which reload the track are done once audio arrives
+        self._seek_started = None
+        self.last_seek_latency = None
+
+        self._pump = threading.Thread(target=self._pump_pipe, name='SpotSpawn pump', daemon=True)
+        self._pump.start()
+
+    def _pump_pipe(self):
+        """Moves audio from the librespot sink into the ring buffer until the buffer closes, then releases
+        the session. Stops early when librespot closes the pipe."""
+        try:
+            fd = self.pipe.fileno()
+            while not self.buffer.closed:
+                # Wait outside of the lock, the read itself won't block anymore.
+                # Unbuffered reads, so the pipe backlog tells exactly what hasn't been pumped yet
+                if not select.select((fd,), (), (), PUMP_POLL)[0]:
+                    continue
+                with self._pump_lock:
+                    chunk = os.read(fd, PUMP_CHUNK)
+                    discard = self._discard_until - self._pumped
+                    self._pumped += len(chunk)
+                    # Flushing clears the buffer, which drops this chunk when it's still being written
+                    epoch = self.buffer.epoch
+                if not chunk:
+                    self.spot_session.healthy = False
+                    break
+                if discard > 0:
+                    chunk = chunk[discard:]
+                self.buffer.write(chunk, epoch=epoch)
+        except (OSError, ValueError):
+            # Pipe got closed underneath us
+            self.spot_session.healthy = False
+        finally:
+            self._pump_eof = True
+            # Nothing reads the pipe anymore, another source may use the session now
+            with self._pump_lock:
+                self.pipe = None
+            self.spot_session.release()
+            log.debug('Pump thread stopped')
 
     def read(self):
-        if not self.playing:
+        while self._segments:
+            segment = self._segments[0]
+            if segment.cached is not None:
+                frame = segment.cached.read()
+                if frame:
+                    self._load_ahead()
+                    return frame
+            elif segment.end is None or self._consumed < segment.end:
+                break
+            self._finish_segment()
+        if self._segments:
+            self._load_ahead()
+
+        if self._seek_started is not None and self.buffer.available:
+            self._seek_done()
+
+        if not self.playing and not self.buffer.available:
             # Play something without playing something.. magic!
             return ZEROS
 
         # Otherwise play from sink
-        buf = self.pipe.read(FRAME_20MS_44100)
-        if len(buf) == 0:
-            return b''
-        return _resample(buf)
+        if self._boundaries and self._consumed + FRAME_20MS_44100 > self._boundaries[0][0] - self._fade_bytes:
+            if self._read_crossfaded(*self._boundaries[0]):
+                return self.resampler.process(self._frame)
+
+        if self.track_cache is not None:
+            return self._read_recorded()
+
+        count = self.buffer.read_into(self._frame_view)
+        self._consumed += count
+        if count < FRAME_20MS_44100:
+            if count == 0 and self._pump_eof:
+                return b''
+            if self.playing:
+                # Librespot fell behind
+                self.underruns += 1
+            # Fill up with silence. This also keeps the resampler aligned on whole frames,
+            # so every call yields FRAME_20MS_48000 bytes
+            self._frame_view[count:] = SILENCE_44100[count:]
+        return self.resampler.process(self._frame)
+
+    def _read_recorded(self):
+        """Reads from the buffer like `read`, recording the frames of each streamed track into the track cache."""
+        segment = self._segments[0] if self._segments else None
+        following = self._segments[1] if len(self._segments) > 1 else None
+        size = FRAME_20MS_44100
+        split = None
+        if segment is not None and segment.end is not None and self._consumed + size > segment.end:
+            # This frame holds the end of the track
+            split = segment.end - self._consumed
+            if following is None or following.cached is not None:
+                # What follows in the buffer isn't part of the next track
+                size = split
+
+        count = self.buffer.read_into(self._frame_view[:size])
+        self._consumed += count
+        if count < FRAME_20MS_44100:
+            if count == 0 and self._pump_eof:
+                return b''
+            if self.playing and split is None:
+                # Librespot fell behind
+                self.underruns += 1
+                if count and segment is not None and segment.writer is not None:
+                    # Don't keep a recording with a gap in it
+                    segment.writer.abort()
+                    segment.writer = None
+            self._frame_view[count:] = SILENCE_44100[count:]
+        frame = self.resampler.process(self._frame)
+
+        if segment is None or (count == 0 and split is None):
+            # Nothing of the track in this frame
+            return frame
+        if split is None:
+            if segment.writer is not None:
+                segment.writer.append(frame)
+            return frame
+
+        # Split the frame at the track boundary, each track keeps its own part
+        edge = min(len(frame), (split // (CHANNELS * SAMPLE_SIZE)) * OUTPUT_RATE // INPUT_RATE * CHANNELS * SAMPLE_SIZE)
+        if segment.writer is not None:
+            segment.writer.append(frame[:edge] + ZEROS[edge:])
+        if count > split and following is not None and following.writer is not None:
+            following.writer.append(ZEROS[:edge] + frame[edge:])
+        return frame
+
+    def _finish_segment(self):
+        """Moves on from the track at the head of the play order."""
+        with self._load_lock:
+            segment = self._segments.popleft()
+        if segment.cached is not None:
+            segment.cached.close()
+            # Streamed audio continues here, history from before the cached track doesn't belong to it
+            self.resampler.reset()
+        elif segment.writer is not None:
+            if len(segment.writer):
+                self.track_cache.commit_later(segment.writer)
+            else:
+                segment.writer.abort()
+            segment.writer = None
+
+    def _load_ahead(self):
+        """Streams the next track while cached tracks play, or queued tracks when librespot finished."""
+        if self.playing is None and self.playlist:
+            with self._load_lock:
+                if self.playing is None:
+                    self._next_song()
+
+    def _read_crossfaded(self, boundary: int, start: bytes = None):
+        """Fills the frame buffer with the end of the finished track mixed with the start of the next one.
+        The next track starts playing `_fade_bytes` earlier than it would without cross-fade. Its `start` comes
+        from the lookahead, otherwise it's read from the buffer behind the end of the finished track.
+        Returns False when the cross-fade can't happen, because the next track isn't buffered in time.
+        """
+        fade = self._fade_bytes
+        fade_start = boundary - fade
+        if start is None:
+            head = self.buffer.peek_into(self._fade_view, fade)
+            if head < FRAME_20MS_44100:
+                if self._consumed <= fade_start:
+                    # Not started yet, fall back to a gapless transition
+                    self._boundaries.popleft()
+                    return False
+                self.underruns += 1
+                self._fade_view[head:] = SILENCE_44100[head:]
+
+        tail = self.buffer.read_into(self._frame_view)
+        self._frame_view[tail:] = SILENCE_44100[tail:]
+        if start is not None:
+            # Before the fade starts the next track is silent, behind the end of the finished track the buffer
+            # continues it
+            skipped = max(0, fade_start - self._consumed)
+            offset = max(0, self._consumed - fade_start)
+            count = max(0, min(FRAME_20MS_44100 - skipped, fade - offset))
+            self._fade_view[:skipped] = SILENCE_44100[:skipped]
+            self._fade_view[skipped:skipped + count] = start[offset:offset + count]
+            self._fade_view[skipped + count:] = self._frame_view[skipped + count:]
+
+        # Gain of the next track for each sample, ramping from 0 to 1 over the fade
+        sample_size = CHANNELS * SAMPLE_SIZE
+        gain = self._fade_gain
+        np.add(self._sample_index, (self._consumed - fade_start) // sample_size, out=gain)
+        np.multiply(gain, sample_size / fade, out=gain)
+        np.clip(gain, 0, 1, out=gain)
+
+        current = np.frombuffer(self._frame, dtype=DT).reshape((-1, CHANNELS))
+        following = np.frombuffer(self._fade_frame, dtype=DT).reshape((-1, CHANNELS))
+        mix = self._fade_mix
+        # current + (following - current) * gain
+        np.subtract(following, current, out=mix)
+        np.multiply(mix, gain, out=mix)
+        np.add(mix, current, out=mix)
+        np.rint(mix, out=mix)
+        np.copyto(current, mix, casting='unsafe')
+
+        self._consumed += FRAME_20MS_44100
+        if self._consumed >= boundary:
+            if start is None:
+                # The start of the next track is mixed in already
+                self._consumed += self.buffer.skip(fade)
+            self._boundaries.popleft()
+        return True
 
     def is_opus(self):
         return False
 
+    def is_idle(self):
+        return not self.playing and not self.buffer.available and not self._segments
+
+    def current_track(self):
+        # Librespot loads ahead of playback, the head of the play order is audible
+        segments = self._segments
+        return segments[0] if segments else self.playing
+
+    def stats(self):
+        with self._pump_lock:
+            backlog = self._pipe_backlog()
+        stats = {
+            'underruns': self.underruns,
+            'buffered_bytes': self.buffer.available,
+            'pipe_backlog_bytes': backlog,
+        }
+        if self.resampler.timed:
+            stats['resampled_frames'] = self.resampler.processed
+            stats['resample_seconds'] = self.resampler.busy_time
+        return stats
+
+    def _clear_segments(self):
+        with self._load_lock:
+            segments = list(self._segments)
+            self._segments.clear()
+        for segment in segments:
+            segment.close()
+
     def cleanup(self):
         try:
-            # TODO Shutdown reactor within session
-            self.pipe.close()
-            pass
+            # Librespot stops writing, the pump releases the session once it stopped
+            self.player.pause()
+            # Tracks which didn't finish play again from the queue, eg after a restart
+            with self._load_lock:
+                self.playing = None
+                for segment in reversed(self._segments):
+                    self.playlist.appendleft(segment.track_id)
+            self._clear_segments()
+            if isinstance(self.playlist, PlayQueue):
+                self.playlist.close()
+            if self._lookahead is not None:
+                self._lookahead.close()
+            self.buffer.close()
         except:
             pass
 
+    def release_queue(self):
+        with self._load_lock:
+            # The replacing source plays the tracks which didn't finish here
+            for segment in reversed(self._segments):
+                self.playlist.appendleft(segment.track_id)
+            playlist, self.playlist = self.playlist, collections.deque()
+        if isinstance(playlist, PlayQueue):
+            playlist.close()
+
     def skip(self, amount: int):
         pass
 
@@ -94,22 +482,149 @@ class SpotSpawn(PlayerBase):
     def queue(self, arg: str):
         track_prefix = 'track:'
         if arg.startswith(track_prefix):
-            track = librespot.SpotifyId(arg[len(track_prefix):])
-            self.playlist.append(track)
+            # Any amount of whitespace separated tracks
+            tracks = [item[len(track_prefix):] for item in arg.split() if item.startswith(track_prefix)]
+            self.playlist.extend(tracks)
+            if self.playing is not None:
+                self._fetch_ahead()
         else:  # Do a flat search
             pass
 
+    def _pipe_backlog(self):
+        """Bytes librespot wrote that aren't pumped yet, 0 once the session is released. The pipe may be closed
+        or used by another source by then. Pump lock must be held."""
+        pipe = self.pipe
+        return _pipe_backlog(pipe.fileno()) if pipe is not None else 0
+
+    def _stream_position(self):
+        """Stream position right after the audio librespot wrote so far."""
+        # Librespot wrote it; it's either pumped already or still waiting in the pipe
+        with self._pump_lock:
+            position = self._pumped + self._pipe_backlog()
+        return position - position % (CHANNELS * SAMPLE_SIZE)
+
+    def _track_finished(self, loaded):
+        with self._load_lock:
+            if loaded is not self.playing:
+                # Replaced by a seek
+                return
+            boundary = self._stream_position()
+            if self._fade_bytes:
+                self._boundaries.append([boundary, None])
+            streamed = [s for s in self._segments if s.cached is None and s.end is None]
+            if streamed:
+                streamed[0].end = boundary
+            # Buffered audio keeps playing while the next track loads
+            self._next_song()
+
     def _next_song(self):
-        def build_next(obj):
-            return obj._next_song
+        with self._load_lock:
+            self.playing = None
+            while self.playlist:
+                track_id = self.playlist.popleft()
+                writer = None
+                if self.track_cache is not None:
+                    cached = self.track_cache.open(track_id)
+                    if cached is not None:
+                        # Cached tracks don't need librespot, look further for one that does
+                        self._segments.append(_Segment(track_id, cached=cached))
+                        continue
+                    writer = self.track_cache.writer(track_id)
+                position = 0
+                if self._lookahead is not None and self._boundaries and self._boundaries[-1][1] is None:
+                    # Fading into this track, continue it behind the start the lookahead fetched
+                    start = self._lookahead.take(track_id)
+                    if start is not None:
+                        self._boundaries[-1][1] = start
+                        position = self._fade_ms
+                self._segments.append(_Segment(track_id, writer=writer, start=self._stream_position(),
+                                               offset=position))
+                self._load(track_id, position)
+                self._fetch_ahead()
+                break
+
+    def _fetch_ahead(self):
+        """Lets the lookahead fetch the start of the track queued next."""
+        if self._lookahead is not None:
+            track_id = next(iter(self.playlist), None)
+            if track_id is not None:
+                self._lookahead.fetch(track_id)
+
+    def _load(self, track_id: str, position: int):
+        def build_next(obj, loaded):
+            return lambda: obj._track_finished(loaded)
+
+        # 1. The SpotifyID object which will be loaded
+        # 2. If this item must be autostarted
+        # 3. The position to scrub after load (milliseconds)
+        self.playing = self.player.load(librespot.SpotifyId(track_id), True, position)
+        self.playing.add_callback(build_next(self, self.playing))
+
+    def _flush_stream(self):
+        """Drops all audio librespot produced so far, buffered or still in the pipe. Returns the stream position
+        where new audio starts."""
+        with self._pump_lock:
+            position = self._pumped + self._pipe_backlog()
+            self._discard_until = position
+            self.buffer.clear()
+            self._consumed = position
+        self._boundaries.clear()
+        return position
+
+    def position(self):
+        segments = self._segments
+        if not segments:
+            return None
+        segment = segments[0]
+        if segment.cached is not None:
+            return segment.cached.position * FRAME_LENGTH
+        return segment.offset + int(max(0, self._consumed - segment.start) / BYTES_PER_MS_44100)
+
+    def seek(self, position: int):
+        """Jumps within the cached or buffered audio of the current track, otherwise librespot reloads it
+        at `position`."""
+        started = time.perf_counter()
+        position = max(0, position)
+        with self._load_lock:
+            if not self._segments:
+                return
+            segment = self._segments[0]
+            if segment.cached is not None:
+                segment.cached.seek(position // FRAME_LENGTH)
+                self._seek_done(started)
+                return
+
+            if segment.writer is not None:
+                # The recording won't be continuous anymore
+                segment.writer.abort()
+                segment.writer = None
+            target = segment.start + int((position - segment.offset) * BYTES_PER_MS_44100)
+            target -= target % (CHANNELS * SAMPLE_SIZE)
+            if segment.end is not None:
+                target = min(target, segment.end)
+            ahead = target - self._consumed
+            if 0 <= ahead <= self.buffer.available:
+                self._consumed += self.buffer.skip(ahead)
+                self._seek_done(started)
+                return
+
+            # Outside of what's buffered; tracks loaded after this one go back in the queue
+            while len(self._segments) > 1:
+                following = self._segments.pop()
+                following.close()
+                self.playlist.appendleft(following.track_id)
+            segment.start = self._flush_stream()
+            segment.offset = position
+            segment.end = None
+            self.resampler.reset()
+            self._seek_started = started
+            self._load(segment.track_id, position)
 
-        if self.playlist:
-            next_track = self.playlist.popleft()
-            # 1. The SpotifyID object which will be loaded
-            # 2. If this item must be autostarted
-            # 3. The position to scrub after load (milliseconds)
-            self.playing = self.player.load(next_track, True, 0)
-            self.playing.add_callback(build_next(self))
+    def _seek_done(self, started: float = None):
+        if started is None:
+            started, self._seek_started = self._seek_started, None
+        self.last_seek_latency = time.perf_counter() - started
+        log.debug(f'Seek took {self.last_seek_latency * 1000:.1f}ms')
 
     def resume(self):
         if not self.playing:
@@ -131,3 +646,6 @@ class SpotSpawn(PlayerBase):
     def stop(self):
         self.pause()
         self.playing = None
+        self._seek_started = None
+        self._clear_segments()
+        self._flush_stream()
@@ -1 +1,2 @@
-from .stub_source import StubSource
\ No newline at end of file
+from .stub_source import StubSource
+from .silence_source import SilenceSource
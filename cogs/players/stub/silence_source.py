@@ -0,0 +1,26 @@
+from cogs.players.opus_source import OPUS_SILENCE
+
+from .stub_source import StubSource
+
+IDLE_TIMEOUT = 5.0  # seconds
+FRAME_LENGTH = 20  # milliseconds
+
+
+class SilenceSource(StubSource):
+    """Stub source which sends precomputed Opus silence, so idle voice states cost no encoding.
+
+    After `idle_timeout` seconds it ends the stream, discord.py then stops the audio player and
+    turns off speaking. Attaching a real source starts a new player.
+    """
+
+    def __init__(self, idle_timeout: float = IDLE_TIMEOUT):
+        self._frames_left = int(idle_timeout * 1000 / FRAME_LENGTH)
+
+    def read(self):
+        if self._frames_left <= 0:
+            return b''
+        self._frames_left -= 1
+        return OPUS_SILENCE
+
+    def is_opus(self):
+        return True
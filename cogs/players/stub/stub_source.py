@@ -1,7 +1,6 @@
 import logging
 
 import numpy as np
-import nnresample
 
 from cogs.players import PlayerBase
 
@@ -16,7 +15,7 @@ QUALITY = 5
 
 FRAME_20MS_48000 = int(((OUTPUT_RATE * FRAME_LENGTH) / 1000) * CHANNELS * SAMPLE_SIZE)
 DT = np.dtype(np.int16).newbyteorder('<')
-ZEROS = np.zeros(FRAME_20MS_48000, dtype=DT).tobytes()
+ZEROS = np.zeros(FRAME_20MS_48000 // SAMPLE_SIZE, dtype=DT).tobytes()
 
 
 class StubSource(PlayerBase):
@@ -31,6 +30,9 @@ class StubSource(PlayerBase):
     def previous(self, amount: int):
         pass
 
+    def seek(self, position: int):
+        pass
+
     def resume(self):
         pass
 
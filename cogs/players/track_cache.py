@@ -0,0 +1,232 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Track file layout: header, the frames back to back, then the index of frame offsets.
+# Offset `i` is where frame `i` starts, the last offset is where the index starts.
+MAGIC = b'PGTC'
+VERSION = 1
+FLAG_OPUS = 1
+_HEADER = struct.Struct('<4sHHIQ')  # magic, version, flags, frame count, index offset
+_OFFSET = np.dtype('<u8')
+
+MAX_BYTES = 2 * 1024 ** 3  # Default cache budget, 2GiB
+
+
+class CachedTrack:
+    """Memory mapped track file. Frames are served from the mapping and any frame is reachable in O(1)."""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, count, index_offset = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{path} is not a track cache file')
+        self.opus = bool(flags & FLAG_OPUS)
+        self.frame_count = count
+        self._offsets = np.frombuffer(self._map, dtype=_OFFSET, count=count + 1, offset=index_offset)
+        self.position = 0
+
+    def __len__(self):
+        return self.frame_count
+
+    def frame_view(self, index: int):
+        """Zero-copy view on frame `index`, valid until the track is closed."""
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return memoryview(self._map)[start:end]
+
+    def frame(self, index: int):
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return self._map[start:end]
+
+    def seek(self, index: int):
+        """Moves playback to frame `index`."""
+        self.position = max(0, min(index, self.frame_count))
+
+    def read(self):
+        """Returns the next frame, or an empty bytes object at the end of the track."""
+        if self.position >= self.frame_count:
+            return b''
+        frame = self.frame(self.position)
+        self.position += 1
+        return frame
+
+    def close(self):
+        # Release the exported buffer before unmapping
+        self._offsets = None
+        self._map.close()
+        self._file.close()
+
+
+class TrackWriter:
+    """Records the frames of one track, the track becomes available in the cache after `commit`."""
+
+    def __init__(self, cache, track_id: str, opus: bool = False):
+        self._cache = cache
+        self.track_id = track_id
+        self._opus = opus
+        self._tmp_path = os.path.join(cache.directory, f'.{uuid.uuid4().hex}.tmp')
+        self._file = open(self._tmp_path, 'wb', buffering=1024 ** 2)
+        self._file.write(bytes(_HEADER.size))
+        self._offsets = [_HEADER.size]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def append(self, frame):
+        self._file.write(frame)
+        self._offsets.append(self._offsets[-1] + len(frame))
+
+    def commit(self):
+        count = len(self._offsets) - 1
+        index_offset = self._offsets[-1]
+        self._file.write(np.array(self._offsets, dtype=_OFFSET).tobytes())
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(MAGIC, VERSION, FLAG_OPUS if self._opus else 0, count, index_offset))
+        self._file.close()
+        size = index_offset + len(self._offsets) * _OFFSET.itemsize
+        self._cache._store(self.track_id, self._tmp_path, size)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class TrackCache:
+    """Size bounded cache of finished frame streams, keyed by track id. Least recently played tracks are
+    evicted first. The files live in the directory of a CacheArena, the arena's index keeps them in LRU order.
+
+    All bookkeeping goes through index transactions, so sources in audio worker processes share the cache.
+    The budget defaults to the one of the arena, which counts the cache in its stats and culls.
+    """
+
+    def __init__(self, arena, max_bytes: int = None):
+        self.directory = os.path.join(arena.directory, 'tracks')
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes or arena.max_bytes or MAX_BYTES
+        self._index = arena.build_index()  # track id -> (file name, size), oldest first
+        self._init_local()
+        arena.register(self)
+
+    def _init_local(self):
+        self._committer = None
+        self._committer_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        return self.directory, self.max_bytes, self._index
+
+    def __setstate__(self, state):
+        self.directory, self.max_bytes, self._index = state
+        self._init_local()
+
+    def _path(self, file_name: str):
+        return os.path.join(self.directory, file_name)
+
+    def __contains__(self, track_id: str):
+        return track_id in self._index
+
+    @property
+    def size(self):
+        return sum(size for _, size in self._index.values())
+
+    def volume(self):
+        return self.size
+
+    def open(self, track_id: str):
+        """Returns the cached track, or None when it's not cached."""
+        with self._index.transact():
+            entry = self._index.pop(track_id, None)
+            if entry is not None:
+                # Move to the back of the LRU order
+                self._index[track_id] = entry
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            track = CachedTrack(self._path(entry[0]))
+        except (OSError, ValueError):
+            log.exception(f'Dropping unreadable cached track {track_id}')
+            self._index.pop(track_id, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return track
+
+    def writer(self, track_id: str, opus: bool = False):
+        return TrackWriter(self, track_id, opus)
+
+    def commit_later(self, writer: TrackWriter):
+        """Commits the writer on a background thread, keeps file and index work off the audio thread."""
+        with self._committer_lock:
+            if self._committer is None:
+                self._committer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='TrackCache commit')
+        self._committer.submit(self._commit, writer)
+
+    @staticmethod
+    def _commit(writer: TrackWriter):
+        try:
+            writer.commit()
+        except Exception:
+            log.exception(f'Failed to store track {writer.track_id}')
+            writer.abort()
+
+    def _store(self, track_id: str, tmp_path: str, size: int):
+        file_name = hashlib.sha1(track_id.encode()).hexdigest() + '.frames'
+        os.replace(tmp_path, self._path(file_name))
+        with self._index.transact():
+            self._index.pop(track_id, None)
+            self._index[track_id] = (file_name, size)
+            # The newest track always stays
+            self._evict(self.max_bytes, keep=1)
+
+    def evict_to(self, max_bytes: int):
+        """Evicts the least recently played tracks until the cache fits in `max_bytes`."""
+        with self._index.transact():
+            return self._evict(max_bytes)
+
+    def _evict(self, max_bytes: int, keep: int = 0):
+        # Must run inside an index transaction
+        total = self.size
+        evicted = 0
+        while total > max_bytes and len(self._index) > keep:
+            track_id, (file_name, size) = self._index.popitem(last=False)
+            total -= size
+            evicted += 1
+            try:
+                # Readers keep their mapping, the data is released when they close it
+                os.remove(self._path(file_name))
+            except OSError:
+                pass
+        self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        return {
+            'tracks': len(self._index),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        """Waits for pending commits."""
+        if self._committer is not None:
+            self._committer.shutdown(wait=True)
+            self._committer = None
@@ -0,0 +1,399 @@
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+from .player_base import PlayerBase
+
+log = logging.getLogger(__name__)
+
+FRAME_SLOT_SIZE = 3840  # One 20ms frame of stereo/i16/48KHz PCM, opus packets are smaller
+RING_SLOTS = 10  # Default amount of frames produced ahead of playback, 200ms
+WORKER_IDLE_WAIT = 0.005  # seconds a worker waits for commands when all rings are full
+QUEUE_RELEASE_TIMEOUT = 1.0  # seconds waited for a worker to let go of the play queue of a source
+
+_HEADER = struct.Struct('<QQQ')  # frames written, frames read, control calls completed
+# Payload length, 0 marks the end of the stream, whether the source idled and its position in ms, -1 when unknown
+_SLOT_HEADER = struct.Struct('<I?q')
+
+
+class SharedFrameRing:
+    """Ring of fixed size frame slots in shared memory, one producer process and one consumer process.
+
+    Both sides only advance their own counter in the header, so frames cross the process boundary
+    without locks or pickling. Every frame carries the state of the source when it was read, so the
+    consumer knows the state of what's audible.
+    """
+
+    def __init__(self, slots: int = RING_SLOTS, slot_size: int = FRAME_SLOT_SIZE, name: str = None):
+        self.slots = slots
+        self.slot_size = slot_size
+        self._stride = _SLOT_HEADER.size + slot_size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + slots * self._stride)
+            _HEADER.pack_into(self.shm.buf, 0, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+    def _counters(self):
+        written, read, _ = _HEADER.unpack_from(self.shm.buf, 0)
+        return written, read
+
+    def _slot_offset(self, index: int):
+        return _HEADER.size + (index % self.slots) * self._stride
+
+    @property
+    def free(self):
+        written, read = self._counters()
+        return self.slots - (written - read)
+
+    def put(self, frame, idle: bool = False, position: int = None):
+        """Producer side: stores one frame, the caller checks `free` first."""
+        if len(frame) > self.slot_size:
+            raise ValueError('frame does not fit in a slot')
+        written, _ = self._counters()
+        offset = self._slot_offset(written)
+        _SLOT_HEADER.pack_into(self.shm.buf, offset, len(frame), idle, -1 if position is None else position)
+        start = offset + _SLOT_HEADER.size
+        self.shm.buf[start:start + len(frame)] = frame
+        # Publish the frame only after its data is in place
+        struct.pack_into('<Q', self.shm.buf, 0, written + 1)
+
+    def get(self):
+        """Consumer side: returns the oldest frame with the idle flag and position stored along with it, as
+        (frame, idle, position). None when the ring is empty."""
+        written, read = self._counters()
+        if written == read:
+            return None
+        offset = self._slot_offset(read)
+        length, idle, position = _SLOT_HEADER.unpack_from(self.shm.buf, offset)
+        start = offset + _SLOT_HEADER.size
+        frame = bytes(self.shm.buf[start:start + length])
+        struct.pack_into('<Q', self.shm.buf, 8, read + 1)
+        return frame, idle, None if position < 0 else position
+
+    @property
+    def calls_done(self):
+        """Amount of control calls the producer side completed."""
+        return _HEADER.unpack_from(self.shm.buf, 0)[2]
+
+    def call_done(self):
+        """Producer side: counts one completed control call."""
+        struct.pack_into('<Q', self.shm.buf, 16, self.calls_done + 1)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _call_source(stream_id, source, ring, method, args):
+    try:
+        getattr(source, method)(*args)
+    except Exception:
+        log.exception(f'Call `{method}` failed on stream {stream_id}')
+    finally:
+        ring.call_done()
+
+
+def _worker_main(commands):
+    """Runs the sources placed on this worker, keeping their rings topped up."""
+    streams = {}
+    # Streams whose source is constructed on a helper thread, stream id -> (ring, calls made meanwhile).
+    # The calls are None once the stream is stopped.
+    building = {}
+    built = queue.Queue()
+
+    def build(stream_id, factory, f_args, f_kwargs):
+        try:
+            source = factory(*f_args, **f_kwargs)
+        except Exception:
+            log.exception(f'Failed to start stream {stream_id}')
+            source = None
+        built.put((stream_id, source))
+
+    while True:
+        try:
+            # Only block on commands when there's nothing else to do
+            command = commands.get(timeout=WORKER_IDLE_WAIT if streams or building else None)
+        except queue.Empty:
+            command = None
+
+        while command is not None:
+            action, stream_id, *args = command
+            if action == 'exit':
+                for source, ring in streams.values():
+                    source.cleanup()
+                    ring.close()
+                return
+            elif action == 'start':
+                name, slots, slot_size, factory, f_args, f_kwargs = args
+                try:
+                    ring = SharedFrameRing(slots, slot_size, name=name)
+                except Exception:
+                    log.exception(f'Failed to start stream {stream_id}')
+                else:
+                    # Constructing may take a while, eg logging in, the other streams are fed meanwhile
+                    building[stream_id] = (ring, [])
+                    threading.Thread(target=build, args=(stream_id, factory, f_args, f_kwargs),
+                                     name=f'Stream {stream_id} builder', daemon=True).start()
+            elif action == 'call':
+                method, m_args = args
+                if stream_id in building:
+                    building[stream_id][1].append((method, m_args))
+                elif stream_id in streams:
+                    source, ring = streams[stream_id]
+                    _call_source(stream_id, source, ring, method, m_args)
+                else:
+                    log.error(f'Call `{method}` on unknown stream {stream_id}')
+            elif action == 'stop':
+                if stream_id in building:
+                    # Cleaned up once it's constructed
+                    building[stream_id] = (building[stream_id][0], None)
+                else:
+                    source, ring = streams.pop(stream_id, (None, None))
+                    if source is not None:
+                        source.cleanup()
+                        ring.close()
+
+            try:
+                command = commands.get_nowait()
+            except queue.Empty:
+                command = None
+
+        while True:
+            try:
+                stream_id, source = built.get_nowait()
+            except queue.Empty:
+                break
+            ring, calls = building.pop(stream_id)
+            if source is None:
+                ring.close()
+            elif calls is None:
+                source.cleanup()
+                ring.close()
+            else:
+                streams[stream_id] = (source, ring)
+                for method, m_args in calls:
+                    _call_source(stream_id, source, ring, method, m_args)
+
+        for stream_id, (source, ring) in list(streams.items()):
+            ended = False
+            try:
+                while ring.free > 0 and not ended:
+                    frame = source.read()
+                    ring.put(frame, source.is_idle(), source.position())
+                    ended = not frame
+            except Exception:
+                log.exception(f'Stream {stream_id} crashed')
+                ended = True
+                if ring.free > 0:
+                    ring.put(b'')
+            if ended:
+                del streams[stream_id]
+                source.cleanup()
+                ring.close()
+
+
+class PooledSource(PlayerBase):
+    """Stand-in for a source running inside an audio worker process.
+
+    Reads copy frames out of the shared ring, control methods are forwarded to the worker. Whether the
+    source idles and its position come along with the frames, as of the last frame read.
+
+    When its worker dies the source is constructed again in a new worker, and resumed when it played.
+    It starts over from what it's constructed with, eg the persisted queue of a Spotify player: the
+    track that played and the position within it are lost.
+    """
+
+    def __init__(self, pool, stream_id: int, ring: SharedFrameRing, opus: bool = False):
+        self._pool = pool
+        self._stream_id = stream_id
+        self._ring = ring
+        self._opus = opus
+        self._silence = b'\xf8\xff\xfe' if opus else bytes(ring.slot_size)
+        self._idle = False
+        self._position = None
+        self.underruns = 0
+        # Control calls made, the worker counts the ones it completed in the ring
+        self._calls = 0
+        self._released = False
+
+    def read(self):
+        slot = self._ring.get()
+        if slot is None:
+            # The worker fell behind
+            self.underruns += 1
+            return self._silence
+        frame, self._idle, self._position = slot
+        return frame
+
+    def is_opus(self):
+        return self._opus
+
+    def is_idle(self):
+        return self._idle
+
+    def position(self):
+        return self._position
+
+    def stats(self):
+        # Stats of the source itself stay inside the worker
+        return {'underruns': self.underruns}
+
+    def cleanup(self):
+        self._released = True
+        self._pool.release(self._stream_id)
+
+    def _call(self, method: str, *args):
+        self._calls += 1
+        self._pool.call(self._stream_id, method, *args)
+
+    def skip(self, amount: int):
+        self._call('skip', amount)
+
+    def previous(self, amount: int):
+        self._call('previous', amount)
+
+    def seek(self, position: int):
+        self._call('seek', position)
+
+    def resume(self):
+        self._call('resume')
+
+    def pause(self):
+        self._call('pause')
+
+    def stop(self):
+        self._call('stop')
+
+    def queue(self, arg: str):
+        self._call('queue', arg)
+
+    def release_queue(self):
+        if self._released:
+            # Its worker cleaned it up, which released the queue as well
+            return
+        self._call('release_queue')
+        # The source replacing this one may only read the queue once the worker let go of it
+        deadline = time.monotonic() + QUEUE_RELEASE_TIMEOUT
+        while not self._released and self._ring.calls_done < self._calls:
+            if time.monotonic() > deadline:
+                log.warning(f'Stream {self._stream_id} didn\'t release its queue in time')
+                return
+            time.sleep(WORKER_IDLE_WAIT)
+
+
+class _Worker:
+    def __init__(self, context):
+        self.commands = context.Queue()
+        self.process = context.Process(target=_worker_main, args=(self.commands,), daemon=True)
+        self.process.start()
+        self.streams = set()
+
+
+class AudioWorkerPool:
+    """Runs sources in worker processes, so decoding and resampling of different guilds
+    don't compete for the GIL of the bot process.
+
+    New sources are placed on the worker with the least streams. When a worker dies, it's replaced
+    and the sources it ran are constructed again, see `PooledSource`.
+    """
+
+    def __init__(self, processes: int = None, slots: int = RING_SLOTS):
+        self.slots = slots
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [_Worker(self._context) for _ in range(processes or os.cpu_count())]
+        self._streams = {}  # stream id -> (worker, ring, factory, args, kwargs)
+        # Streams resumed since they were paused or stopped last, resumed again after a restart
+        self._resumed = set()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._monitor = threading.Thread(target=self._monitor_workers, name='Audio pool monitor', daemon=True)
+        self._monitor.start()
+
+    def spawn(self, factory, *args, opus: bool = False, **kwargs):
+        """Constructs `factory(*args, **kwargs)` inside the least loaded worker.
+        The factory and its arguments must be picklable, eg a PlayerBase subclass.
+        """
+        ring = SharedFrameRing(self.slots)
+        with self._lock:
+            stream_id = next(self._ids)
+            worker = min(self._workers, key=lambda w: len(w.streams))
+            worker.streams.add(stream_id)
+            self._streams[stream_id] = (worker, ring, factory, args, kwargs)
+            self._start(worker, stream_id)
+        return PooledSource(self, stream_id, ring, opus=opus)
+
+    def _start(self, worker, stream_id):
+        _, ring, factory, args, kwargs = self._streams[stream_id]
+        worker.commands.put(('start', stream_id, ring.name, ring.slots, ring.slot_size, factory, args, kwargs))
+
+    def call(self, stream_id: int, method: str, *args):
+        with self._lock:
+            worker = self._streams[stream_id][0]
+            worker.commands.put(('call', stream_id, method, args))
+            if method == 'resume':
+                self._resumed.add(stream_id)
+            elif method in ('pause', 'stop'):
+                self._resumed.discard(stream_id)
+
+    def release(self, stream_id: int):
+        """Stops the stream and frees its shared memory."""
+        with self._lock:
+            entry = self._streams.pop(stream_id, None)
+            if entry is None:
+                return
+            worker, ring = entry[0], entry[1]
+            worker.streams.discard(stream_id)
+            self._resumed.discard(stream_id)
+            worker.commands.put(('stop', stream_id))
+        ring.unlink()
+
+    def stats(self):
+        """Amount of streams per worker process."""
+        with self._lock:
+            return [len(w.streams) for w in self._workers]
+
+    def _monitor_workers(self):
+        while not self._closed:
+            sentinels = {w.process.sentinel: w for w in self._workers}
+            ready = multiprocessing.connection.wait(list(sentinels), timeout=1.0)
+            if self._closed:
+                return
+            for sentinel in ready:
+                self._restart(sentinels[sentinel])
+
+    def _restart(self, dead):
+        log.warning(f'Audio worker {dead.process.pid} died (exit code {dead.process.exitcode}), restarting it')
+        with self._lock:
+            worker = _Worker(self._context)
+            self._workers[self._workers.index(dead)] = worker
+            for stream_id in dead.streams:
+                worker.streams.add(stream_id)
+                self._streams[stream_id] = (worker,) + self._streams[stream_id][1:]
+                self._start(worker, stream_id)
+                if stream_id in self._resumed:
+                    worker.commands.put(('call', stream_id, 'resume', ()))
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            for worker in self._workers:
+                worker.commands.put(('exit', None))
+            for worker in self._workers:
+                worker.process.join(timeout=1.0)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            for stream_id in list(self._streams):
+                self._streams.pop(stream_id)[1].unlink()
@@ -1,19 +1,33 @@
 import sys
+import time
 import logging
 import importlib
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from types import ModuleType
 
 import discord
 from discord.ext import commands
-from unidecode import unidecode
 
-from bot import PinguBot
+from bot import PinguBot, ReloadableCog
+from util import metrics, ChannelIndex
 
-from .players import PlayerBase, UnknownPlayerError, ControlBase
-from .players.stub import StubSource
+from .players import PlayerBase, WrappedSource, UnknownPlayerError, ControlBase, OpusEncodedSource
+from .players.dsp import DspSource
+from .players.broadcast import Broadcast, BroadcastSubscriber
+from .players.metered import MeteredSource
+from .players.stub import StubSource, SilenceSource
+from .players.worker_pool import AudioWorkerPool
 
 log = logging.getLogger(__name__)
 
+SOURCE_RELEASE_DELAY = 0.1  # seconds
+VOICE_OPERATION_TIMEOUT = 15.0  # Default seconds a join, attach or leave may take
+SOURCE_BUILDERS = 4  # Threads building sources whose player blocks while spawning them
+IDLE_CHECK_INTERVAL = 1.0  # seconds between checking whether attached players idle
+SEEK_LATENCY_WAIT = 5.0  # seconds waited for a seek to complete before replying
+
 
 class NoVoiceStateError(discord.ClientException):
     pass
@@ -23,16 +37,100 @@ class NoPlayerError(discord.ClientException):
     pass
 
 
-class Voice:
+def _parse_position(text: str):
+    """Parses `[m:]ss` into milliseconds. A leading + or - makes the position relative, returns (ms, sign)."""
+    sign = 0
+    if text[:1] in '+-':
+        sign = 1 if text[0] == '+' else -1
+        text = text[1:]
+    seconds = 0
+    for part in text.split(':'):
+        seconds = seconds * 60 + float(part)
+    return int(seconds * 1000), sign
+
+
+def _origin(source):
+    """Returns the source producing the audio of `source`, looking through processing stages and broadcasts."""
+    while True:
+        if isinstance(source, WrappedSource):
+            source = source.source
+        elif isinstance(source, BroadcastSubscriber):
+            source = source.broadcast.source
+        else:
+            return source
+
+
+def _cleanup_built_source(building):
+    if not building.cancelled() and building.exception() is None:
+        building.result().cleanup()
+
+
+class VoiceScheduler:
+    """Runs the voice operations of a guild one at a time, in order. Operations of different guilds run
+    concurrently. Operations taking longer than `timeout` seconds are cancelled, raising asyncio.TimeoutError.
+    """
+
+    def __init__(self, timeout: float = VOICE_OPERATION_TIMEOUT):
+        self.timeout = timeout
+        self._locks = {}
+        # Operations running or waiting per guild, locks of guilds without any are dropped
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    async def run(self, guild_id: int, operation, *args):
+        """Awaits `operation(*args)` once the earlier operations of the guild finished."""
+        lock = self._locks.get(guild_id, None)
+        if lock is None:
+            lock = self._locks[guild_id] = asyncio.Lock()
+        self._pending[guild_id] = self._pending.get(guild_id, 0) + 1
+        try:
+            async with lock:
+                return await asyncio.wait_for(operation(*args), self.timeout)
+        finally:
+            self._pending[guild_id] -= 1
+            if not self._pending[guild_id]:
+                del self._pending[guild_id]
+                del self._locks[guild_id]
+
+
+class Voice(ReloadableCog):
     """Commands for attaching the bot to voice channels"""
+    # Reloading keeps voice clients connected and playing, with their players loaded and operations ordered
+    kept_on_reload = ('_voice_states', '_players', '_player_modules', '_player_loads', '_worker_pool', '_broadcasts',
+                      '_scheduler', '_builders', '_channel_indexes', '_idle_since', '_idle_paused')
 
-    def __init__(self, bot, players: dict):
+    def __init__(self, bot, players: dict, worker_pool: AudioWorkerPool = None, player_modules: dict = None):
         self.bot = bot
         self._voice_states = {}
         self._players = players
+        # Players by name whose extension is loaded on their first attach, see `_get_player`
+        self._player_modules = dict(player_modules or {})
+        self._player_loads = {}
+        self._worker_pool = worker_pool
+        self._broadcasts = {}
+        self._idle_timeout = getattr(bot.config, 'VOICE_IDLE_TIMEOUT', 5.0)
+        # Guild id -> loop time since when its player idles, and guilds whose voice state is paused for idling
+        self._idle_since = {}
+        self._idle_paused = set()
+        self._idle_check = bot.loop.call_later(IDLE_CHECK_INTERVAL, self._check_idle)
+        self._scheduler = VoiceScheduler(getattr(bot.config, 'VOICE_OPERATION_TIMEOUT', VOICE_OPERATION_TIMEOUT))
+        self._builders = ThreadPoolExecutor(max_workers=SOURCE_BUILDERS, thread_name_prefix='Voice source')
+        # Voice channel names per guild id, indexed on the first join and kept current by channel events
+        self._channel_indexes = {}
+
+    def __unload(self):
+        # The cog of a reloaded extension checks on its own
+        self._idle_check.cancel()
+        if self._handed_over:
+            return
+        self._builders.shutdown(wait=False)
+        if self._worker_pool is not None:
+            self._worker_pool.close()
 
     @staticmethod
-    def register_player(bot: PinguBot, name: str, player_module):
+    def register_player(bot: PinguBot, name: str, player_module, worker_pool: AudioWorkerPool = None):
         if not isinstance(player_module, ModuleType):
             raise ValueError('player_module')
         cogs = bot.get_loaded_cogs_for_module(player_module)
@@ -40,9 +138,104 @@ class Voice:
             raise ValueError('Need class spawning AudioSource objects!')
         control_instance = cogs[0]
         if not isinstance(control_instance, ControlBase): raise ValueError('Not a control object')
+        control_instance.worker_pool = worker_pool
         # Store the spawn_source object as callback for later use
         return name, control_instance.spawn_source
 
+    async def _get_player(self, name: str):
+        """Returns the builder of the player, loading its extension when it's attached the first time."""
+        builder = self._players.get(name, None)
+        if builder is not None:
+            return builder
+        if name not in self._player_modules:
+            raise UnknownPlayerError()
+
+        lock = self._player_loads.get(name, None)
+        if lock is None:
+            lock = self._player_loads[name] = asyncio.Lock()
+        async with lock:
+            if name not in self._players:
+                module_name = self._player_modules[name]
+                log.info(f'Loading player `{name}`..')
+                start = time.perf_counter()
+                # Players import numpy, scipy, librespot..., which takes seconds. Importing them off the event
+                # loop leaves only the extension setup for the loop.
+                try:
+                    await self.bot.loop.run_in_executor(None, importlib.import_module, module_name)
+                except ImportError:
+                    log.exception(f'Failed to load player `{name}`')
+                    del self._player_modules[name]
+                    raise UnknownPlayerError()
+                builder = _load_player(self.bot, name, module_name, self._worker_pool)
+                if builder is None:
+                    del self._player_modules[name]
+                    raise UnknownPlayerError()
+                self._players[name] = builder
+                log.info(f'Loaded player `{name}` in {time.perf_counter() - start:.2f} s')
+        return self._players[name]
+
+    def _check_idle(self):
+        """Pauses voice states whose player idled for the idle timeout, like the stub player ends its stream. They
+        send no frames and turn speaking off meanwhile. Resumes them once their player has something to play."""
+        try:
+            now = self.bot.loop.time()
+            for guild_id, state in list(self._voice_states.items()):
+                try:
+                    self._check_guild_idle(guild_id, state, now)
+                except Exception:
+                    log.exception(f'Checking whether guild {guild_id} idles failed')
+        finally:
+            self._idle_check = self.bot.loop.call_later(IDLE_CHECK_INTERVAL, self._check_idle)
+
+    def _check_guild_idle(self, guild_id: int, state, now: float):
+        source = state.source
+        if not isinstance(source, PlayerBase) or isinstance(source, SilenceSource):
+            return
+        idle = source.is_idle()
+        if state.is_playing():
+            if not idle:
+                self._idle_since.pop(guild_id, None)
+            elif now - self._idle_since.setdefault(guild_id, now) >= self._idle_timeout:
+                state.pause()
+                self._idle_since.pop(guild_id, None)
+                self._idle_paused.add(guild_id)
+        elif guild_id in self._idle_paused and not idle:
+            self._idle_paused.discard(guild_id)
+            state.resume()
+
+    def _channel_index(self, guild: discord.Guild) -> ChannelIndex:
+        index = self._channel_indexes.get(guild.id, None)
+        if index is None:
+            index = self._channel_indexes[guild.id] = ChannelIndex(guild.voice_channels)
+        return index
+
+    async def on_guild_channel_create(self, channel):
+        index = self._channel_indexes.get(channel.guild.id, None)
+        if index is not None and isinstance(channel, discord.VoiceChannel):
+            index.add(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        await self.on_guild_channel_create(after)
+
+    async def on_guild_channel_delete(self, channel):
+        index = self._channel_indexes.get(channel.guild.id, None)
+        if index is not None:
+            index.remove(channel.id)
+
+    async def on_extension_reloaded(self, name: str):
+        # Loaded players of the extension spawn sources through its new control object
+        for player, module_name in self._player_modules.items():
+            if module_name == name and player in self._players:
+                _, self._players[player] = Voice.register_player(self.bot, player, self.bot.extensions[name],
+                                                                 self._worker_pool)
+
+    async def on_guild_remove(self, guild):
+        self._channel_indexes.pop(guild.id, None)
+
+    async def on_ready(self):
+        # Channel events missed while disconnected aren't replayed, index again on the next join
+        self._channel_indexes.clear()
+
     def _get_voice_state(self, guild: discord.Guild):
         state = self._voice_states.get(guild.id, None)
         if not state:
@@ -54,6 +247,8 @@ class Voice:
         state = self._voice_states.pop(guild.id, None)
         if not state:
             raise NoVoiceStateError()
+        self._idle_since.pop(guild.id, None)
+        self._idle_paused.discard(guild.id)
 
         await state.disconnect()
 
@@ -62,10 +257,13 @@ class Voice:
             raise ValueError('channel is None')
 
         guild_id = channel.guild.id
+        if guild_id in self._voice_states:
+            await self._voice_states[guild_id].move_to(channel)
+            return self._voice_states[guild_id]
         try:
             client = await channel.connect()
-            # Add stub player to voice state
-            client.play(StubSource())
+            # Add stub player to voice state, it stops sending frames after the idle timeout
+            client.play(SilenceSource(self._idle_timeout))
             # Pause the player.. now we can freely interchange sources within
             # the player (within the voice state)
             client.pause()
@@ -81,36 +279,95 @@ class Voice:
         if not player_str:
             raise commands.MissingRequiredArgument('player')
 
-        if player_str not in self._players:
-            raise UnknownPlayerError()
+        # Fail before loading a player or building a source nothing would play
+        self._get_voice_state(guild)
+        builder = await self._get_player(player_str)
+        player = await self._build_shielded(guild, builder)
+        try:
+            self._play_source(guild, player)
+        except:
+            player.cleanup()
+            raise
 
-        player_builder = self._players[player_str]
-        player = player_builder(guild=guild)
+    async def _overlay_source(self, guild: discord.Guild, player_str: str):
+        state = self._get_voice_state(guild)
+        dsp = state.source.find(DspSource) if isinstance(state.source, WrappedSource) else None
+        if dsp is None:
+            return 'The attached player doesn\'t support mixing'
+        builder = await self._get_player(player_str)
+        # The DSP stage of the attached source processes the mix
+        overlay = await self._build_shielded(guild, builder, processed=False)
+        try:
+            dsp.add_overlay(overlay)
+        except ValueError:
+            overlay.cleanup()
+            return f'The source `{player_str}` can\'t be mixed in'
+        overlay.resume()
+        return f'Mixing in `{player_str}`'
+
+    async def _build_shielded(self, guild: discord.Guild, player_builder, processed: bool = True):
+        building = asyncio.ensure_future(self._build_source(guild, player_builder, processed), loop=self.bot.loop)
+        try:
+            # Builders in threads can't be cancelled, a source finished after a timeout is cleaned up
+            return await asyncio.shield(building)
+        except asyncio.CancelledError:
+            building.add_done_callback(_cleanup_built_source)
+            raise
+
+    async def _build_source(self, guild: discord.Guild, player_builder, processed: bool = True):
+        if asyncio.iscoroutinefunction(player_builder):
+            player = await player_builder(guild=guild)
+        else:
+            # Spawning may block, eg while logging in
+            player = await self.bot.loop.run_in_executor(self._builders, functools.partial(player_builder, guild=guild))
         # The following also tests against None
         if not isinstance(player, PlayerBase):
             raise Exception()
-
+        if not processed:
+            return player
+        if getattr(self.bot.config, 'AUDIO_DSP', False) and not player.is_opus():
+            player = DspSource(player)
+        # Move encoding off discord's audio thread
+        if getattr(self.bot.config, 'PRE_ENCODE_OPUS', False) and not player.is_opus():
+            player = OpusEncodedSource(player)
+        return player
+
+    def _play_source(self, guild: discord.Guild, player: PlayerBase, cleanup_previous: bool = True):
         state = self._get_voice_state(guild)
+        if metrics.registry.enabled:
+            player = MeteredSource(player, guild.id)
+        if not state.is_playing() and not state.is_paused():
+            # The audio player stopped after idling, start a new one right away
+            state.play(player)
+            return
+
         was_playing = state.is_playing()
+        previous = state.source
         # State auto pauses and resumes
         state.source = player
         if not was_playing:
             state.pause()
+        if cleanup_previous and previous is not player:
+            # Swapping doesn't clean up the previous source. The audio thread may still be in the middle
+            # of reading it, give it a frame to finish.
+            self.bot.loop.call_later(SOURCE_RELEASE_DELAY, previous.cleanup)
 
     @commands.command()
     @commands.guild_only()
     async def join(self, ctx, *, channel: str):
-        """Joins a voice channel."""
-        all_channels = ctx.guild.voice_channels
-        target_channel = next(
-            filter(lambda x: unidecode(x.name).strip().startswith(channel), all_channels),
-            None)
+        """Joins a voice channel, the name may be abbreviated or misspelled."""
+        target_channel = self._channel_index(ctx.guild).best(channel)
+        if target_channel is None:
+            await ctx.send(f'No voice channel is called like `{channel}`...')
+            return
         try:
-            await self._build_voice_state_or_move(target_channel)
+            await self._scheduler.run(ctx.guild.id, self._build_voice_state_or_move, target_channel)
         except discord.InvalidArgument:
             await ctx.send('This is not a voice channel...')
         except discord.ClientException:
             await ctx.send('Already in a voice channel...')
+        except asyncio.TimeoutError:
+            await ctx.send('Joining took too long, try again')
 
     @commands.command()
     @commands.guild_only()
@@ -126,17 +383,22 @@ class Voice:
             return
 
         try:
-            await self._build_voice_state_or_move(summoned_channel)
+            await self._scheduler.run(ctx.guild.id, self._build_voice_state_or_move, summoned_channel)
         except discord.InvalidArgument:
             await ctx.send('This is not a voice channel...')
         except discord.ClientException:
             await ctx.send('Already in a voice channel...')
+        except asyncio.TimeoutError:
+            await ctx.send('Joining took too long, try again')
 
     @commands.command()
     @commands.guild_only()
     async def leave(self, ctx):
         """Stops playing music and the bot will leave the voice channel."""
-        await self._remove_voice_state(ctx.guild)
+        try:
+            await self._scheduler.run(ctx.guild.id, self._remove_voice_state, ctx.guild)
+        except asyncio.TimeoutError:
+            await ctx.send('Leaving took too long, try again')
 
     @commands.command()
     @commands.guild_only()
@@ -146,6 +408,7 @@ class Voice:
             state = self._get_voice_state(ctx.guild)
             if state.source:
                 state.source.resume()
+                self._idle_paused.discard(ctx.guild.id)
                 state.resume()
         except NoVoiceStateError:
             await ctx.send('I\'m not currently in a voice channel')
@@ -160,38 +423,178 @@ class Voice:
         except NoVoiceStateError:
             await ctx.send('I\'m not in a voice channel currently')
 
+    @commands.command()
+    @commands.guild_only()
+    async def volume(self, ctx, percentage: int):
+        """Changes the volume of the attached player."""
+        try:
+            state = self._get_voice_state(ctx.guild)
+            dsp = state.source.find(DspSource) if isinstance(state.source, WrappedSource) else None
+            if dsp is None:
+                await ctx.send('The attached player doesn\'t support changing volume')
+                return
+            dsp.volume = max(0, min(percentage, 200)) / 100
+            await ctx.send(f'Volume set to {int(dsp.volume * 100)}%')
+        except NoVoiceStateError:
+            await ctx.send('I\'m not in a voice channel currently')
+
+    @commands.command()
+    @commands.guild_only()
+    async def seek(self, ctx, position: str):
+        """Continues the current song at the position, eg `1:23`, or relative to it, eg `+10` or `-10`."""
+        try:
+            target, sign = _parse_position(position)
+        except ValueError:
+            await ctx.send(f'`{position}` is not a position, use eg `1:23` or `+10`')
+            return
+        try:
+            await ctx.send(await self._scheduler.run(ctx.guild.id, self._seek, ctx.guild, target, sign))
+        except NotImplementedError:
+            await ctx.send('The attached player doesn\'t support seeking')
+        except NoVoiceStateError:
+            await ctx.send('I\'m not in a voice channel currently')
+        except asyncio.TimeoutError:
+            await ctx.send('Seeking took too long, try again')
+
+    async def _seek(self, guild: discord.Guild, target: int, sign: int):
+        state = self._get_voice_state(guild)
+        origin = _origin(state.source)
+        if not isinstance(origin, PlayerBase) or isinstance(origin, StubSource):
+            # Stub and silence sources accept seeking without doing anything
+            raise NotImplementedError()
+        if sign:
+            current = state.source.position()
+            if current is None:
+                return 'The attached player doesn\'t know its position'
+            target = max(0, current + sign * target)
+
+        # Players measuring seeks report the time until audio at the new position is available
+        measured = hasattr(origin, 'last_seek_latency')
+        if measured:
+            origin.last_seek_latency = None
+        state.source.seek(target)
+        minutes, seconds = divmod(target // 1000, 60)
+        reply = f'Continuing at {minutes}:{seconds:02}'
+        if not measured or not state.is_playing():
+            return reply
+
+        deadline = self.bot.loop.time() + SEEK_LATENCY_WAIT
+        while origin.last_seek_latency is None and self.bot.loop.time() < deadline:
+            await asyncio.sleep(0.02)
+        if origin.last_seek_latency is None:
+            return f'{reply} (still loading)'
+        return f'{reply} (took {origin.last_seek_latency * 1000:.1f}ms)'
+
+    @commands.command()
+    @commands.guild_only()
+    async def broadcast(self, ctx, name: str):
+        """Shares the attached player, other servers can tune in to it by name."""
+        try:
+            await ctx.send(await self._scheduler.run(ctx.guild.id, self._share, ctx.guild, name))
+        except NoVoiceStateError:
+            await ctx.send('I\'m not in a voice channel currently')
+        except asyncio.TimeoutError:
+            await ctx.send('The voice connection is busy, try again')
+
+    async def _share(self, guild: discord.Guild, name: str):
+        state = self._get_voice_state(guild)
+        if name in self._broadcasts:
+            return f'The broadcast `{name}` already exists!'
+        if not isinstance(state.source, PlayerBase) or isinstance(state.source, SilenceSource):
+            return 'Attach a player first!'
+        source = state.source
+        if isinstance(source, MeteredSource):
+            # The subscriber of this guild gets metered instead
+            source = source.release()
+        shared = Broadcast(source, name, on_close=lambda b: self._broadcasts.pop(b.name, None))
+        self._broadcasts[name] = shared
+        # The broadcast owns the source now
+        self._play_source(guild, shared.subscribe(), cleanup_previous=False)
+        return f'Broadcasting as `{name}`'
+
+    @commands.command()
+    @commands.guild_only()
+    async def tune(self, ctx, name: str):
+        """Plays the broadcast with the specified name in this server."""
+        try:
+            shared = self._broadcasts.get(name, None)
+            if shared is None:
+                await ctx.send(f'The broadcast `{name}` doesn\'t exist!')
+                return
+            await self._scheduler.run(ctx.guild.id, self._tune_in, ctx.guild, shared)
+            await ctx.send(f'Tuned in to `{name}`')
+        except NoVoiceStateError:
+            await ctx.send('I\'m not in a voice channel currently')
+        except asyncio.TimeoutError:
+            await ctx.send('The voice connection is busy, try again')
+
+    async def _tune_in(self, guild: discord.Guild, shared: Broadcast):
+        # Subscribing only after the voice state is known, a subscriber nothing plays would hold the broadcast
+        self._get_voice_state(guild)
+        self._play_source(guild, shared.subscribe())
+
     @commands.command()
     @commands.guild_only()
     async def attach(self, ctx, source: str):
         """Attaches the specified player to the current voice state"""
         try:
-            await self._attach_source(ctx.guild, source)
+            await self._scheduler.run(ctx.guild.id, self._attach_source, ctx.guild, source)
             await ctx.send(f'The source `{source}` succesfully attached!')
         except UnknownPlayerError:
             await ctx.send(f'The source `{source}` doesn\'t exist!')
         except NoVoiceStateError:
             await ctx.send('I\'m not in a voice channel currently')
+        except asyncio.TimeoutError:
+            await ctx.send(f'Building a `{source}` source took too long')
         except:
             await ctx.send('Encountered an issue while building a `{player}` source..')
 
+    @commands.command()
+    @commands.guild_only()
+    async def overlay(self, ctx, source: str):
+        """Mixes the specified player on top of the attached one until it ends, eg sound effects over music."""
+        try:
+            await ctx.send(await self._scheduler.run(ctx.guild.id, self._overlay_source, ctx.guild, source))
+        except UnknownPlayerError:
+            await ctx.send(f'The source `{source}` doesn\'t exist!')
+        except NoVoiceStateError:
+            await ctx.send('I\'m not in a voice channel currently')
+        except asyncio.TimeoutError:
+            await ctx.send(f'Building a `{source}` source took too long')
+
 
 def setup(bot):
     """Setup handlers in this module for the provided bot."""
-    log.info('Loading whitelisted players..')
-    players_whitelist = bot.config.PLAYERS_WHITELIST
-    players = {}
-    for player in set(players_whitelist.keys()):
-        player_module = players_whitelist[player]
-        try:
-            bot.load_extension(player_module)
-            try:
-                player_lib = bot.extensions[player_module]
-                name, builder = Voice.register_player(bot, player, player_lib)
-                players[name] = builder
-            except:
-                bot.unload_extension(player_module)
-        except (discord.ClientException, ImportError):
-            log.exception(f'Failed to load player `{player}`')
-
-    voice_ext = Voice(bot, players)
+    state = bot.take_over('Voice')
+    if state is not None:
+        voice_ext = Voice(bot, state['_players'], state['_worker_pool'])
+        voice_ext.take_over(state)
+        bot.add_cog(voice_ext)
+        return
+
+    worker_pool = None
+    audio_workers = getattr(bot.config, 'AUDIO_WORKERS', 0)
+    if audio_workers:
+        log.info('Starting audio worker pool..')
+        # `True` means one worker per core
+        worker_pool = AudioWorkerPool(None if audio_workers is True else audio_workers)
+
+    # Players are registered by name, loading them is left to their first attach
+    voice_ext = Voice(bot, {}, worker_pool, player_modules=bot.config.PLAYERS_WHITELIST)
     bot.add_cog(voice_ext)
+
+
+def _load_player(bot, name: str, module_name: str, worker_pool: AudioWorkerPool = None):
+    """Loads the player extension and returns its builder, None when it fails."""
+    try:
+        bot.load_extension(module_name)
+    except (discord.ClientException, ImportError):
+        log.exception(f'Failed to load player `{name}`')
+        return None
+    try:
+        _, builder = Voice.register_player(bot, name, bot.extensions[module_name], worker_pool)
+        return builder
+    except:
+        log.exception(f'Failed to register player `{name}`')
+        bot.unload_extension(module_name)
+        return None
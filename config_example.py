@@ -6,7 +6,22 @@ NOOT NOOT! Development Pingu bot!
 """
 
 ENABLE_VOICE = True
+# Volume control, overlays and loudness normalization for attached players
+AUDIO_DSP = True
+# Encode audio to Opus on a worker per source, instead of on discord's audio thread
+PRE_ENCODE_OPUS = True
+# Seconds of silence sent by idle voice states and idle players before they stop sending audio
+VOICE_IDLE_TIMEOUT = 5.0
+# Seconds a join, attach or leave may take, operations of a guild run one at a time
+VOICE_OPERATION_TIMEOUT = 15.0
+# Processes decoding/resampling audio sources; 0 runs sources inside the bot process, True uses one per core
+AUDIO_WORKERS = 0
+# Measure the audio and command pipelines, the owner reads them with the `metrics` command
+METRICS = False
+# Also serve the metrics on this localhost port in the Prometheus text format, None disables
+METRICS_PORT = None
 
+# Players by name, each is loaded the first time it's attached
 PLAYERS_WHITELIST = {
     'spotify': 'cogs.players.spotify.control',
 }
@@ -21,5 +36,40 @@ SPOT_PLAYER = {
     'tmp_credentials': {
         'username': 'todo',
         'password': 'todo'
-    }
+    },
+    # Store designed resampling filters in the global cache
+    'persist_filters': True,
+    # Audio buffered ahead of playback, in 20ms frames. The next track loads while this plays,
+    # so keep it above the time librespot needs to load a track for gapless transitions.
+    'buffer_frames': 50,
+    # Milliseconds the end of a track is mixed with the start of the next one, 0 disables.
+    # Cross-fading logs in a second session per guild, which fetches the start of the next track ahead.
+    'crossfade_ms': 0,
+    # Megabytes of resampled tracks kept on disk, replays skip librespot and resampling. 0 disables.
+    # Tracks are not recorded while cross-fading.
+    'track_cache_mb': 2048,
+    # Librespot sessions are logged in ahead of time and reused after guilds detach, so attaching doesn't
+    # wait for a login. With AUDIO_WORKERS every source logs in inside its worker instead.
+    'sessions': {
+        # Most idle sessions kept for reuse, 0 disables pooling
+        'pool_size': 4,
+        # Idle sessions kept logged in at all times
+        'warm': 1,
+        # Seconds the other idle sessions are kept
+        'idle_ttl': 10 * 60,
+    },
+    # Looks up albums, playlists and searches when queueing. 'web' uses the Spotify Web API with the
+    # credentials of an app registered at developer.spotify.com, 'stub' is a local catalog for testing.
+    # Leave out to only queue tracks by id.
+    'metadata': {
+        'provider': 'web',
+        'client_id': 'todo',
+        'client_secret': 'todo',
+        # Lookups running at the same time
+        'concurrency': 8,
+        # Seconds lookups are remembered
+        'ttl': 24 * 60 * 60,
+        # Megabytes of remembered lookups, least recently used ones are evicted first
+        'cache_mb': 64,
+    },
 }
\ No newline at end of file
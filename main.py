@@ -3,17 +3,21 @@
 import asyncio
 import logging
 import contextlib
+import importlib.util
+import os
+import time
+
+STARTED = time.perf_counter()
 
 import click
-import discord
 
-import util
-from bot import PinguBot
+STARTUP_PROFILE_TOP = 25  # slowest modules reported by `--profile_startup`
 
 
 @contextlib.contextmanager
 def setup_logging():
     """Method available in `with` syntax to construct and destruct logging infrastructure."""
+    import util
     try:
         # Setup logging
         # Print all errors and higher, for all modules, to console.
@@ -41,30 +45,54 @@ def setup_logging():
 
 
 @contextlib.contextmanager
-def setup_cache(cache_path):
+def setup_cache(cache_path, cache_mb=None):
     """Method available in `with` syntax to setup/tear down caching infrastructure."""
+    import util
     cache_manager = None
     try:
-        cache_manager = util.CacheManager(cache_path)
+        cache_manager = util.CacheManager(cache_path, max_bytes=cache_mb * 1024 ** 2 if cache_mb else None)
         yield cache_manager
     finally:
-        cache_manager.cleanup()
+        if cache_manager is not None:
+            cache_manager.cleanup()
 
 
 @click.group(invoke_without_command=True)
 @click.option('--tmp_path', default=None, help='Location of cache files.')
+@click.option('--cache_mb', default=None, type=int, help='Megabytes all cache files together may use.')
+@click.option('--profile_startup', is_flag=True, help='Report the import time per module and the time until ready.')
 @click.pass_context
-def main(ctx, tmp_path):
+def main(ctx, tmp_path, cache_mb, profile_startup):
     if ctx.invoked_subcommand is None:
+        import_timer = None
+        if profile_startup:
+            import_timer = _import_timer()
+            import_timer.install()
         # Attaches the event loop to this thread
         event_loop = asyncio.get_event_loop()
-        with setup_logging(), setup_cache(tmp_path) as cache_manager:
-            run_bot(cache_manager)
+        with setup_logging(), setup_cache(tmp_path, cache_mb) as cache_manager:
+            run_bot(cache_manager, import_timer)
+
+
+def _import_timer():
+    """Loads the ImportTimer on its own. Importing it from the `util` package would import util, diskcache,
+    numpy... before the timer could measure them; util is imported once the timer is installed."""
+    spec = importlib.util.spec_from_file_location(
+        'import_timer', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'util', 'import_timer.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.ImportTimer()
+
 
+def run_bot(cache_manager, import_timer=None):
+    # Imported here, so profiling the startup measures them as well
+    import discord
+    from bot import PinguBot
 
-def run_bot(cache_manager):
     # Setup the bot, it will automatically use the discord logger.
     bot = PinguBot(cache_manager)
+    if import_timer is not None:
+        profile_startup(bot, import_timer)
 
     # Make sure everything is setup to join/send data to voice channels.
     if bot.config.ENABLE_VOICE:
@@ -76,5 +104,23 @@ def run_bot(cache_manager):
     bot.run()
 
 
+def profile_startup(bot, import_timer):
+    """Reports the slowest imports and the time taken until the bot is ready, once it's ready the first time."""
+    constructed = time.perf_counter() - STARTED
+
+    async def report():
+        bot.remove_listener(report, 'on_ready')
+        ready = time.perf_counter() - STARTED
+        import_timer.uninstall()
+        click.echo(f'Startup: bot set up after {constructed:.2f} s, ready after {ready:.2f} s, '
+                   f'{import_timer.total:.2f} s of it importing {len(import_timer.modules)} modules')
+        click.echo(f'{"cumulative":>10} {"self":>10}  module')
+        for name, self_time, cumulative in import_timer.slowest(STARTUP_PROFILE_TOP):
+            click.echo(f'{cumulative * 1000:8.1f}ms {self_time * 1000:8.1f}ms  {name}')
+        click.echo('Players load when they\'re attached the first time, their imports are not included')
+
+    bot.add_listener(report, 'on_ready')
+
+
 if __name__ == "__main__":
     main()
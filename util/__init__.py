@@ -1,3 +1,6 @@
 from .exists_file_handler import ExistsFileHandler
 
-from .disk_cache import CacheManager, memoized_result
+from .disk_cache import CacheManager, AsyncGlobalCache, memoized_result
+from .channel_index import ChannelIndex
+from .import_timer import ImportTimer
+from . import metrics
@@ -0,0 +1,142 @@
+import bisect
+import collections
+import heapq
+import itertools
+
+from unidecode import unidecode
+
+MIN_SIMILARITY = 0.3  # Share of trigrams a fuzzy match has in common with the query, from 0 to 1
+LOOKUP_LIMIT = 5
+# Channels a fuzzy lookup scores, gathered from the rarest trigrams of the query. Trigrams which would exceed it, eg of
+# words every other channel name has, only add to the counts of those. The rarest trigram always gathers candidates.
+MAX_CANDIDATES = 200
+
+
+def normalize(name: str) -> str:
+    """Transliterated to ASCII, case-folded and with whitespace collapsed, so `Müsik  Raum` finds `musik raum`."""
+    return ' '.join(unidecode(name).casefold().split())
+
+
+def _trigrams(name: str):
+    # Padded, so names shorter than three characters and word boundaries get trigrams as well
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _inner_words(name: str):
+    return [name[i + 1:] for i, char in enumerate(name) if char == ' ']
+
+
+def _starting_with(entries: list, prefix: str):
+    """Yields the (text, channel id) entries of the sorted list whose text starts with the prefix, in order."""
+    i = bisect.bisect_left(entries, (prefix,))
+    while i < len(entries) and entries[i][0].startswith(prefix):
+        yield entries[i]
+        i += 1
+
+
+def _remove_sorted(entries: list, entry):
+    i = bisect.bisect_left(entries, entry)
+    if i < len(entries) and entries[i] == entry:
+        del entries[i]
+
+
+class ChannelIndex:
+    """Normalized names of channels, looked up by prefix and ranked typo-tolerant trigram matches.
+
+    Channels are added, renamed and removed one at a time, nothing is rebuilt."""
+
+    def __init__(self, channels=()):
+        # Channel id -> (channel, normalized name, trigram count)
+        self._channels = {}
+        # Sorted (normalized name, channel id), names starting with a query are a bisect away
+        self._names = []
+        # Sorted (name from the start of its second, third, ... word, channel id)
+        self._words = []
+        # Trigram -> ids of the channels whose name contains it
+        self._trigrams = collections.defaultdict(set)
+        for channel in channels:
+            self.add(channel)
+
+    def __len__(self):
+        return len(self._channels)
+
+    def add(self, channel):
+        """Indexes the channel, replacing the previous name of a channel already indexed."""
+        self.remove(channel.id)
+        name = normalize(channel.name)
+        trigrams = _trigrams(name)
+        self._channels[channel.id] = (channel, name, len(trigrams))
+        bisect.insort(self._names, (name, channel.id))
+        for words in _inner_words(name):
+            bisect.insort(self._words, (words, channel.id))
+        for trigram in trigrams:
+            self._trigrams[trigram].add(channel.id)
+
+    def remove(self, channel_id: int):
+        entry = self._channels.pop(channel_id, None)
+        if entry is None:
+            return
+        name = entry[1]
+        _remove_sorted(self._names, (name, channel_id))
+        for words in _inner_words(name):
+            _remove_sorted(self._words, (words, channel_id))
+        for trigram in _trigrams(name):
+            ids = self._trigrams[trigram]
+            ids.discard(channel_id)
+            if not ids:
+                del self._trigrams[trigram]
+
+    def find(self, query: str, limit: int = LOOKUP_LIMIT):
+        """Returns up to `limit` channels matching the query, best first: names starting with it, the exact name
+        first, then names with a later word starting with it, then names sharing most trigrams with it."""
+        query = normalize(query)
+        if not query or limit < 1:
+            return []
+
+        found = []
+        # Sorted, so the exact name comes first and the rest alphabetically. Only reads as many as are returned.
+        for _, channel_id in itertools.chain(_starting_with(self._names, query), _starting_with(self._words, query)):
+            if channel_id not in found:
+                found.append(channel_id)
+                if len(found) == limit:
+                    break
+        if len(found) < limit:
+            found.extend(self._similar(query, limit - len(found), set(found)))
+        return [self._channels[channel_id][0] for channel_id in found]
+
+    def _similar(self, query: str, limit: int, exclude: set):
+        """Ids of the channels sharing the most trigrams with the query, relative to the trigrams of both."""
+        query_trigrams = _trigrams(query)
+        postings = sorted((self._trigrams[trigram] for trigram in query_trigrams if trigram in self._trigrams),
+                          key=len)
+        shared = collections.Counter()
+        for i, ids in enumerate(postings):
+            if shared and len(shared) + len(ids) > MAX_CANDIDATES:
+                candidates = set(shared)
+                for common in postings[i:]:
+                    shared.update(candidates & common)
+                break
+            shared.update(ids)
+
+        best = []  # Heap of (similarity, -channel id), the worst of the best on top
+        for channel_id, count in shared.most_common():
+            # Even a name of nothing but shared trigrams can't beat the ones found, and the counts only get lower
+            bound = 2 * count / (len(query_trigrams) + count)
+            if bound < MIN_SIMILARITY or (len(best) == limit and bound < best[0][0]):
+                break
+            if channel_id in exclude:
+                continue
+            similarity = 2 * count / (len(query_trigrams) + self._channels[channel_id][2])
+            if similarity < MIN_SIMILARITY:
+                continue
+            if len(best) < limit:
+                heapq.heappush(best, (similarity, -channel_id))
+            elif (similarity, -channel_id) > best[0]:
+                heapq.heapreplace(best, (similarity, -channel_id))
+        return [-channel_id for _, channel_id in sorted(best, reverse=True)]
+
+    def best(self, query: str):
+        """The best match of the query, None when nothing matches."""
+        found = self.find(query, limit=1)
+        return found[0] if found else None
@@ -1,7 +1,11 @@
 import tempfile
 import os
+import shutil
 import logging
 import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import diskcache
 
@@ -10,23 +14,98 @@ memoized_result = diskcache.fanout.memoize
 
 log = logging.getLogger(__name__)
 
+FLUSH_DELAY = 0.5  # seconds writes are collected before they're flushed as one transaction
+_DELETED = object()
+_MISSING = object()
+
 
 # See http://www.grantjenks.com/docs/diskcache/api.html
 # for examples on how to interface with the cache objects!
 
+RUN_PREFIX = 'run-'  # Temporary arenas of one bot process live in `<tempdir>/run-<pid>-<start time>`
+CULL_INTERVAL = 10.0  # seconds between checks of the byte budgets
+EVICTION_POLICY = 'least-recently-used'
+
+
+def _volume(cache):
+    """Bytes used by a diskcache object or a registered store, as its own size accounting sees it."""
+    volume = getattr(cache, 'volume', None)
+    if volume is None:
+        # Index and Deque wrap a Cache
+        volume = cache._cache.volume
+    return volume()
+
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.stat(os.path.join(root, file_name)).st_size
+            except OSError:
+                # Removed while walking
+                pass
+    return total
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists, but belongs to someone else
+        return True
+    return True
+
+
 class CacheManager:
-    def __init__(self, storage_path=None):
+    def __init__(self, storage_path=None, max_bytes=None, cull_interval=CULL_INTERVAL):
         if storage_path:
-            if os.path.isdir(storage_path):
+            if not os.path.isdir(storage_path):
                 raise FileNotFoundError('The provided path is not a valid directory!')
             self.tempdir = os.path.abspath(storage_path)
         else:
             self.tempdir = os.path.join(tempfile.gettempdir(), 'pingu-bot')
 
+        self.max_bytes = max_bytes
+        self._cull_interval = cull_interval
+        self._sweep_orphans()
+        self._run_path = os.path.join(self.tempdir, f'{RUN_PREFIX}{os.getpid()}-{int(time.time())}')
         self._global_cache = self._build_global_cache()
         self._arenas = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._culler = None
+        if max_bytes:
+            self._start_culler()
         log.info(f'Cache folder: {self.tempdir}')
 
+    def _sweep_orphans(self):
+        """Removes the temporary arenas of bot processes which are gone, eg after a crash."""
+        if not os.path.isdir(self.tempdir):
+            return
+        reclaimed = 0
+        for entry in os.listdir(self.tempdir):
+            path = os.path.join(self.tempdir, entry)
+            if entry.startswith(RUN_PREFIX):
+                try:
+                    pid = int(entry[len(RUN_PREFIX):].split('-')[0])
+                except ValueError:
+                    continue
+                if pid != os.getpid() and _process_alive(pid):
+                    continue
+            else:
+                try:
+                    # Older versions used a timestamp per arena
+                    float(entry)
+                except ValueError:
+                    continue
+            reclaimed += _directory_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+        if reclaimed:
+            log.info(f'Swept {reclaimed / 1024 ** 2:.1f}MB of orphaned arenas')
+
     def _build_global_cache(self):
         # GlobalCache is actually an arena in itself.
         # We persist the arena path, because global data is intended to survive rebooting the bot!
@@ -34,29 +113,130 @@ class CacheManager:
         return GlobalCache(global_dir)
 
     def _build_tmp_path(self):
-        return os.path.join(self.tempdir, str(time.time()))
+        return self._run_path
 
     @property
     def global_cache(self):
         return self._global_cache
 
-    def create_arena(self, arena_name):
+    def _build_persistent_path(self):
+        return os.path.join(self.tempdir, 'arenas')
+
+    def create_arena(self, arena_name, persistent=False, max_bytes=None, eviction_policy=EVICTION_POLICY):
         """
         Allocates a new cache folder where data for a specific scenario can be stored.
+        Persistent arenas reuse the same folder after rebooting the bot, the others start empty.
+        Above `max_bytes` the caches of the arena evict items following `eviction_policy`.
         This method returns None if the name is already in use!
         """
         new_arena = None
-        if arena_name not in self._arenas:
-            arena_path = os.path.join(self._build_tmp_path(), arena_name)
-            self._arenas[arena_name] = CacheArena(arena_path, arena_name)
+        with self._lock:
+            if arena_name not in self._arenas:
+                arena_path = self._build_persistent_path() if persistent else self._build_tmp_path()
+                new_arena = CacheArena(arena_path, arena_name, max_bytes, eviction_policy, persistent)
+                self._arenas[arena_name] = new_arena
+        if max_bytes:
+            self._start_culler()
         return new_arena
 
     def remove_arena(self, arena_name):
-        return self._arenas.pop(arena_name, None) is not None
+        """Closes the caches of the arena, the folder of a temporary arena is deleted as well."""
+        with self._lock:
+            arena = self._arenas.pop(arena_name, None)
+        if arena is None:
+            return False
+        arena.cleanup()
+        if not arena.persistent:
+            shutil.rmtree(arena.directory, ignore_errors=True)
+        return True
+
+    def _start_culler(self):
+        with self._lock:
+            if self._culler is None and not self._stopped.is_set():
+                self._culler = threading.Thread(target=self._cull_loop, name='Cache culler', daemon=True)
+                self._culler.start()
+
+    def _cull_loop(self):
+        while not self._stopped.wait(self._cull_interval):
+            try:
+                self.cull()
+            except Exception:
+                log.exception('Enforcing cache budgets failed')
+
+    def cull(self):
+        """Brings every arena within its budget, then all arenas together within the global budget.
+        Returns the amount of bytes freed."""
+        with self._lock:
+            arenas = list(self._arenas.values())
+        freed = sum(arena.cull() for arena in arenas)
+        if self.max_bytes:
+            sizes = {arena: arena.size() for arena in arenas}
+            excess = sum(sizes.values()) + _volume(self._global_cache) - self.max_bytes
+            # Largest arenas give up space first
+            for arena in sorted(arenas, key=sizes.get, reverse=True):
+                if excess <= 0:
+                    break
+                evicted = arena.evict(excess)
+                excess -= evicted
+                freed += evicted
+            if excess > 0:
+                log.warning(f'Caches exceed the global budget by {excess / 1024 ** 2:.1f}MB, '
+                            f'the rest is not evictable')
+        return freed
+
+    def stats(self):
+        """Stats of every arena by name."""
+        with self._lock:
+            arenas = list(self._arenas.values())
+        return {arena.name: arena.stats() for arena in arenas}
+
+    def collect_metrics(self):
+        """Metrics collector exporting the stats of every arena."""
+        for name, stats in self.stats().items():
+            labels = {'arena': name}
+            yield 'pingu_cache_bytes', 'gauge', 'Bytes used by the arena', labels, stats['size']
+            yield 'pingu_cache_hits_total', 'counter', 'Lookups served by the arena', labels, stats['hits']
+            yield 'pingu_cache_misses_total', 'counter', 'Lookups the arena missed', labels, stats['misses']
+            yield 'pingu_cache_evictions_total', 'counter', 'Items evicted from the arena', labels, stats['evictions']
+            lookups = stats['hits'] + stats['misses']
+            if lookups:
+                yield 'pingu_cache_hit_ratio', 'gauge', 'Share of lookups served by the arena', labels, \
+                      stats['hits'] / lookups
 
     def cleanup(self):
+        self._stopped.set()
+        if self._culler is not None:
+            self._culler.join()
+        with self._lock:
+            arenas = list(self._arenas)
+        for arena_name in arenas:
+            self.remove_arena(arena_name)
+        _close_cache(self._global_cache)
         del self._global_cache
-        self._arenas.clear()
+        shutil.rmtree(self._run_path, ignore_errors=True)
+
+
+def _cull_to(cache, max_bytes):
+    """Culls a diskcache Cache or FanoutCache down to `max_bytes`, returns the amount of evicted items."""
+    # A FanoutCache splits its size limit over its shards
+    shards = getattr(cache, '_shards', (cache,))
+    evicted = 0
+    for shard in shards:
+        limit = shard.size_limit
+        shard.reset('size_limit', int(max_bytes / len(shards)))
+        evicted += shard.cull() or 0
+        shard.reset('size_limit', limit)
+    return evicted
+
+
+def _close_cache(cache):
+    """Closes the database handles of any diskcache object."""
+    close = getattr(cache, 'close', None)
+    if close is None:
+        # Index and Deque wrap a Cache
+        close = getattr(getattr(cache, '_cache', None), 'close', None)
+    if close is not None:
+        close()
 
 
 class GlobalCache(diskcache.Index):
@@ -66,15 +246,215 @@ class GlobalCache(diskcache.Index):
         super().__init__(directory, *args, **kwargs)
 
 
+class AsyncGlobalCache:
+    """Facade over the GlobalCache that keeps SQLite off the event loop.
+
+    Reads are served from memory, only the first read of a key touches disk, keys missing on disk are
+    remembered until they're written. Writes update memory
+    immediately and are flushed to disk in batched transactions by a background thread. Until a batch
+    is committed, reads see its writes and deletes rather than the disk. Batches failing to commit are
+    queued again. Setting and deleting items is thread safe. Call `close` to guarantee all writes hit the disk.
+    """
+
+    def __init__(self, cache: GlobalCache, loop, flush_delay: float = FLUSH_DELAY):
+        self._cache = cache
+        self._loop = loop
+        self._flush_delay = flush_delay
+        self._memory = {}
+        # Keys known to be missing on disk
+        self._missing = set()
+        self._pending = {}
+        # Batches being written, oldest first
+        self._flushing = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+        # A single thread keeps batches ordered
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='GlobalCache flush')
+        # Metrics
+        self.flushes = 0
+        self.flushed_writes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def queue_depth(self):
+        """Amount of writes waiting to be flushed."""
+        return len(self._pending)
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = self._memory[key]
+            except KeyError:
+                value = self._queued(key)
+                if value is _DELETED or key in self._missing:
+                    raise
+                if value is _MISSING:
+                    try:
+                        value = self._cache[key]
+                    except KeyError:
+                        self._missing.add(key)
+                        raise
+                self._memory[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._missing.discard(key)
+            self._queue(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._queue(key, _DELETED)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """All keys, including the ones that are not flushed yet."""
+        with self._lock:
+            keys = set(self._cache.keys())
+            for batch in self._flushing + [self._pending]:
+                for key, value in batch.items():
+                    if value is _DELETED:
+                        keys.discard(key)
+                    else:
+                        keys.add(key)
+        return list(keys)
+
+    def _queued(self, key):
+        """The latest value of the key which isn't on disk yet, `_DELETED` or `_MISSING`. Lock must be held."""
+        for batch in [self._pending] + self._flushing[::-1]:
+            if key in batch:
+                return batch[key]
+        return _MISSING
+
+    def _queue(self, key, value):
+        # Lock must be held
+        self._pending[key] = value
+        self._schedule()
+
+    def _schedule(self):
+        # Lock must be held
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon_threadsafe(self._loop.call_later, self._flush_delay, self._start_flush)
+
+    def _start_flush(self):
+        task = asyncio.ensure_future(self.flush(), loop=self._loop)
+        task.add_done_callback(self._flushed)
+
+    @staticmethod
+    def _flushed(task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error('Flushing the global cache failed, retrying', exc_info=task.exception())
+
+    def _write(self, batch: dict):
+        with self._cache.transact():
+            for key, value in batch.items():
+                if value is _DELETED:
+                    self._cache.pop(key, None)
+                else:
+                    self._cache[key] = value
+
+    async def flush(self):
+        """Writes all queued changes to disk in one transaction."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._scheduled = False
+            if not batch:
+                return
+            self._flushing.append(batch)
+
+        start = time.perf_counter()
+        try:
+            await self._loop.run_in_executor(self._executor, self._write, batch)
+        except BaseException:
+            # Queue the batch again, under the writes made since
+            with self._lock:
+                newer = self._flushing[self._flushing.index(batch) + 1:]
+                self._flushing.remove(batch)
+                retry = {key: value for key, value in batch.items() if not any(key in b for b in newer)}
+                retry.update(self._pending)
+                self._pending = retry
+                self._schedule()
+            raise
+        with self._lock:
+            self._flushing.remove(batch)
+        latency = time.perf_counter() - start
+        self.flushes += 1
+        self.flushed_writes += len(batch)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'flushes': self.flushes,
+            'flushed_writes': self.flushed_writes,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+    def collect_metrics(self):
+        """Metrics collector exporting the write queue and flush stats."""
+        yield 'pingu_global_cache_queue_depth', 'gauge', 'Writes waiting to be flushed', {}, self.queue_depth
+        yield 'pingu_global_cache_flushes_total', 'counter', 'Batches flushed to disk', {}, self.flushes
+        yield 'pingu_global_cache_flushed_writes_total', 'counter', 'Writes flushed to disk', {}, \
+              self.flushed_writes
+        yield 'pingu_global_cache_flush_seconds_max', 'gauge', 'Slowest flush so far', {}, self.max_flush_latency
+
+    async def close(self):
+        """Flushes the remaining writes and stops the background thread."""
+        await self.flush()
+        await self._loop.run_in_executor(None, self._executor.shutdown)
+
+
 class CacheArena:
     """Manages a specific cache directory. All cache objects built from this arena work on THE SAME data!
     Build multiple arenas for each different purpose!
+
+    Arenas with `max_bytes` evict from their evictable caches when the manager culls them. The caches don't
+    cull themselves while writing, so evictions can be counted.
+    Index and Deque caches are never evicted, but they do count towards the size of the arena.
     """
 
-    def __init__(self, directory, name):
+    def __init__(self, directory, name, max_bytes=None, eviction_policy=EVICTION_POLICY, persistent=False):
         self.directory = os.path.join(directory, name)
         self.name = name
+        self.max_bytes = max_bytes
+        self.eviction_policy = eviction_policy
+        self.persistent = persistent
+        self.evictions = 0
         self._caches = []
+        # Caches and registered stores which can give up items
+        self._evictable = []
+
+    def _evictable_settings(self, kwargs):
+        kwargs.setdefault('eviction_policy', self.eviction_policy)
+        if self.max_bytes:
+            kwargs.setdefault('size_limit', self.max_bytes)
+            # Culled by the manager
+            kwargs.setdefault('cull_limit', 0)
+        return kwargs
+
+    def _add_evictable(self, cache):
+        cache.stats(enable=True)
+        self._caches.append(cache)
+        self._evictable.append(cache)
+        return cache
 
     def build_simple_cache(self, directory=None, *args, **kwargs):
         """Returns a simple key-value cache with automatic eviction enabled.
@@ -82,9 +462,8 @@ class CacheArena:
         """
         if not directory:
             directory = self.directory
-        cache = diskcache.Cache(directory=directory, *args, **kwargs)
-        self._caches.append(cache)
-        return cache
+        cache = diskcache.Cache(directory=directory, *args, **self._evictable_settings(kwargs))
+        return self._add_evictable(cache)
 
     def build_index(self, *args, **kwargs):
         """Returns a persistent key-value cache without automatic eviction.
@@ -102,18 +481,78 @@ class CacheArena:
         """
         # Dissalow passing directory to the constructor
         kwargs.pop('directory', None)
-        cache = diskcache.FanoutCache(directory=self.directory, **kwargs)
-        self._caches.append(cache)
-        return cache
+        cache = diskcache.FanoutCache(directory=self.directory, **self._evictable_settings(kwargs))
+        return self._add_evictable(cache)
 
-    def build_deque(self, *args, **kwargs):
+    def build_deque(self, name=None, *args, **kwargs):
         """Returns a persistent cache supporting FIFO queue operations. Both ends can be manipulated.
-        This cache can be used to build a threadsafe command queue."""
+        This cache can be used to build a threadsafe command queue.
+        Deques with a different name are stored separately within this arena."""
         # Dissalow passing directory to the constructor
         kwargs.pop('directory', None)
-        cache = diskcache.Deque(directory=self.directory, **kwargs)
+        directory = os.path.join(self.directory, str(name)) if name is not None else self.directory
+        cache = diskcache.Deque(directory=directory, **kwargs)
         self._caches.append(cache)
         return cache
 
+    def register(self, store):
+        """Adds a store managing its own files within the arena directory to the budget and stats of the arena.
+        The store provides `volume()`, `evict_to(max_bytes)` returning the amount of evicted items,
+        `stats()` returning a dict with hits, misses and evictions, and `close()`."""
+        self._caches.append(store)
+        self._evictable.append(store)
+
+    def size(self):
+        """Bytes used by the caches of this arena. SQLite journals are not included."""
+        # Caches built over the same directory share their data
+        volumes = {cache.directory: _volume(cache) for cache in self._caches}
+        return sum(volumes.values())
+
+    def cull(self):
+        """Evicts items until the arena fits its budget, returns the amount of bytes freed."""
+        if not self.max_bytes:
+            return 0
+        return self.evict(self.size() - self.max_bytes)
+
+    def evict(self, amount):
+        """Evicts at least `amount` bytes when possible, from the largest caches first.
+        Returns the amount of bytes freed."""
+        freed = 0
+        for store in sorted(self._evictable, key=lambda s: s.volume(), reverse=True):
+            if freed >= amount:
+                break
+            volume = store.volume()
+            target = max(0, volume - (amount - freed))
+            if isinstance(store, (diskcache.Cache, diskcache.FanoutCache)):
+                self.evictions += _cull_to(store, target)
+            else:
+                store.evict_to(target)
+            freed += volume - store.volume()
+        return freed
+
+    def stats(self):
+        hits = misses = 0
+        evictions = self.evictions
+        for store in self._evictable:
+            if isinstance(store, (diskcache.Cache, diskcache.FanoutCache)):
+                store_hits, store_misses = store.stats()
+            else:
+                store_stats = store.stats()
+                store_hits, store_misses = store_stats['hits'], store_stats['misses']
+                evictions += store_stats['evictions']
+            hits += store_hits
+            misses += store_misses
+        return {
+            'size': self.size(),
+            'max_bytes': self.max_bytes,
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+        }
+
     def cleanup(self):
+        """Closes every cache built from this arena."""
+        for cache in self._caches:
+            _close_cache(cache)
         del self._caches[:]
+        del self._evictable[:]
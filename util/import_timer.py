@@ -0,0 +1,79 @@
+import sys
+import time
+
+
+class _TimedLoader:
+    """Wraps the loader of a module, timing how long executing the module takes."""
+
+    def __init__(self, timer, loader):
+        self._timer = timer
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        create_module = getattr(self._loader, 'create_module', None)
+        return create_module(spec) if create_module is not None else None
+
+    def exec_module(self, module):
+        self._timer._enter()
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer._exit(module.__name__, time.perf_counter() - start)
+
+
+class ImportTimer:
+    """Measures how long importing each module takes, like `python -X importtime`, while installed.
+
+    Cumulative time includes the modules a module imports itself, self time doesn't. Modules imported
+    before installing aren't measured.
+    """
+
+    def __init__(self):
+        # Module name -> (self seconds, cumulative seconds), in import order
+        self.modules = {}
+        # Time spent in nested imports, per module being executed
+        self._nested = []
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            # Namespace packages have nothing to execute
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimedLoader(self, spec.loader)
+            return spec
+        return None
+
+    def _enter(self):
+        self._nested.append(0.0)
+
+    def _exit(self, name: str, elapsed: float):
+        nested = self._nested.pop()
+        if self._nested:
+            self._nested[-1] += elapsed
+        self.modules[name] = (elapsed - nested, elapsed)
+
+    @property
+    def total(self):
+        """Seconds spent importing, without counting nested imports twice."""
+        return sum(self_time for self_time, _ in self.modules.values())
+
+    def slowest(self, count: int = 20):
+        """The modules taking the most time including their imports, as (name, self seconds, cumulative seconds)."""
+        ranked = sorted(self.modules.items(), key=lambda item: item[1][1], reverse=True)
+        return [(name, self_time, cumulative) for name, (self_time, cumulative) in ranked[:count]]
@@ -0,0 +1,211 @@
+import asyncio
+import bisect
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Seconds, from 100us up to 1s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    """Monotonic counter. Increments aren't locked, metrics tolerate a rare lost update between threads."""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last bucket holds everything above the largest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding quantile `q`, None without observations."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class _Family:
+    """All metrics sharing a name, one per combination of label values."""
+
+    def __init__(self, name: str, kind: str, help_text: str, labelnames, factory):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values, None)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(v) for v in values), None)
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            yield dict(zip(self.labelnames, values)), child
+
+
+class MetricsRegistry:
+    """Metrics of the audio and command pipelines.
+
+    Instrumented code checks `enabled` once, when it's set up, and skips its measurements entirely when
+    metrics are off. Collectors are called when metrics are read, they export stats which are kept
+    anyway, eg cache hits. A collector yields `(name, kind, help, labels, value)` tuples.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._families = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _family(self, name, kind, help_text, labelnames, factory):
+        with self._lock:
+            family = self._families.get(name, None)
+            if family is None:
+                family = self._families[name] = _Family(name, kind, help_text, labelnames, factory)
+            return family
+
+    def counter(self, name: str, help_text: str, labelnames=()):
+        return self._family(name, 'counter', help_text, labelnames, Counter)
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._family(name, 'histogram', help_text, labelnames, lambda: Histogram(buckets))
+
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def _collected(self):
+        """Collector samples grouped by name."""
+        with self._lock:
+            collectors = list(self._collectors)
+        grouped = {}
+        for collector in collectors:
+            try:
+                for name, kind, help_text, labels, value in collector():
+                    grouped.setdefault(name, (kind, help_text, []))[2].append((labels, value))
+            except Exception:
+                log.exception(f'Metrics collector {collector} failed')
+        return grouped
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            families = list(self._families.values())
+        for family in families:
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            for labels, metric in family.samples():
+                if family.kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.bounds + (float('inf'),), metric.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{family.name}_bucket{_labels(labels, le=le)} {cumulative}')
+                    lines.append(f'{family.name}_sum{_labels(labels)} {metric.sum}')
+                    lines.append(f'{family.name}_count{_labels(labels)} {metric.count}')
+                else:
+                    lines.append(f'{family.name}{_labels(labels)} {metric.value}')
+        for name, (kind, help_text, samples) in self._collected().items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Short, human readable overview: counters, p50/p99 of histograms and collected values."""
+        lines = []
+        with self._lock:
+            families = list(self._families.values())
+        for family in families:
+            for labels, metric in family.samples():
+                name = f'{family.name}{_labels(labels)}'
+                if family.kind == 'histogram':
+                    if metric.count:
+                        lines.append(f'{name} n={metric.count} p50<={_ms(metric.quantile(0.5))} '
+                                     f'p99<={_ms(metric.quantile(0.99))}')
+                else:
+                    lines.append(f'{name} {metric.value}')
+        for name, (_, _, samples) in self._collected().items():
+            for labels, value in samples:
+                lines.append(f'{name}{_labels(labels)} {value:.4g}' if isinstance(value, float)
+                             else f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines)
+
+
+def _labels(labels: dict, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def _ms(seconds):
+    return 'inf' if seconds == float('inf') else f'{seconds * 1000:g}ms'
+
+
+registry = MetricsRegistry()
+
+
+async def serve(metrics: MetricsRegistry, port: int, host: str = '127.0.0.1'):
+    """Serves the metrics over HTTP in the Prometheus text format, for any path."""
+
+    async def handle(reader, writer):
+        try:
+            # Request line and headers, the request itself doesn't matter
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            body = metrics.render().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    log.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server